@@ -0,0 +1,263 @@
+"""
+Throughput benchmarks for the MuchMore and n2c2 loaders on synthetic data
+
+Generates archives with synthetic.py (sized by --scale), then runs each
+benchmark in its own python process so peak RSS is not shared between
+them. Reports wall time, docs/sec, tokens/sec and peak RSS.
+
+    python benchmarks/bench_loaders.py --scale 1.0
+    python benchmarks/bench_loaders.py --scale 0.2 --only read_anno iter_docs
+    python benchmarks/bench_loaders.py --json results.json
+
+Benchmarks needing `datasets` (generate_examples*) are skipped when it is
+not installed.
+
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, Tuple
+
+import synthetic
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MUCH_MORE_DIR = os.path.join(REPO_DIR, "much_more")
+N2C2_DIR = os.path.join(REPO_DIR, "n2c2_2011_coref")
+
+
+# Setup
+#=========================================
+
+def _much_more_parse(data_dir: str):
+    """parse.py from much_more with its archive paths pointed at data_dir"""
+    sys.path.insert(0, MUCH_MORE_DIR)
+    import parse
+
+    for paths in (parse.PLAIN_PATHS, parse.ANNO_PATHS):
+        for key, path in paths.items():
+            paths[key] = os.path.join(data_dir, "much_more", os.path.basename(path))
+    return parse
+
+
+def _much_more_anno_paths(data_dir: str):
+    """the annotated archives in data_dir, without importing parse.py (the
+    dataset script has its own copies of the loader modules)"""
+    return [
+        os.path.join(data_dir, "much_more", f"springer_{name}_train_V4.2.tar.gz")
+        for name in ("english", "german")
+    ]
+
+
+def _muchmore_builder(**config_kwargs):
+    sys.path.insert(0, REPO_DIR)
+    from much_more import muchmore
+
+    return muchmore.MuchMoreDataset(
+        cache_dir=tempfile.mkdtemp(), name="muchmore", **config_kwargs
+    )
+
+
+def _n2c2_parse():
+    spec = importlib.util.spec_from_file_location("n2c2_parse", os.path.join(N2C2_DIR, "parse.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# Benchmarks
+#=========================================
+# each returns a zero argument callable that does the timed work and
+# returns the number of documents it produced. setup work is not timed.
+
+def bench_read_plain(data_dir):
+    parse = _much_more_parse(data_dir)
+    return lambda: len(parse.read_plain())
+
+
+def bench_read_anno(data_dir):
+    parse = _much_more_parse(data_dir)
+    return lambda: len(parse.read_anno())
+
+
+def bench_read_docs(data_dir):
+    """the parse.py document loop over an already read df_anno"""
+    parse = _much_more_parse(data_dir)
+    df_anno = parse.read_anno()
+    return lambda: len(parse.read_docs(df_anno))
+
+
+def bench_iter_docs(data_dir):
+    parse = _much_more_parse(data_dir)
+    return lambda: sum(1 for _ in parse.iter_docs())
+
+
+def bench_iter_docs_num_proc(data_dir):
+    parse = _much_more_parse(data_dir)
+    return lambda: sum(1 for _ in parse.iter_docs(num_proc=os.cpu_count()))
+
+
+def _bench_generate_examples(data_dir, **config_kwargs):
+    import datasets
+
+    builder = _muchmore_builder(**config_kwargs)
+    dl_manager = datasets.DownloadManager()
+
+    # listing the members into shards is setup, not timed
+    shards = [builder._get_shards(dl_manager, [path]) for path in _much_more_anno_paths(data_dir)]
+
+    def run():
+        return sum(
+            sum(1 for _ in builder._generate_examples(archive_shards, "train"))
+            for archive_shards in shards
+        )
+
+    return run
+
+
+def bench_generate_examples(data_dir):
+    return _bench_generate_examples(data_dir)
+
+
+def bench_generate_examples_streaming(data_dir):
+    return _bench_generate_examples(data_dir, streaming_parse=True)
+
+
+def bench_generate_examples_num_proc(data_dir):
+    return _bench_generate_examples(data_dir, parse_num_proc=os.cpu_count())
+
+
+def bench_n2c2_concepts(data_dir):
+    n2c2 = _n2c2_parse()
+    samples = n2c2.read_samples(os.path.join(data_dir, "n2c2_2011_coref", "Task_1C.zip"))
+    return lambda: sum(1 for sample in samples.values() if n2c2.get_concepts(sample) is not None)
+
+
+def bench_n2c2_iter_samples(data_dir):
+    n2c2 = _n2c2_parse()
+    path = os.path.join(data_dir, "n2c2_2011_coref", "Task_1C.zip")
+    return lambda: sum(1 for sample in n2c2.iter_samples(path) if sample["concepts"] is not None)
+
+
+BENCHMARKS: Dict[str, Tuple[Callable, str]] = {
+    "read_plain": (bench_read_plain, "much_more"),
+    "read_anno": (bench_read_anno, "much_more"),
+    "read_docs": (bench_read_docs, "much_more"),
+    "iter_docs": (bench_iter_docs, "much_more"),
+    "iter_docs_num_proc": (bench_iter_docs_num_proc, "much_more"),
+    "generate_examples": (bench_generate_examples, "much_more"),
+    "generate_examples_streaming": (bench_generate_examples_streaming, "much_more"),
+    "generate_examples_num_proc": (bench_generate_examples_num_proc, "much_more"),
+    "n2c2_concepts": (bench_n2c2_concepts, "n2c2_2011_coref"),
+    "n2c2_iter_samples": (bench_n2c2_iter_samples, "n2c2_2011_coref"),
+}
+
+
+# Running
+#=========================================
+
+def _count_tokens(counts: Dict, dataset: str, name: str) -> int:
+    if dataset == "n2c2_2011_coref":
+        return counts[dataset]["tokens"]
+    # plain text has the same tokens as the (non empty) annotations
+    return sum(lang["tokens"] for lang in counts[dataset].values())
+
+
+def run_one(name: str, data_dir: str) -> Dict:
+    """Run a single benchmark in this process"""
+    make, dataset = BENCHMARKS[name]
+    try:
+        run = make(data_dir)
+    except ImportError as err:
+        return {"name": name, "skipped": str(err)}
+
+    cpu0 = time.process_time()
+    t0 = time.perf_counter()
+    docs = run()
+    wall = time.perf_counter() - t0
+    cpu = time.process_time() - cpu0
+
+    with open(os.path.join(data_dir, "counts.json")) as fp:
+        counts = json.load(fp)
+    tokens = _count_tokens(counts, dataset, name)
+
+    # ru_maxrss is in KiB on linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    return {
+        "name": name,
+        "docs": docs,
+        "tokens": tokens,
+        "wall_s": wall,
+        "cpu_s": cpu,
+        "docs_per_s": docs / wall,
+        "tokens_per_s": tokens / wall,
+        "peak_rss_bytes": max(peak_rss, children_rss),
+    }
+
+
+def run_isolated(name: str, data_dir: str) -> Dict:
+    """Run a single benchmark in a fresh python process"""
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--run-one", name, "--data-dir", data_dir],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def print_results(results):
+    print(f"{'benchmark':30s} {'docs':>7s} {'wall s':>8s} {'docs/s':>9s} {'tokens/s':>11s} {'peak MiB':>9s}")
+    for result in results:
+        if "skipped" in result:
+            print(f"{result['name']:30s} skipped ({result['skipped']})")
+            continue
+        print(
+            f"{result['name']:30s} {result['docs']:7d} {result['wall_s']:8.2f} "
+            f"{result['docs_per_s']:9.1f} {result['tokens_per_s']:11.0f} "
+            f"{result['peak_rss_bytes'] / 2 ** 20:9.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=float, default=0.2)
+    parser.add_argument("--data-dir", help="reuse synthetic data in this dir instead of generating it")
+    parser.add_argument("--only", nargs="*", choices=list(BENCHMARKS))
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        # stdout of a child process is the json result, so print() in the
+        # loaders (e.g. "skipping" empty members) goes to stderr instead
+        stdout, sys.stdout = sys.stdout, sys.stderr
+        result = run_one(args.run_one, args.data_dir)
+        print(json.dumps(result), file=stdout)
+        return
+
+    data_dir = args.data_dir
+    if data_dir is None:
+        data_dir = tempfile.mkdtemp(prefix="bench_loaders_")
+    if not os.path.exists(os.path.join(data_dir, "counts.json")):
+        print(f"writing synthetic data (scale={args.scale}) to {data_dir}")
+        synthetic.write_all(data_dir, args.scale)
+
+    results = [run_isolated(name, data_dir) for name in (args.only or BENCHMARKS)]
+    print_results(results)
+
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
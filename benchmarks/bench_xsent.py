@@ -0,0 +1,200 @@
+"""
+Benchmark the single pass sentence walk (anno.read_xsent) against the
+six find/findall helpers parse.py used before it, on the annotated archives.
+
+Trees are built up front so only sentence extraction is timed.
+
+    python benchmarks/bench_xsent.py [repeats]
+
+"""
+
+import os
+import sys
+import time
+from typing import Tuple
+import xml.etree.ElementTree as ET
+from xml.etree.ElementTree import Element
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MUCH_MORE_DIR = os.path.join(REPO_DIR, "much_more")
+
+sys.path.insert(0, MUCH_MORE_DIR)
+
+from anno import DICT_BUILDERS, read_xsent
+from parse import (
+    ANNO_PATHS,
+    XSENT_BUILDERS,
+    Chunk,
+    Concept,
+    EwnTerm,
+    Msh,
+    SemRel,
+    Sense,
+    Token,
+    UmlsTerm,
+    read_anno,
+)
+
+
+# The find/findall helpers (one walk per layer)
+#=========================================
+
+def get_umlsterms_from_xsent(xsent: Element) -> Tuple[UmlsTerm,...]:
+    xumlsterms = xsent.find("./umlsterms")
+
+    umlsterms = []
+    for xumlsterm in xumlsterms.findall("./umlsterm"):
+
+        concepts = []
+        for xconcept in xumlsterm.findall("./concept"):
+
+            mshs = []
+            for xmsh in xconcept.findall("./msh"):
+                msh = Msh(xcode=xmsh.get("code"))
+                mshs.append(msh)
+
+            concept = Concept(
+                xid=xconcept.get("id"),
+                xcui=xconcept.get("cui"),
+                xpreferred=xconcept.get("preferred"),
+                xtui=xconcept.get("tui"),
+                xmshs=tuple(mshs),
+            )
+            concepts.append(concept)
+
+        umlsterm = UmlsTerm(
+            xid=xumlsterm.get("id"),
+            xfrom=xumlsterm.get("from"),
+            xto=xumlsterm.get("to"),
+            xconcepts=tuple(concepts),
+        )
+        umlsterms.append(umlsterm)
+
+    return tuple(umlsterms)
+
+
+def get_xrceterms_from_xsent(xsent: Element) -> Tuple:
+    xrceterms = xsent.find("./xrceterms")
+    assert(len(xrceterms.findall("./"))==0)
+
+
+def get_ewnterms_from_xsent(xsent: Element) -> Tuple[EwnTerm,...]:
+    xewnterms = xsent.find("./ewnterms")
+
+    ewnterms = []
+    for xewnterm in xewnterms.findall("./ewnterm"):
+
+        senses = []
+        for xsense in xewnterm.findall("./sense"):
+
+            sense = Sense(
+                xoffset=xsense.get("offset"),
+            )
+            senses.append(sense)
+
+        ewnterm = EwnTerm(
+            xid=xewnterm.get("id"),
+            xfrom=xewnterm.get("from"),
+            xto=xewnterm.get("to"),
+            xsenses=tuple(senses),
+        )
+        ewnterms.append(ewnterm)
+
+    return tuple(ewnterms)
+
+
+def get_semrels_from_xsent(xsent: Element) -> Tuple[SemRel,...]:
+    xsemrels = xsent.find("./semrels")
+    semrels = [
+        SemRel(
+            xid=xsemrel.get("id"),
+            xterm1=xsemrel.get("term1"),
+            xterm2=xsemrel.get("term2"),
+            xreltype=xsemrel.get("reltype"),
+        ) for xsemrel in xsemrels.findall("./semrel")
+    ]
+    return tuple(semrels)
+
+
+def get_chunks_from_xsent(xsent: Element) -> Tuple[Chunk,...]:
+    xchunks = xsent.find("./chunks")
+    chunks = [
+        Chunk(
+            xid=xchunk.get("id"),
+            xfrom=xchunk.get("from"),
+            xto=xchunk.get("to"),
+            xtype=xchunk.get("type"),
+        ) for xchunk in xchunks.findall("./chunk")
+    ]
+    return tuple(chunks)
+
+
+def get_text_from_xsent(xsent: Element) -> Tuple[Token,...]:
+    xtext = xsent.find("./text")
+    tokens = [
+        Token(
+            xid=xtoken.get("id"),
+            xpos=xtoken.get("pos"),
+            xlemma=xtoken.get("lemma"),
+            xtext=xtoken.text,
+        ) for xtoken in xtext.findall("./token")
+    ]
+    return tuple(tokens)
+
+
+# Benchmark
+#=========================================
+
+def helpers_xsent(xsent):
+    umlsterms = get_umlsterms_from_xsent(xsent)
+    get_xrceterms_from_xsent(xsent)
+    ewnterms = get_ewnterms_from_xsent(xsent)
+    semrels = get_semrels_from_xsent(xsent)
+    chunks = get_chunks_from_xsent(xsent)
+    text = get_text_from_xsent(xsent)
+    return umlsterms, ewnterms, semrels, chunks, text
+
+
+def dataclass_xsent(xsent):
+    return read_xsent(xsent, XSENT_BUILDERS)
+
+
+def dict_xsent(xsent):
+    return read_xsent(xsent, DICT_BUILDERS)
+
+
+def time_extract(xsents, extract, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        for xsent in xsents:
+            extract(xsent)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main(repeats=3):
+    df_anno = read_anno()
+    for language in ANNO_PATHS:
+        xml_strs = df_anno[df_anno["language"] == language]["anno_xml"]
+        xsents = [
+            xsent
+            for xml_str in xml_strs if xml_str != ""
+            for xsent in ET.fromstring(xml_str).findall("./")
+        ]
+
+        base = time_extract(xsents, helpers_xsent, repeats)
+        print(f"{language}: {len(xsents)} sentences (best of {repeats})")
+        print(f"  find helpers       {base:8.3f}s")
+        for name, extract in [
+            ("read_xsent (parse)", dataclass_xsent),
+            ("read_xsent (dicts)", dict_xsent),
+        ]:
+            elapsed = time_extract(xsents, extract, repeats)
+            print(f"  {name} {elapsed:8.3f}s  {base / elapsed:5.2f}x")
+        print()
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,249 @@
+"""
+Synthetic archives in the same formats as the real (licensed / remote) data
+
+MuchMore (under <out_dir>/much_more)
+
+* springer_{english,german}_train_plain.tar.gz
+* springer_{english,german}_train_V4.2.tar.gz
+    one chunkmorph xml member per abstract with sentences holding
+    text/tokens, chunks, umlsterms (concepts, mshs), an empty xrceterms,
+    ewnterms (senses) and semrels. ISO-8859-1 encoded.
+
+About 80% of the prefixes exist in both languages and one english
+annotation is empty, like Arthroskopie.00130237.eng in the real corpus.
+
+n2c2 2011 coref (under <out_dir>/n2c2_2011_coref)
+
+* Task_1C.zip with docs/*.txt, concepts/*.txt.con and chains/*.txt.chains
+
+`scale` = 1.0 gives 1000 abstracts per language and 100 n2c2 documents.
+
+    python synthetic.py <out_dir> [scale]
+
+"""
+
+import io
+import json
+import os
+import random
+import sys
+import tarfile
+import zipfile
+from typing import Dict, List
+
+
+MUCH_MORE_DOCS = 1000
+N2C2_DOCS = 100
+
+NATIVE_ENCODING = "ISO-8859-1"
+
+JOURNALS = ["Arthroskopie", "Der_Chirurg", "Der_Nervenarzt", "Der_Radiologe", "Der_Unfallchirurg"]
+
+LANGUAGES = {
+    "en": ("english", "eng", "ger"),
+    "de": ("german", "ger", "eng"),
+}
+
+WORDS = {
+    "en": [
+        "the", "patient", "knee", "arthroscopy", "meniscus", "lesion", "of", "was",
+        "treated", "with", "results", "in", "cartilage", "and", "surgery", "cases",
+    ],
+    "de": [
+        "der", "Patient", "Knie", "Arthroskopie", "Meniskus", "Läsion", "von", "wurde",
+        "behandelt", "mit", "Ergebnisse", "bei", "Knorpel", "und", "Operation", "Fälle",
+    ],
+}
+
+POS = ["DT", "NN", "NNS", "JJ", "IN", "VBD", "VBN", "CC"]
+CHUNK_TYPES = ["NP", "VP", "PP", "ADJP"]
+RELTYPES = ["location_of", "issue_in", "treats", "part_of", "diagnoses"]
+N2C2_TYPES = ["person", "problem", "treatment", "test", "pronoun"]
+
+
+def _xml_attr(value: str) -> str:
+    return value.replace("&", "&amp;").replace('"', "&quot;").replace("<", "&lt;")
+
+
+def _sentence_xml(rng: random.Random, language: str, sid: int, words: List[str]) -> str:
+    out = [f'<sentence id="s{sid}" corresp="s{sid}">\n<text>\n']
+    for ii, word in enumerate(words, 1):
+        pos = rng.choice(POS)
+        out.append(f'<token id="w{ii}" pos="{pos}" lemma="{_xml_attr(word.lower())}">{word}</token>\n')
+    out.append("</text>\n<chunks>\n")
+    start = 1
+    cid = 1
+    while start <= len(words):
+        end = min(len(words), start + rng.randint(0, 3))
+        out.append(f'<chunk id="c{cid}" from="w{start}" to="w{end}" type="{rng.choice(CHUNK_TYPES)}"/>\n')
+        start = end + 1
+        cid += 1
+    out.append("</chunks>\n<umlsterms>\n")
+    n_terms = rng.randint(0, max(1, len(words) // 3))
+    for tid in range(1, n_terms + 1):
+        start = rng.randint(1, len(words))
+        end = min(len(words), start + rng.randint(0, 1))
+        out.append(f'<umlsterm id="t{tid}" from="w{start}" to="w{end}">\n')
+        for kk in range(1, rng.randint(1, 2) + 1):
+            cui = f"C{rng.randint(1, 5000):07d}"
+            tui = f"T{rng.randint(1, 200):03d}"
+            preferred = " ".join(words[start - 1:end]).title()
+            out.append(
+                f'<concept id="t{tid}.{kk}" cui="{cui}" preferred="{_xml_attr(preferred)}" tui="{tui}">\n'
+            )
+            for _ in range(rng.randint(0, 2)):
+                out.append(f'<msh code="{rng.choice("ACDEG")}{rng.randint(1, 20):02d}.{rng.randint(1, 999):03d}"/>\n')
+            out.append("</concept>\n")
+        out.append("</umlsterm>\n")
+    out.append("</umlsterms>\n<xrceterms/>\n<ewnterms>\n")
+    for eid in range(1, rng.randint(0, 3) + 1):
+        start = rng.randint(1, len(words))
+        out.append(f'<ewnterm id="e{eid}" from="w{start}" to="w{start}">\n')
+        for _ in range(rng.randint(1, 2)):
+            out.append(f'<sense offset="{rng.randint(1000000, 9999999)}"/>\n')
+        out.append("</ewnterm>\n")
+    out.append("</ewnterms>\n<semrels>\n")
+    for rid in range(1, (n_terms // 2) + 1):
+        out.append(
+            f'<semrel id="r{rid}" term1="t{2 * rid - 1}" term2="t{2 * rid}" reltype="{rng.choice(RELTYPES)}"/>\n'
+        )
+    out.append("</semrels>\n</sentence>\n")
+    return "".join(out)
+
+
+def _add_member(tf: tarfile.TarFile, name: str, data: bytes):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tf.addfile(info, io.BytesIO(data))
+
+
+def write_much_more(out_dir: str, scale: float = 1.0, seed: int = 0) -> Dict:
+    """Write the four MuchMore archives. Returns counts per archive."""
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    n_docs = max(2, int(MUCH_MORE_DOCS * scale))
+    prefixes = [
+        f"{JOURNALS[ii % len(JOURNALS)]}.{130000 + ii:08d}"
+        for ii in range(int(n_docs * 1.1))
+    ]
+
+    counts = {}
+    for language, (name, code, other) in LANGUAGES.items():
+        plain_path = os.path.join(out_dir, f"springer_{name}_train_plain.tar.gz")
+        anno_path = os.path.join(out_dir, f"springer_{name}_train_V4.2.tar.gz")
+        n_tokens = 0
+        n_sentences = 0
+        n_members = 0
+        with tarfile.open(plain_path, "w:gz") as plain, tarfile.open(anno_path, "w:gz") as anno:
+            for ii, prefix in enumerate(prefixes):
+                # ~10% of the prefixes only exist in one of the two languages
+                if ii % 10 == (1 if language == "en" else 2):
+                    continue
+                sentences = [
+                    [rng.choice(WORDS[language]) for _ in range(rng.randint(4, 25))]
+                    for _ in range(rng.randint(3, 12))
+                ]
+                doc_id = f"{prefix}.{code}.abstr"
+                xml = [
+                    f'<?xml version="1.0" encoding="{NATIVE_ENCODING}"?>\n',
+                    f'<document id="{doc_id}" type="abstract" lang="{language}" corresp="{prefix}.{other}.abstr">\n',
+                ]
+                xml.extend(
+                    _sentence_xml(rng, language, sid, words)
+                    for sid, words in enumerate(sentences, 1)
+                )
+                xml.append("</document>\n")
+                anno_bytes = "".join(xml).encode(NATIVE_ENCODING)
+                if language == "en" and ii == 7:
+                    anno_bytes = b""
+                else:
+                    n_tokens += sum(len(words) for words in sentences)
+                    n_sentences += len(sentences)
+
+                plain_text = "\n".join(" ".join(words) for words in sentences) + "\n"
+                _add_member(plain, doc_id, plain_text.encode(NATIVE_ENCODING))
+                _add_member(anno, f"{doc_id}.chunkmorph.annotated.xml", anno_bytes)
+                n_members += 1
+
+        counts[language] = {
+            "members": n_members,
+            "sentences": n_sentences,
+            "tokens": n_tokens,
+        }
+    return counts
+
+
+def write_n2c2(out_dir: str, scale: float = 1.0, seed: int = 0) -> Dict:
+    """Write Task_1C.zip. Returns counts."""
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    n_docs = max(1, int(N2C2_DOCS * scale))
+    words = [word.lower() for word in WORDS["en"]] + ["pain", "he", "she", "mg", "daily", "ct", "scan"]
+    base = "Task_1C/i2b2_Beth_Train"
+
+    n_concepts = 0
+    n_tokens = 0
+    with zipfile.ZipFile(os.path.join(out_dir, "Task_1C.zip"), "w", zipfile.ZIP_DEFLATED) as zf:
+        for ii in range(n_docs):
+            sample_id = f"clinical-{ii + 1}"
+            lines = [
+                [rng.choice(words).capitalize() if rng.random() < 0.1 else rng.choice(words)
+                 for _ in range(rng.randint(1, 15))]
+                for _ in range(rng.randint(20, 120))
+            ]
+            n_tokens += sum(len(line) for line in lines)
+
+            concepts = []
+            for line_num, line in enumerate(lines, 1):
+                for _ in range(rng.randint(0, 2)):
+                    start = rng.randint(0, len(line) - 1)
+                    end = min(len(line) - 1, start + rng.randint(0, 2))
+                    text = " ".join(line[start: end + 1]).lower()
+                    ctype = rng.choice(N2C2_TYPES)
+                    concepts.append((text, line_num, start, end, ctype))
+            n_concepts += len(concepts)
+
+            con = "".join(
+                f'c="{text}" {line}:{start} {line}:{end}||t="{ctype}"\n'
+                for text, line, start, end, ctype in concepts
+            )
+            chains = []
+            by_type = {}
+            for concept in concepts:
+                by_type.setdefault(concept[4], []).append(concept)
+            for ctype, mentions in by_type.items():
+                if len(mentions) < 2 or ctype == "pronoun":
+                    continue
+                members = rng.sample(mentions, rng.randint(2, min(4, len(mentions))))
+                members.sort(key=lambda c: (c[1], c[2]))
+                chains.append(
+                    "||".join(
+                        f'c="{text}" {line}:{start} {line}:{end}'
+                        for text, line, start, end, _ in members
+                    ) + f'||t="coref {ctype}"\n'
+                )
+
+            zf.writestr(f"{base}/docs/{sample_id}.txt", "\n".join(" ".join(line) for line in lines) + "\n")
+            zf.writestr(f"{base}/concepts/{sample_id}.txt.con", con)
+            zf.writestr(f"{base}/chains/{sample_id}.txt.chains", "".join(chains))
+
+    return {"documents": n_docs, "concepts": n_concepts, "tokens": n_tokens}
+
+
+def write_all(out_dir: str, scale: float = 1.0, seed: int = 0) -> Dict:
+    """Write every synthetic archive plus a counts.json manifest."""
+    counts = {
+        "scale": scale,
+        "much_more": write_much_more(os.path.join(out_dir, "much_more"), scale, seed),
+        "n2c2_2011_coref": write_n2c2(os.path.join(out_dir, "n2c2_2011_coref"), scale, seed),
+    }
+    with open(os.path.join(out_dir, "counts.json"), "w") as fp:
+        json.dump(counts, fp, indent=2)
+    return counts
+
+
+if __name__ == "__main__":
+
+    out_dir = sys.argv[1]
+    scale = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    print(json.dumps(write_all(out_dir, scale), indent=2))
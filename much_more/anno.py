@@ -0,0 +1,323 @@
+"""
+MuchMore annotated xml helpers
+
+Shared by parse.py and the muchmore.py dataset script so this module
+should only depend on the standard library and must not import any of
+its siblings.
+
+
+Each member of springer_*_train_V4.2.tar.gz looks like,
+
+<document id=... lang=... corresp=... type=...>
+  <sentence id=... corresp=...>
+    <text> <token/> ... </text>
+    <chunks> <chunk/> ... </chunks>
+    <umlsterms> <umlsterm> <concept> <msh/> ... </concept> </umlsterm> </umlsterms>
+    <xrceterms/>
+    <ewnterms> <ewnterm> <sense/> ... </ewnterm> </ewnterms>
+    <semrels> <semrel/> ... </semrels>
+  </sentence>
+  ...
+</document>
+
+"""
+
+import re
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Tuple
+import xml.etree.ElementTree as ET
+from xml.etree.ElementTree import Element
+
+
+# bytes handed to the xml parser per feed
+CHUNK_SIZE = 64 * 1024
+
+
+class XsentBuilders(NamedTuple):
+    """Record factories used by `read_xsent`.
+
+    Leaf builders get the xml element. Builders for elements with nested
+    records also get the list of already built children.
+    """
+    msh: Callable[[Element], Any]
+    concept: Callable[[Element, List], Any]
+    umlsterm: Callable[[Element, List], Any]
+    sense: Callable[[Element], Any]
+    ewnterm: Callable[[Element, List], Any]
+    semrel: Callable[[Element], Any]
+    chunk: Callable[[Element], Any]
+    token: Callable[[Element], Any]
+
+
+def _read_umlsterms(xumlsterms: Element, builders: XsentBuilders) -> List:
+    umlsterms = []
+    for xumlsterm in xumlsterms:
+        if xumlsterm.tag != "umlsterm":
+            continue
+        concepts = []
+        for xconcept in xumlsterm:
+            if xconcept.tag != "concept":
+                continue
+            mshs = [builders.msh(xmsh) for xmsh in xconcept if xmsh.tag == "msh"]
+            concepts.append(builders.concept(xconcept, mshs))
+        umlsterms.append(builders.umlsterm(xumlsterm, concepts))
+    return umlsterms
+
+
+def _read_ewnterms(xewnterms: Element, builders: XsentBuilders) -> List:
+    ewnterms = []
+    for xewnterm in xewnterms:
+        if xewnterm.tag != "ewnterm":
+            continue
+        senses = [builders.sense(xsense) for xsense in xewnterm if xsense.tag == "sense"]
+        ewnterms.append(builders.ewnterm(xewnterm, senses))
+    return ewnterms
+
+
+def _read_semrels(xsemrels: Element, builders: XsentBuilders) -> List:
+    return [builders.semrel(x) for x in xsemrels if x.tag == "semrel"]
+
+
+def _read_chunks(xchunks: Element, builders: XsentBuilders) -> List:
+    return [builders.chunk(x) for x in xchunks if x.tag == "chunk"]
+
+
+def _read_tokens(xtext: Element, builders: XsentBuilders) -> List:
+    return [builders.token(x) for x in xtext if x.tag == "token"]
+
+
+def _read_xrceterms(xxrceterms: Element, builders: XsentBuilders) -> List:
+    # all xrceterms in the corpus are empty
+    assert len(xxrceterms) == 0
+    return []
+
+
+# sentence child tag -> (layer name, reader)
+# xrceterms are only checked, they never end up in a layer
+_LAYER_READERS = {
+    "umlsterms": ("umlsterms", _read_umlsterms),
+    "xrceterms": (None, _read_xrceterms),
+    "ewnterms": ("ewnterms", _read_ewnterms),
+    "semrels": ("semrels", _read_semrels),
+    "chunks": ("chunks", _read_chunks),
+    "text": ("tokens", _read_tokens),
+}
+
+LAYERS = ("umlsterms", "ewnterms", "semrels", "chunks", "tokens")
+
+
+def skip_tags(layers: Optional[Iterable[str]]) -> FrozenSet[str]:
+    """Sentence child tags that are not needed to build the given layers.
+
+    None means every layer (and the xrceterms check), so nothing is skipped.
+    """
+    if layers is None:
+        return frozenset()
+    layers = set(layers)
+    unknown = layers - set(LAYERS)
+    if unknown:
+        raise ValueError(f"unknown layers {sorted(unknown)}, expected some of {LAYERS}")
+    return frozenset(tag for tag, (layer, _) in _LAYER_READERS.items() if layer not in layers)
+
+
+def read_xsent(
+    xsent: Element,
+    builders: XsentBuilders,
+    layers: Optional[Iterable[str]] = None,
+) -> Dict[str, List]:
+    """Build the annotation layers of a sentence in one walk of its subtree.
+
+    Returns a dict mapping each requested name in LAYERS (all of them when
+    layers is None) to a list of records. A layer that is missing from the
+    sentence comes back empty. Subtrees of other layers are not visited.
+    """
+    skip = skip_tags(layers)
+    out = {layer: [] for layer in LAYERS if layers is None or layer in layers}
+    for xlayer in xsent:
+        reader = _LAYER_READERS.get(xlayer.tag)
+        if reader is None or xlayer.tag in skip:
+            continue
+        layer, read = reader
+        records = read(xlayer, builders)
+        if layer is not None:
+            out[layer] = records
+    return out
+
+
+# records shaped like the features of the muchmore.py dataset script
+DICT_BUILDERS = XsentBuilders(
+    msh=lambda xmsh: {
+        "code": xmsh.get("code"),
+    },
+    concept=lambda xconcept, mshs: {
+        "id": xconcept.get("id"),
+        "cui": xconcept.get("cui"),
+        "preferred": xconcept.get("preferred"),
+        "tui": xconcept.get("tui"),
+        "mshs": mshs,
+    },
+    umlsterm=lambda xumlsterm, concepts: {
+        "id": xumlsterm.get("id"),
+        "from": xumlsterm.get("from"),
+        "to": xumlsterm.get("to"),
+        "concepts": concepts,
+    },
+    sense=lambda xsense: {
+        "offset": xsense.get("offset"),
+    },
+    ewnterm=lambda xewnterm, senses: {
+        "id": xewnterm.get("id"),
+        "from": xewnterm.get("from"),
+        "to": xewnterm.get("to"),
+        "senses": senses,
+    },
+    semrel=lambda xsemrel: {
+        "id": xsemrel.get("id"),
+        "term1": xsemrel.get("term1"),
+        "term2": xsemrel.get("term2"),
+        "reltype": xsemrel.get("reltype"),
+    },
+    chunk=lambda xchunk: {
+        "id": xchunk.get("id"),
+        "to": xchunk.get("to"),
+        "from": xchunk.get("from"),
+        "type": xchunk.get("type"),
+    },
+    token=lambda xtoken: {
+        "id": xtoken.get("id"),
+        "pos": xtoken.get("pos"),
+        "lemma": xtoken.get("lemma"),
+        "text": xtoken.text,
+    },
+)
+
+
+class _SentenceTarget:
+    """XMLParser target that converts each child of the root element
+    (i.e. each sentence) as soon as it is closed and then drops it.
+
+    Children of a sentence whose tag is in skip (and everything below
+    them) never become elements at all.
+    """
+
+    def __init__(self, convert_xsent: Callable[[Element], Any], skip: FrozenSet[str] = frozenset()):
+        self._builder = ET.TreeBuilder()
+        self._convert_xsent = convert_xsent
+        self._skip = skip
+        self._depth = 0
+        # depth of the skipped subtree we are in, 0 when not skipping
+        self._skip_depth = 0
+        self.xroot = None
+        self.sentences = []
+
+    def start(self, tag, attrib):
+        self._depth += 1
+        if self._skip_depth:
+            return None
+        if self._depth == 3 and tag in self._skip:
+            self._skip_depth = self._depth
+            return None
+        xelem = self._builder.start(tag, attrib)
+        if self._depth == 1:
+            self.xroot = xelem
+        return xelem
+
+    def end(self, tag):
+        self._depth -= 1
+        if self._skip_depth:
+            if self._depth < self._skip_depth:
+                self._skip_depth = 0
+            return None
+        xelem = self._builder.end(tag)
+        if self._depth == 1:
+            self.sentences.append(self._convert_xsent(xelem))
+            self.xroot.remove(xelem)
+        return xelem
+
+    def data(self, data):
+        if not self._skip_depth:
+            self._builder.data(data)
+
+    def close(self):
+        return self._builder.close()
+
+
+def iterparse_document(
+    fp,
+    convert_xsent: Callable[[Element], Any],
+    encoding: str,
+    chunk_size: int = CHUNK_SIZE,
+    layers: Optional[Iterable[str]] = None,
+) -> Optional[Tuple[Element, List[Any]]]:
+    """Incrementally parse one annotated document from a binary file object.
+
+    Bytes are fed straight to the parser (no separate decode step) and
+    each sentence is passed to `convert_xsent` and released as soon as its
+    end tag is seen, so the full tree is never held in memory.
+
+    Returns (xroot, sentences) where xroot is the childless document element
+    and sentences are the converted sentences in document order.
+    Returns None if the member is empty.
+
+    If layers is given, sentence children that no requested layer needs
+    are skipped by the parser and sentences only hold the other children.
+    """
+    chunk = fp.read(chunk_size)
+    if chunk == b"":
+        return None
+
+    target = _SentenceTarget(convert_xsent, skip_tags(layers))
+    parser = ET.XMLParser(target=target, encoding=encoding)
+    while chunk:
+        parser.feed(chunk)
+        chunk = fp.read(chunk_size)
+    parser.close()
+
+    return target.xroot, target.sentences
+
+
+def strip_layers(data, layers: Optional[Iterable[str]]) -> bytes:
+    """Cut the sentence children no requested layer needs out of raw document bytes.
+
+    One regex pass in C, so the xml parser never sees the skipped subtrees.
+    Relies on the layer elements never nesting in each other, which holds
+    for every member of the corpus.
+    """
+    skip = skip_tags(layers)
+    if not skip:
+        return bytes(data)
+    pattern = _STRIP_PATTERNS.get(skip)
+    if pattern is None:
+        tags = b"|".join(re.escape(tag.encode("ascii")) for tag in sorted(skip))
+        pattern = re.compile(rb"<(" + tags + rb")\b(?:[^>]*/>|.*?</\1\s*>)", re.DOTALL)
+        _STRIP_PATTERNS[skip] = pattern
+    return pattern.sub(b"", data)
+
+
+_STRIP_PATTERNS: Dict[FrozenSet[str], "re.Pattern"] = {}
+
+
+def parse_document(
+    data,
+    convert_xsent: Callable[[Element], Any],
+    encoding: str,
+    layers: Optional[Iterable[str]] = None,
+) -> Optional[Tuple[Element, List[Any]]]:
+    """Parse a document that is already in memory, same output as iterparse_document.
+
+    data can be bytes or any buffer (e.g. a memoryview of a larger
+    buffer). Without layers it goes to the parser as is, without a copy.
+    With layers the unneeded subtrees are cut out first (strip_layers).
+    """
+    view = memoryview(data)
+    if len(view) == 0:
+        return None
+    if layers is not None:
+        view = strip_layers(view, layers)
+
+    parser = ET.XMLParser(encoding=encoding)
+    parser.feed(view)
+    xroot = parser.close()
+    sentences = [convert_xsent(xsent) for xsent in xroot]
+    del xroot[:]
+
+    return xroot, sentences
@@ -0,0 +1,85 @@
+"""
+Helpers for reading the MuchMore tar.gz archives
+
+Shared by parse.py and the muchmore.py dataset script so this module
+should only depend on the standard library and must not import any of
+its siblings.
+
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+import re
+import tarfile
+from typing import Any, Callable, Iterable, Iterator, Optional, Tuple
+
+
+# strips the language and everything after it from a sample id or member name
+# e.g. Arthroskopie.00130003.eng.abstr(.chunkmorph.annotated.xml) -> Arthroskopie.00130003
+PREFIX_RE = re.compile(r"\.(eng|ger)\.abstr.*$")
+
+
+def iter_members(path: str) -> Iterator[Tuple[str, bytes]]:
+    """Yield (member name, member bytes) for each file in a tar.gz in archive order.
+
+    The archive is read as a stream so it is only decompressed once.
+    """
+    with tarfile.open(name=path, mode="r|gz") as tf:
+        for member in tf:
+            if not member.isfile():
+                continue
+            with tf.extractfile(member) as fp:
+                yield member.name, fp.read()
+
+
+def _map_batch(func, batch):
+    return [func(item) for item in batch]
+
+
+def _iter_batches(items, batch_size):
+    items = iter(items)
+    batch = list(islice(items, batch_size))
+    while batch:
+        yield batch
+        batch = list(islice(items, batch_size))
+
+
+def imap_ordered(
+    func: Callable[[Any], Any],
+    items: Iterable[Any],
+    num_proc: int = 1,
+    max_pending: Optional[int] = None,
+    batch_size: int = 16,
+) -> Iterator[Any]:
+    """Map `func` over `items` with a pool of worker processes.
+
+    Items are sent to the workers in batches of `batch_size` and results
+    are yielded in the same order as `items`. At most `max_pending` batches
+    (default 2 per worker) are in flight at once and `items` is only
+    advanced when a slot frees up, so memory stays bounded no matter how
+    far the reader could get ahead of the workers or the consumer.
+
+    With num_proc <= 1 this is a plain map in the current process.
+    `func` and the items must be picklable when num_proc > 1.
+    """
+    if num_proc <= 1:
+        yield from map(func, items)
+        return
+
+    if max_pending is None:
+        max_pending = 2 * num_proc
+
+    map_batch = partial(_map_batch, func)
+    executor = ProcessPoolExecutor(max_workers=num_proc)
+    try:
+        pending = deque()
+        for batch in _iter_batches(items, batch_size):
+            pending.append(executor.submit(map_batch, batch))
+            if len(pending) >= max_pending:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,220 @@
+"""
+Random access to single members of the MuchMore tar.gz archives
+
+A plain gzip stream can only be read from the start, so pulling one
+abstract out of an archive means decompressing everything before it.
+For each archive we write two sidecar files next to it,
+
+* <archive>.blocks.gz
+    the same tar re-compressed as a series of independent gzip members
+    (restart checkpoints), each holding a run of whole tar members of
+    roughly `block_size` uncompressed bytes. Concatenated gzip members
+    are still a valid gzip file, so this is also a drop in copy of the
+    original archive.
+
+* <archive>.idx.json
+    the compressed offset/length of every block and, for every tar
+    member, the block it lives in plus its data offset and size within
+    the decompressed block. Also the prefix -> member name mapping and
+    the size/mtime of the archive it was built from.
+
+A lookup seeks to one block and decompresses only that block.
+
+CPython's zlib can not restart inflate at an arbitrary bit position of
+the original deflate stream, which is why the checkpoints live in a
+re-blocked copy instead of pointing into the original archive.
+
+    get_plain("Arthroskopie.00130003.eng.abstr")
+    get_anno("Arthroskopie.00130003.eng.abstr")
+    get_anno("Arthroskopie.00130003", language="de")
+
+"""
+
+import gzip
+import json
+import os
+import re
+import tarfile
+from typing import Dict, List, Optional
+
+from parse import ANNO_PATHS, NATIVE_ENCODING, PLAIN_PATHS, sample_prefix
+
+
+INDEX_SUFFIX = ".idx.json"
+BLOCKS_SUFFIX = ".blocks.gz"
+
+# uncompressed bytes per checkpoint block
+BLOCK_SIZE = 256 * 1024
+
+INDEX_VERSION = 1
+
+LANGUAGE_CODES = {"en": "eng", "de": "ger"}
+
+_LANGUAGE_RE = re.compile(r"\.(eng|ger)\.abstr")
+
+
+def _archive_stat(path: str) -> Dict[str, int]:
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def build_index(path: str, block_size: int = BLOCK_SIZE) -> Dict:
+    """Write the sidecar block file and index for one archive and return the index."""
+
+    # pass 1: tar header offsets of every member
+    with tarfile.open(name=path, mode="r:gz") as tf:
+        members = tf.getmembers()
+
+    # group consecutive members into blocks of about block_size bytes.
+    # block boundaries are always tar header offsets.
+    starts = [0]
+    for member in members[1:]:
+        if member.offset - starts[-1] >= block_size:
+            starts.append(member.offset)
+
+    index_members = {}
+    block_num = 0
+    for member in members:
+        while block_num + 1 < len(starts) and member.offset >= starts[block_num + 1]:
+            block_num += 1
+        if member.isfile():
+            index_members[member.name] = (
+                block_num,
+                member.offset_data - starts[block_num],
+                member.size,
+            )
+
+    # pass 2: re-compress the raw tar stream one block at a time.
+    # the last block runs to the end of the stream (end of archive padding).
+    blocks = []
+    comp_offset = 0
+    with gzip.open(path, "rb") as fin, open(path + BLOCKS_SUFFIX + ".tmp", "wb") as fout:
+        for ii, start in enumerate(starts):
+            if ii + 1 < len(starts):
+                raw = fin.read(starts[ii + 1] - start)
+            else:
+                raw = fin.read()
+            comp = gzip.compress(raw, mtime=0)
+            fout.write(comp)
+            blocks.append((comp_offset, len(comp)))
+            comp_offset += len(comp)
+    os.replace(path + BLOCKS_SUFFIX + ".tmp", path + BLOCKS_SUFFIX)
+
+    index = {
+        "version": INDEX_VERSION,
+        "archive": _archive_stat(path),
+        "block_size": block_size,
+        "blocks": blocks,
+        "members": index_members,
+        "prefixes": {sample_prefix(name): name for name in index_members},
+    }
+    with open(path + INDEX_SUFFIX + ".tmp", "w") as fp:
+        json.dump(index, fp)
+    os.replace(path + INDEX_SUFFIX + ".tmp", path + INDEX_SUFFIX)
+
+    return index
+
+
+class ArchiveIndex:
+    """Random access reader for one archive, (re)building the sidecars when needed."""
+
+    def __init__(self, path: str, block_size: int = BLOCK_SIZE):
+        self.path = path
+        self.index = self._load_index()
+        if self.index is None:
+            self.index = build_index(path, block_size=block_size)
+        self._fp = None
+
+    def _load_index(self) -> Optional[Dict]:
+        index_path = self.path + INDEX_SUFFIX
+        if not (os.path.exists(index_path) and os.path.exists(self.path + BLOCKS_SUFFIX)):
+            return None
+        with open(index_path) as fp:
+            index = json.load(fp)
+        if index.get("version") != INDEX_VERSION:
+            return None
+        if index["archive"] != _archive_stat(self.path):
+            return None
+        return index
+
+    @property
+    def names(self) -> List[str]:
+        return list(self.index["members"])
+
+    def resolve(self, key: str) -> str:
+        """Return the member name for a member name, or a prefix"""
+        if key in self.index["members"]:
+            return key
+        if key in self.index["prefixes"]:
+            return self.index["prefixes"][key]
+        raise KeyError(key)
+
+    def read(self, key: str) -> bytes:
+        block_num, offset, size = self.index["members"][self.resolve(key)]
+        comp_offset, comp_len = self.index["blocks"][block_num]
+        if self._fp is None:
+            self._fp = open(self.path + BLOCKS_SUFFIX, "rb")
+        self._fp.seek(comp_offset)
+        raw = gzip.decompress(self._fp.read(comp_len))
+        return raw[offset: offset + size]
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_INDEXES: Dict[str, ArchiveIndex] = {}
+
+
+def get_index(path: str) -> ArchiveIndex:
+    """Cached ArchiveIndex for a path"""
+    if path not in _INDEXES:
+        _INDEXES[path] = ArchiveIndex(path)
+    return _INDEXES[path]
+
+
+def _language_of(sample_id: str, language: Optional[str]) -> str:
+    if language is not None:
+        return language
+    match = _LANGUAGE_RE.search(sample_id)
+    if match is None:
+        raise KeyError(f"can not tell language of {sample_id}, pass language=")
+    return {code: lang for lang, code in LANGUAGE_CODES.items()}[match.group(1)]
+
+
+def _anno_key(sample_id: str) -> str:
+    # document ids (e.g. Arthroskopie.00130003.eng.abstr) are the
+    # annotated member names without this suffix
+    if sample_id.endswith(".abstr"):
+        return sample_id + ".chunkmorph.annotated.xml"
+    return sample_id
+
+
+def get_plain(sample_id: str, language: Optional[str] = None) -> str:
+    """Plain text abstract for a sample id (X.eng.abstr) or a prefix plus language"""
+    index = get_index(PLAIN_PATHS[_language_of(sample_id, language)])
+    return index.read(sample_id).decode(NATIVE_ENCODING)
+
+
+def get_anno(sample_id: str, language: Optional[str] = None) -> str:
+    """Annotated xml for a sample id (X.eng.abstr or the member name) or a prefix plus language"""
+    index = get_index(ANNO_PATHS[_language_of(sample_id, language)])
+    return index.read(_anno_key(sample_id)).decode(NATIVE_ENCODING)
+
+
+def build_all():
+    for paths in (PLAIN_PATHS, ANNO_PATHS):
+        for path in paths.values():
+            index = build_index(path)
+            print(path, len(index["members"]), "members", len(index["blocks"]), "blocks")
+
+
+if __name__ == "__main__":
+    build_all()
@@ -0,0 +1,184 @@
+"""
+English / German pairing for the MuchMore parallel corpus
+
+Documents are joined on prefix (Arthroskopie.00130003.eng.abstr and
+Arthroskopie.00130003.ger.abstr share the prefix Arthroskopie.00130003)
+while both language archives are streamed side by side. Unmatched items
+wait in a hash index keyed by prefix and are dropped from it as soon as
+their partner shows up, so when the archives are in similar order only a
+handful of items are held at any time.
+
+Sentences of a matched pair of annotated documents are aligned with the
+corresp attributes on <sentence> (which hold the id(s) of the sentence(s)
+in the other language).
+
+    for prefix, en, de in iter_plain_pairs():
+        if en is None or de is None:
+            continue  # unmatched remainder
+        ...
+
+"""
+
+from itertools import zip_longest
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, TypeVar
+
+from parse import Document, Sentence, iter_docs, iter_plain, sample_prefix
+
+
+L = TypeVar("L")
+R = TypeVar("R")
+
+_DONE = object()
+
+
+def join_on_prefix(
+    left: Iterable[Tuple[str, L]],
+    right: Iterable[Tuple[str, R]],
+    max_waiting: Optional[int] = None,
+    evicted: Optional[Set[str]] = None,
+) -> Iterator[Tuple[str, Optional[L], Optional[R]]]:
+    """Symmetric hash join of two (prefix, item) streams.
+
+    Yields (prefix, left item, right item) for every match as soon as the
+    second item of the pair is read, then (prefix, item, None) for the left
+    items that never matched and (prefix, None, item) for the right ones.
+    Prefixes are expected to be unique within each stream.
+
+    With max_waiting each side holds at most that many unmatched items,
+    the oldest one is given up (yielded as unmatched) to make room. This
+    bounds memory for streams that are in nearly the same order. The
+    prefixes of given up items are added to evicted (a set of prefixes
+    only) before they are yielded and a partner that shows up later is
+    yielded as unmatched right away, so with evicted the caller can tell
+    both halves of a split pair from items that really have no partner.
+    """
+    waiting_left: Dict[str, L] = {}
+    waiting_right: Dict[str, R] = {}
+    if evicted is None:
+        evicted = set()
+
+    for left_item, right_item in zip_longest(left, right, fillvalue=_DONE):
+        if left_item is not _DONE:
+            prefix, item = left_item
+            if prefix in waiting_right:
+                yield prefix, item, waiting_right.pop(prefix)
+            elif prefix in evicted:
+                yield prefix, item, None
+            else:
+                waiting_left[prefix] = item
+                if max_waiting is not None and len(waiting_left) > max_waiting:
+                    oldest = next(iter(waiting_left))
+                    evicted.add(oldest)
+                    yield oldest, waiting_left.pop(oldest), None
+        if right_item is not _DONE:
+            prefix, item = right_item
+            if prefix in waiting_left:
+                yield prefix, waiting_left.pop(prefix), item
+            elif prefix in evicted:
+                yield prefix, None, item
+            else:
+                waiting_right[prefix] = item
+                if max_waiting is not None and len(waiting_right) > max_waiting:
+                    oldest = next(iter(waiting_right))
+                    evicted.add(oldest)
+                    yield oldest, None, waiting_right.pop(oldest)
+
+    for prefix, item in waiting_left.items():
+        yield prefix, item, None
+    for prefix, item in waiting_right.items():
+        yield prefix, None, item
+
+
+def iter_plain_pairs(num_proc=1) -> Iterator[Tuple[str, Optional[str], Optional[str]]]:
+    """(prefix, en abstract, de abstract) with None for a missing language"""
+    en = ((prefix, abstract) for prefix, _, abstract, _ in iter_plain(num_proc, ["en"]))
+    de = ((prefix, abstract) for prefix, _, abstract, _ in iter_plain(num_proc, ["de"]))
+    return join_on_prefix(en, de)
+
+
+def iter_doc_pairs(num_proc=1, vocabs=None) -> Iterator[Tuple[str, Optional[Document], Optional[Document]]]:
+    """(prefix, en Document, de Document) with None for a missing language"""
+    en = ((sample_prefix(doc.xid), doc) for doc in iter_docs(num_proc, vocabs=vocabs, languages=["en"]))
+    de = ((sample_prefix(doc.xid), doc) for doc in iter_docs(num_proc, vocabs=vocabs, languages=["de"]))
+    return join_on_prefix(en, de)
+
+
+def align_sentences(
+    doc_en: Document,
+    doc_de: Document,
+) -> List[Tuple[Tuple[Sentence, ...], Tuple[Sentence, ...]]]:
+    """Group the sentences of two documents using their corresp attributes.
+
+    corresp may list several space separated ids, so each group is a tuple
+    of en sentences and a tuple of de sentences (usually one each).
+    Links in either direction are used and groups are the connected
+    components of the links, in en document order. Sentences without a
+    link are left out.
+    """
+    en_sents = list(doc_en.xsentences)
+    de_sents = list(doc_de.xsentences)
+    n_en = len(en_sents)
+    en_index = {sent.xid: ii for ii, sent in enumerate(en_sents)}
+    de_index = {sent.xid: n_en + ii for ii, sent in enumerate(de_sents)}
+
+    # union find over en sentences (0 .. n_en-1) and de sentences (n_en ..)
+    parent = list(range(n_en + len(de_sents)))
+
+    def find(ii):
+        while parent[ii] != ii:
+            parent[ii] = parent[parent[ii]]
+            ii = parent[ii]
+        return ii
+
+    linked = set()
+    for ii, sent in enumerate(en_sents):
+        for xid in (sent.xcorresp or "").split():
+            if xid in de_index:
+                parent[find(de_index[xid])] = find(ii)
+                linked.update((ii, de_index[xid]))
+    for ii, sent in enumerate(de_sents, n_en):
+        for xid in (sent.xcorresp or "").split():
+            if xid in en_index:
+                parent[find(ii)] = find(en_index[xid])
+                linked.update((ii, en_index[xid]))
+
+    groups: Dict[int, Tuple[List[Sentence], List[Sentence]]] = {}
+    for ii in sorted(linked):
+        en_group, de_group = groups.setdefault(find(ii), ([], []))
+        if ii < n_en:
+            en_group.append(en_sents[ii])
+        else:
+            de_group.append(de_sents[ii - n_en])
+
+    return [(tuple(en_group), tuple(de_group)) for en_group, de_group in groups.values()]
+
+
+def iter_sentence_pairs(num_proc=1, vocabs=None) -> Iterator[Tuple[str, Tuple[Sentence, ...], Tuple[Sentence, ...]]]:
+    """(prefix, en sentences, de sentences) for every aligned group of every matched pair"""
+    for prefix, doc_en, doc_de in iter_doc_pairs(num_proc, vocabs=vocabs):
+        if doc_en is None or doc_de is None:
+            continue
+        for en_group, de_group in align_sentences(doc_en, doc_de):
+            yield prefix, en_group, de_group
+
+
+def report_pairs(pairs: Iterable[Tuple[str, Optional[L], Optional[R]]]):
+    counts = {"matched": 0, "en": 0, "de": 0}
+    for _, en, de in pairs:
+        if en is not None and de is not None:
+            counts["matched"] += 1
+        elif en is not None:
+            counts["en"] += 1
+        else:
+            counts["de"] += 1
+
+    print('total matched pairs: ', counts["matched"])
+    print('en with no de: ', counts["en"])
+    print('de with no en: ', counts["de"])
+    print()
+
+
+if __name__ == "__main__":
+
+    report_pairs(iter_plain_pairs())
+    report_pairs(iter_doc_pairs())
@@ -0,0 +1,208 @@
+"""
+On disk cache of the parsed corpus
+
+Parsing every archive from scratch takes minutes. The first call to
+`load_docs` / `load_plain` parses the archives and saves the result under
+CACHE_DIR, later calls load it in seconds,
+
+* load_docs: CompactDocuments (compact.py) saved with write_corpus,
+    one memory mapped .npy file per column
+* load_plain: the read_plain DataFrame as an uncompressed arrow (feather) file,
+    loaded as a memory mapped pyarrow Table (table.to_pandas() copies it)
+
+Entries are keyed by the path, size, mtime and sha256 of every archive
+that went into them (plus CACHE_VERSION), so a changed archive simply
+produces a new key. The sha256 of an archive is kept in fingerprints.json
+and only computed again when its size or mtime changes. Entries that have not been used recently are evicted
+once the cache grows past `max_bytes`.
+
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from compact import CompactBuilder, CompactDocument, read_corpus, write_corpus
+from parse import ANNO_PATHS, BASE_DATA_PATH, DATASET, PLAIN_PATHS, iter_docs, read_plain
+from vocab import Vocabs
+
+
+CACHE_DIR = os.path.join(BASE_DATA_PATH, DATASET, "cache")
+
+# 2 GiB
+MAX_BYTES = 2 * 1024 ** 3
+
+# bump when the layout of a cache entry changes
+CACHE_VERSION = 1
+
+_HASH_BLOCK = 1024 * 1024
+_LAST_USED = "last_used"
+_FINGERPRINT = "fingerprint.json"
+_FINGERPRINTS = "fingerprints.json"
+
+
+def archive_fingerprint(path: str, known: Optional[Dict] = None) -> Dict:
+    """path, size, mtime and sha256 of an archive. The sha256 of known (an
+    earlier fingerprint of the same path) is reused if size and mtime match."""
+    stat = os.stat(path)
+    fingerprint = {
+        "path": os.path.abspath(path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+    if known is not None and all(known.get(name) == value for name, value in fingerprint.items()):
+        fingerprint["sha256"] = known["sha256"]
+        return fingerprint
+
+    sha = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(_HASH_BLOCK), b""):
+            sha.update(block)
+    fingerprint["sha256"] = sha.hexdigest()
+    return fingerprint
+
+
+def _dir_bytes(path: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+class CorpusCache:
+
+    def __init__(self, cache_dir: str = CACHE_DIR, max_bytes: int = MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def _archive_fingerprints(self, paths: Iterable[str]) -> List[Dict]:
+        """Fingerprints of paths, hashing only archives that changed since the last call"""
+        known_path = os.path.join(self.cache_dir, _FINGERPRINTS)
+        known = {}
+        if os.path.exists(known_path):
+            with open(known_path, encoding="utf-8") as fp:
+                known = json.load(fp)
+        fingerprints = [
+            archive_fingerprint(path, known.get(os.path.abspath(path))) for path in paths
+        ]
+        updated = {**known, **{fingerprint["path"]: fingerprint for fingerprint in fingerprints}}
+        if updated != known:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f"{known_path}.tmp.{os.getpid()}"
+            with open(tmp_path, "w", encoding="utf-8") as fp:
+                json.dump(updated, fp, indent=2)
+            os.replace(tmp_path, known_path)
+        return fingerprints
+
+    def key(self, kind: str, paths: Iterable[str]) -> Tuple[str, Dict]:
+        fingerprint = {
+            "version": CACHE_VERSION,
+            "kind": kind,
+            "archives": self._archive_fingerprints(paths),
+        }
+        blob = json.dumps(fingerprint, sort_keys=True).encode("utf-8")
+        return f"{kind}-{hashlib.sha256(blob).hexdigest()[:24]}", fingerprint
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def _touch(self, key: str):
+        with open(os.path.join(self._entry_dir(key), _LAST_USED), "w") as fp:
+            fp.write(str(time.time()))
+
+    def _get_or_build(self, kind, paths, build) -> str:
+        """Return the entry dir for kind/paths, calling build(tmp_dir) if it is missing."""
+        key, fingerprint = self.key(kind, paths)
+        entry_dir = self._entry_dir(key)
+        if not os.path.exists(os.path.join(entry_dir, _LAST_USED)):
+            tmp_dir = f"{entry_dir}.tmp.{os.getpid()}"
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            build(tmp_dir)
+            with open(os.path.join(tmp_dir, _FINGERPRINT), "w") as fp:
+                json.dump(fingerprint, fp, indent=2)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(tmp_dir, entry_dir)
+            self._touch(key)
+            self.evict(keep=key)
+        else:
+            self._touch(key)
+        return entry_dir
+
+    def entries(self) -> List[Tuple[float, int, str]]:
+        """(last used, bytes, key) for every complete entry"""
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            if key == _FINGERPRINTS:
+                continue
+            last_used = os.path.join(self._entry_dir(key), _LAST_USED)
+            if os.path.exists(last_used):
+                entries.append((
+                    os.path.getmtime(last_used), _dir_bytes(self._entry_dir(key)), key
+                ))
+        return entries
+
+    def evict(self, keep: str = None):
+        """Remove least recently used entries until the cache fits in max_bytes."""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def load_docs(self, num_proc: int = 1) -> Tuple[List[CompactDocument], Vocabs]:
+        def build(out_dir):
+            builder = CompactBuilder()
+            cdocs = [builder.add(doc) for doc in iter_docs(num_proc=num_proc)]
+            write_corpus(cdocs, builder.vocabs, out_dir)
+
+        entry_dir = self._get_or_build("docs", ANNO_PATHS.values(), build)
+        return read_corpus(entry_dir)
+
+    def load_plain(self, num_proc: int = 1) -> pa.Table:
+        def build(out_dir):
+            df_plain = read_plain(num_proc=num_proc)
+            feather.write_feather(
+                df_plain, os.path.join(out_dir, "plain.arrow"), compression="uncompressed"
+            )
+
+        entry_dir = self._get_or_build("plain", PLAIN_PATHS.values(), build)
+        # the buffers of the table point into the memory map (and keep it
+        # alive after the file is closed), nothing is copied
+        with pa.memory_map(os.path.join(entry_dir, "plain.arrow")) as source:
+            return pa.ipc.open_file(source).read_all()
+
+
+def load_docs(num_proc: int = 1) -> Tuple[List[CompactDocument], Vocabs]:
+    return CorpusCache().load_docs(num_proc=num_proc)
+
+
+def load_plain(num_proc: int = 1) -> pa.Table:
+    return CorpusCache().load_plain(num_proc=num_proc)
+
+
+if __name__ == "__main__":
+
+    t0 = time.time()
+    table_plain = load_plain()
+    print(f"plain: {table_plain.num_rows} abstracts in {time.time() - t0:.1f}s")
+
+    t0 = time.time()
+    cdocs, vocabs = load_docs()
+    print(f"docs: {len(cdocs)} documents in {time.time() - t0:.1f}s")
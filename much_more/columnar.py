@@ -0,0 +1,310 @@
+"""
+Flat columnar (parquet) export of the annotated MuchMore documents
+
+The nested structure (documents -> sentences -> umlsterms -> concepts -> mshs)
+is split into one table per level. Child rows point at their parent with
+an integer row number and parents hold [start, end) row ranges into their
+children. Token references like "w3" are replaced with integer positions
+within the sentence and spans are half open, i.e. the xml from="w2" to="w4"
+becomes start=1 end=4. Repetitive string columns are dictionary encoded.
+
+Tables (one parquet file each in the output directory),
+
+* documents: doc, sample_id, language, corresp, sentence_start, sentence_end
+* sentences: sentence, doc, id, corresp, token_start, token_end
+* tokens: sentence, position, text, pos, lemma
+* chunks: sentence, id, start, end, type
+* umlsterms: umlsterm, sentence, id, start, end, concept_start, concept_end
+* concepts: umlsterm, id, cui, tui, preferred, mshs
+* ewnterms: sentence, id, start, end, senses
+* semrels: sentence, id, term1, term2, reltype
+    term1/term2 are rows of the umlsterms table
+
+Row groups are written every `batch_size` documents so memory stays bounded.
+To read only what you need,
+
+    pq.read_table("tokens.parquet", columns=["pos"], memory_map=True)
+
+"""
+
+import os
+from typing import Dict, Iterable, List, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from instrument import INSTRUMENT
+from parse import Document, iter_docs
+
+
+_STR = pa.string()
+_DICT = pa.dictionary(pa.int32(), pa.string())
+_INT = pa.int64()
+
+SCHEMAS = {
+    "documents": pa.schema([
+        ("doc", _INT),
+        ("sample_id", _STR),
+        ("language", _DICT),
+        ("corresp", _STR),
+        ("sentence_start", _INT),
+        ("sentence_end", _INT),
+    ]),
+    "sentences": pa.schema([
+        ("sentence", _INT),
+        ("doc", _INT),
+        ("id", _STR),
+        ("corresp", _STR),
+        ("token_start", _INT),
+        ("token_end", _INT),
+    ]),
+    "tokens": pa.schema([
+        ("sentence", _INT),
+        ("position", pa.int32()),
+        ("text", _STR),
+        ("pos", _DICT),
+        ("lemma", _DICT),
+    ]),
+    "chunks": pa.schema([
+        ("sentence", _INT),
+        ("id", _STR),
+        ("start", pa.int32()),
+        ("end", pa.int32()),
+        ("type", _DICT),
+    ]),
+    "umlsterms": pa.schema([
+        ("umlsterm", _INT),
+        ("sentence", _INT),
+        ("id", _STR),
+        ("start", pa.int32()),
+        ("end", pa.int32()),
+        ("concept_start", _INT),
+        ("concept_end", _INT),
+    ]),
+    "concepts": pa.schema([
+        ("umlsterm", _INT),
+        ("id", _STR),
+        ("cui", _DICT),
+        ("tui", _DICT),
+        ("preferred", _DICT),
+        ("mshs", pa.list_(_STR)),
+    ]),
+    "ewnterms": pa.schema([
+        ("sentence", _INT),
+        ("id", _STR),
+        ("start", pa.int32()),
+        ("end", pa.int32()),
+        ("senses", pa.list_(_STR)),
+    ]),
+    "semrels": pa.schema([
+        ("sentence", _INT),
+        ("id", _STR),
+        ("term1", _INT),
+        ("term2", _INT),
+        ("reltype", _DICT),
+    ]),
+}
+
+BATCH_SIZE = 1000
+
+
+def span_to_positions(xfrom: str, xto: str, token_index: Dict[str, int]):
+    """Turn an inclusive token id span (from="w2" to="w4") into half open positions (1, 4).
+
+    Unknown token ids come back as None.
+    """
+    start = token_index.get(xfrom)
+    end = token_index.get(xto)
+    if end is not None:
+        end += 1
+    return start, end
+
+
+class ColumnarBuilder:
+    """Accumulates the flat tables for a stream of Documents.
+
+    Row numbers keep counting across calls to `pop_tables`, so batches can
+    be written one after the other as row groups of the same files.
+    """
+
+    def __init__(self):
+        self.counts = {name: 0 for name in SCHEMAS}
+        self._reset()
+
+    def _reset(self):
+        self.columns = {
+            name: {field.name: [] for field in schema}
+            for name, schema in SCHEMAS.items()
+        }
+
+    def _append(self, table: str, **values):
+        columns = self.columns[table]
+        for key, value in values.items():
+            columns[key].append(value)
+        self.counts[table] += 1
+
+    def add(self, doc: Document):
+        doc_row = self.counts["documents"]
+        sentence_start = self.counts["sentences"]
+
+        for sent in doc.xsentences:
+            sent_row = self.counts["sentences"]
+            token_start = self.counts["tokens"]
+            token_index = sent.token_index
+
+            for ii, token in enumerate(sent.xtext):
+                self._append(
+                    "tokens",
+                    sentence=sent_row,
+                    position=ii,
+                    text=token.xtext,
+                    pos=token.xpos,
+                    lemma=token.xlemma,
+                )
+
+            for chunk in sent.xchunks:
+                start, end = span_to_positions(chunk.xfrom, chunk.xto, token_index)
+                self._append(
+                    "chunks",
+                    sentence=sent_row,
+                    id=chunk.xid,
+                    start=start,
+                    end=end,
+                    type=chunk.xtype,
+                )
+
+            term_rows = {}
+            for umlsterm in sent.xumlsterms:
+                term_row = self.counts["umlsterms"]
+                term_rows[umlsterm.xid] = term_row
+                concept_start = self.counts["concepts"]
+                for concept in umlsterm.xconcepts:
+                    self._append(
+                        "concepts",
+                        umlsterm=term_row,
+                        id=concept.xid,
+                        cui=concept.xcui,
+                        tui=concept.xtui,
+                        preferred=concept.xpreferred,
+                        mshs=[msh.xcode for msh in concept.xmshs],
+                    )
+                start, end = span_to_positions(umlsterm.xfrom, umlsterm.xto, token_index)
+                self._append(
+                    "umlsterms",
+                    umlsterm=term_row,
+                    sentence=sent_row,
+                    id=umlsterm.xid,
+                    start=start,
+                    end=end,
+                    concept_start=concept_start,
+                    concept_end=self.counts["concepts"],
+                )
+
+            for ewnterm in sent.xewnterms:
+                start, end = span_to_positions(ewnterm.xfrom, ewnterm.xto, token_index)
+                self._append(
+                    "ewnterms",
+                    sentence=sent_row,
+                    id=ewnterm.xid,
+                    start=start,
+                    end=end,
+                    senses=[sense.xoffset for sense in ewnterm.xsenses],
+                )
+
+            for semrel in sent.xsemrels:
+                self._append(
+                    "semrels",
+                    sentence=sent_row,
+                    id=semrel.xid,
+                    term1=term_rows.get(semrel.xterm1),
+                    term2=term_rows.get(semrel.xterm2),
+                    reltype=semrel.xreltype,
+                )
+
+            self._append(
+                "sentences",
+                sentence=sent_row,
+                doc=doc_row,
+                id=sent.xid,
+                corresp=sent.xcorresp,
+                token_start=token_start,
+                token_end=self.counts["tokens"],
+            )
+
+        self._append(
+            "documents",
+            doc=doc_row,
+            sample_id=doc.xid,
+            language=doc.xlang,
+            corresp=doc.xcorresp,
+            sentence_start=sentence_start,
+            sentence_end=self.counts["sentences"],
+        )
+
+    def pop_tables(self) -> Dict[str, pa.Table]:
+        """Return the rows added since the last call as arrow tables."""
+        tables = {
+            name: pa.Table.from_pydict(self.columns[name], schema=schema)
+            for name, schema in SCHEMAS.items()
+        }
+        self._reset()
+        return tables
+
+
+def documents_to_tables(docs: Iterable[Document]) -> Dict[str, pa.Table]:
+    builder = ColumnarBuilder()
+    for doc in docs:
+        builder.add(doc)
+    return builder.pop_tables()
+
+
+def write_parquet(
+    docs: Iterable[Document],
+    out_dir: str,
+    batch_size: int = BATCH_SIZE,
+) -> Dict[str, int]:
+    """Stream Documents into one parquet file per table. Returns row counts."""
+    os.makedirs(out_dir, exist_ok=True)
+    writers = {
+        name: pq.ParquetWriter(os.path.join(out_dir, f"{name}.parquet"), schema)
+        for name, schema in SCHEMAS.items()
+    }
+
+    def flush():
+        with INSTRUMENT.stage("arrow_write"):
+            for name, table in builder.pop_tables().items():
+                writers[name].write_table(table)
+
+    builder = ColumnarBuilder()
+    try:
+        pending = 0
+        for doc in docs:
+            with INSTRUMENT.stage("columns"):
+                builder.add(doc)
+            pending += 1
+            if pending == batch_size:
+                flush()
+                pending = 0
+        if pending:
+            flush()
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    return dict(builder.counts)
+
+
+def read_table(out_dir: str, name: str, columns: Optional[List[str]] = None) -> pa.Table:
+    return pq.read_table(
+        os.path.join(out_dir, f"{name}.parquet"), columns=columns, memory_map=True
+    )
+
+
+if __name__ == "__main__":
+
+    import sys
+
+    out_dir = sys.argv[1] if len(sys.argv) > 1 else "much_more_columnar"
+    counts = write_parquet(iter_docs(), out_dir)
+    for name, count in counts.items():
+        print(f"{name}: {count}")
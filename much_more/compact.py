@@ -0,0 +1,456 @@
+"""
+Compact struct-of-arrays documents
+
+parse.py builds one dataclass instance per token, chunk, term, concept,
+etc. which adds up to millions of small python objects for the corpus.
+A CompactDocument instead keeps one typed array per attribute and layer.
+Strings are stored as integer codes into string tables (vocab.Vocab)
+shared by every document built with the same CompactBuilder.
+
+Item access returns small __slots__ views that have the same attribute
+names as the parse.py dataclasses (xid, xpos, xfrom, ...), so code written
+against Document keeps working,
+
+    builder = CompactBuilder()
+    cdocs = [builder.add(doc) for doc in iter_docs()]
+    cdocs[0].xsentences[0].xtext[0].xlemma
+
+write_corpus / read_corpus store a list of CompactDocuments as one .npy
+file per column (plus per document offsets) that is memory mapped on
+load, so reading a saved corpus does not touch the column data until it
+is used.
+
+Spans (chunks, umlsterms, ewnterms) are stored as half open token
+positions within the document (start, end) instead of the "wN" strings.
+xfrom / xto on the views are looked up from the token ids. A span end
+point that does not match a token id in its sentence is stored as -1 and
+comes back as None.
+
+"""
+
+from array import array
+import json
+import os
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
+
+import numpy as np
+
+from parse import (
+    Chunk,
+    Concept,
+    Document,
+    EwnTerm,
+    Msh,
+    SemRel,
+    Sense,
+    Sentence,
+    Token,
+    UmlsTerm,
+)
+from vocab import Vocab, Vocabs
+
+
+# string valued attributes, each coded by a shared Vocab
+FIELDS = (
+    "sentence_id", "sentence_corresp",
+    "token_id", "token_pos", "token_lemma", "token_text",
+    "chunk_id", "chunk_type",
+    "umlsterm_id",
+    "concept_id", "concept_cui", "concept_preferred", "concept_tui",
+    "msh_code",
+    "ewnterm_id",
+    "sense_offset",
+    "semrel_id", "semrel_term1", "semrel_term2", "semrel_reltype",
+)
+
+# fields coded with the corpus wide vocabularies from vocab.py.
+# the rest (ids, token text, ...) get a vocab of their own name.
+FIELD_VOCABS = {
+    "token_pos": "pos",
+    "token_lemma": "lemma",
+    "chunk_type": "chunk_type",
+    "concept_cui": "cui",
+    "concept_preferred": "preferred",
+    "concept_tui": "tui",
+    "msh_code": "msh",
+    "semrel_reltype": "reltype",
+}
+
+# integer columns. *_offsets are [start, end) row ranges into a child layer
+# with one more entry than rows in the parent layer.
+COLUMNS = FIELDS + (
+    "token_offsets", "chunk_offsets", "umlsterm_offsets", "ewnterm_offsets", "semrel_offsets",
+    "chunk_start", "chunk_end",
+    "umlsterm_start", "umlsterm_end", "concept_offsets",
+    "msh_offsets",
+    "ewnterm_start", "ewnterm_end", "sense_offsets",
+)
+
+
+class _Layer(Sequence):
+    """Rows [start, stop) of one layer of a CompactDocument as views"""
+
+    __slots__ = ("_doc", "_view", "_start", "_stop")
+
+    def __init__(self, doc, view, start, stop):
+        self._doc = doc
+        self._view = view
+        self._start = start
+        self._stop = stop
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __getitem__(self, ii):
+        if isinstance(ii, slice):
+            return [self[jj] for jj in range(*ii.indices(len(self)))]
+        if ii < 0:
+            ii += len(self)
+        if not 0 <= ii < len(self):
+            raise IndexError(ii)
+        return self._view(self._doc, self._start + ii)
+
+
+class _View:
+
+    __slots__ = ("_doc", "_ii")
+
+    def __init__(self, doc, ii):
+        self._doc = doc
+        self._ii = ii
+
+    def _str(self, field):
+        return self._doc.tables[field].string(self._doc.columns[field][self._ii])
+
+    def _layer(self, view, offsets):
+        column = self._doc.columns[offsets]
+        return _Layer(self._doc, view, column[self._ii], column[self._ii + 1])
+
+    def _token_id(self, position):
+        if position < 0:
+            return None
+        return self._doc.tables["token_id"].string(self._doc.columns["token_id"][position])
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_record()!r})"
+
+    def __eq__(self, other):
+        if isinstance(other, _View):
+            other = other.to_record()
+        return self.to_record() == other
+
+
+class TokenView(_View):
+    __slots__ = ()
+    xid = property(lambda self: self._str("token_id"))
+    xpos = property(lambda self: self._str("token_pos"))
+    xlemma = property(lambda self: self._str("token_lemma"))
+    xtext = property(lambda self: self._str("token_text"))
+
+    def to_record(self) -> Token:
+        return Token(xid=self.xid, xpos=self.xpos, xlemma=self.xlemma, xtext=self.xtext)
+
+
+class ChunkView(_View):
+    __slots__ = ()
+    xid = property(lambda self: self._str("chunk_id"))
+    xtype = property(lambda self: self._str("chunk_type"))
+    start = property(lambda self: self._doc.columns["chunk_start"][self._ii])
+    end = property(lambda self: self._doc.columns["chunk_end"][self._ii])
+    xfrom = property(lambda self: self._token_id(self.start))
+    xto = property(lambda self: self._token_id(self.end - 1 if self.end >= 0 else -1))
+
+    def to_record(self) -> Chunk:
+        return Chunk(xid=self.xid, xfrom=self.xfrom, xto=self.xto, xtype=self.xtype)
+
+
+class MshView(_View):
+    __slots__ = ()
+    xcode = property(lambda self: self._str("msh_code"))
+
+    def to_record(self) -> Msh:
+        return Msh(xcode=self.xcode)
+
+
+class ConceptView(_View):
+    __slots__ = ()
+    xid = property(lambda self: self._str("concept_id"))
+    xcui = property(lambda self: self._str("concept_cui"))
+    xpreferred = property(lambda self: self._str("concept_preferred"))
+    xtui = property(lambda self: self._str("concept_tui"))
+    xmshs = property(lambda self: self._layer(MshView, "msh_offsets"))
+
+    def to_record(self) -> Concept:
+        return Concept(
+            xid=self.xid,
+            xcui=self.xcui,
+            xpreferred=self.xpreferred,
+            xtui=self.xtui,
+            xmshs=tuple(msh.to_record() for msh in self.xmshs),
+        )
+
+
+class UmlsTermView(_View):
+    __slots__ = ()
+    xid = property(lambda self: self._str("umlsterm_id"))
+    start = property(lambda self: self._doc.columns["umlsterm_start"][self._ii])
+    end = property(lambda self: self._doc.columns["umlsterm_end"][self._ii])
+    xfrom = property(lambda self: self._token_id(self.start))
+    xto = property(lambda self: self._token_id(self.end - 1 if self.end >= 0 else -1))
+    xconcepts = property(lambda self: self._layer(ConceptView, "concept_offsets"))
+
+    def to_record(self) -> UmlsTerm:
+        return UmlsTerm(
+            xid=self.xid,
+            xfrom=self.xfrom,
+            xto=self.xto,
+            xconcepts=tuple(concept.to_record() for concept in self.xconcepts),
+        )
+
+
+class SenseView(_View):
+    __slots__ = ()
+    xoffset = property(lambda self: self._str("sense_offset"))
+
+    def to_record(self) -> Sense:
+        return Sense(xoffset=self.xoffset)
+
+
+class EwnTermView(_View):
+    __slots__ = ()
+    xid = property(lambda self: self._str("ewnterm_id"))
+    start = property(lambda self: self._doc.columns["ewnterm_start"][self._ii])
+    end = property(lambda self: self._doc.columns["ewnterm_end"][self._ii])
+    xfrom = property(lambda self: self._token_id(self.start))
+    xto = property(lambda self: self._token_id(self.end - 1 if self.end >= 0 else -1))
+    xsenses = property(lambda self: self._layer(SenseView, "sense_offsets"))
+
+    def to_record(self) -> EwnTerm:
+        return EwnTerm(
+            xid=self.xid,
+            xfrom=self.xfrom,
+            xto=self.xto,
+            xsenses=tuple(sense.to_record() for sense in self.xsenses),
+        )
+
+
+class SemRelView(_View):
+    __slots__ = ()
+    xid = property(lambda self: self._str("semrel_id"))
+    xterm1 = property(lambda self: self._str("semrel_term1"))
+    xterm2 = property(lambda self: self._str("semrel_term2"))
+    xreltype = property(lambda self: self._str("semrel_reltype"))
+
+    def to_record(self) -> SemRel:
+        return SemRel(
+            xid=self.xid, xterm1=self.xterm1, xterm2=self.xterm2, xreltype=self.xreltype
+        )
+
+
+class SentenceView(_View):
+    __slots__ = ()
+    xid = property(lambda self: self._str("sentence_id"))
+    xcorresp = property(lambda self: self._str("sentence_corresp"))
+    xumlsterms = property(lambda self: self._layer(UmlsTermView, "umlsterm_offsets"))
+    xewnterms = property(lambda self: self._layer(EwnTermView, "ewnterm_offsets"))
+    xsemrels = property(lambda self: self._layer(SemRelView, "semrel_offsets"))
+    xchunks = property(lambda self: self._layer(ChunkView, "chunk_offsets"))
+    xtext = property(lambda self: self._layer(TokenView, "token_offsets"))
+
+    def to_record(self) -> Sentence:
+        return Sentence(
+            xid=self.xid,
+            xcorresp=self.xcorresp,
+            xumlsterms=tuple(x.to_record() for x in self.xumlsterms),
+            xewnterms=tuple(x.to_record() for x in self.xewnterms),
+            xsemrels=tuple(x.to_record() for x in self.xsemrels),
+            xchunks=tuple(x.to_record() for x in self.xchunks),
+            xtext=tuple(x.to_record() for x in self.xtext),
+        )
+
+
+class CompactDocument:
+    """One annotated document as typed arrays (see module docstring)"""
+
+    __slots__ = ("xid", "xtype", "xlang", "xcorresp", "columns", "tables")
+
+    def __init__(self, xid, xtype, xlang, xcorresp, columns, tables):
+        self.xid = xid
+        self.xtype = xtype
+        self.xlang = xlang
+        self.xcorresp = xcorresp
+        self.columns: Mapping[str, Sequence[int]] = columns
+        self.tables: Dict[str, Vocab] = tables
+
+    @property
+    def xsentences(self) -> _Layer:
+        return _Layer(self, SentenceView, 0, len(self.columns["sentence_id"]))
+
+    @property
+    def num_tokens(self) -> int:
+        return len(self.columns["token_id"])
+
+    def to_document(self) -> Document:
+        return Document(
+            xid=self.xid,
+            xtype=self.xtype,
+            xlang=self.xlang,
+            xcorresp=self.xcorresp,
+            xsentences=[sent.to_record() for sent in self.xsentences],
+        )
+
+
+class CompactBuilder:
+    """Converts Documents to CompactDocuments that share string tables.
+
+    Pass in `vocabs` (e.g. Vocabs.load(...)) to code pos, lemma, cui, etc.
+    with the same codes as other outputs built from those vocabs.
+    """
+
+    def __init__(self, vocabs: Optional[Vocabs] = None):
+        if vocabs is None:
+            vocabs = Vocabs.new()
+        self.vocabs = vocabs
+        self.tables = {
+            field: vocabs[FIELD_VOCABS.get(field, field)] for field in FIELDS
+        }
+
+    def add(self, doc: Document) -> CompactDocument:
+        cols = {column: array("i") for column in COLUMNS}
+        for column in COLUMNS:
+            if column.endswith("_offsets"):
+                cols[column].append(0)
+        tables = self.tables
+
+        def put(field, value):
+            cols[field].append(tables[field].code(value))
+
+        def put_span(prefix, xfrom, xto, token_index, base):
+            start = token_index.get(xfrom, -1)
+            cols[prefix + "_start"].append(base + start if start >= 0 else -1)
+            end = token_index.get(xto, -1)
+            cols[prefix + "_end"].append(base + end + 1 if end >= 0 else -1)
+
+        for sent in doc.xsentences:
+            put("sentence_id", sent.xid)
+            put("sentence_corresp", sent.xcorresp)
+
+            base = len(cols["token_id"])
+            token_index = sent.token_index
+            for token in sent.xtext:
+                put("token_id", token.xid)
+                put("token_pos", token.xpos)
+                put("token_lemma", token.xlemma)
+                put("token_text", token.xtext)
+
+            for chunk in sent.xchunks:
+                put("chunk_id", chunk.xid)
+                put("chunk_type", chunk.xtype)
+                put_span("chunk", chunk.xfrom, chunk.xto, token_index, base)
+
+            for umlsterm in sent.xumlsterms:
+                put("umlsterm_id", umlsterm.xid)
+                put_span("umlsterm", umlsterm.xfrom, umlsterm.xto, token_index, base)
+                for concept in umlsterm.xconcepts:
+                    put("concept_id", concept.xid)
+                    put("concept_cui", concept.xcui)
+                    put("concept_preferred", concept.xpreferred)
+                    put("concept_tui", concept.xtui)
+                    for msh in concept.xmshs:
+                        put("msh_code", msh.xcode)
+                    cols["msh_offsets"].append(len(cols["msh_code"]))
+                cols["concept_offsets"].append(len(cols["concept_id"]))
+
+            for ewnterm in sent.xewnterms:
+                put("ewnterm_id", ewnterm.xid)
+                put_span("ewnterm", ewnterm.xfrom, ewnterm.xto, token_index, base)
+                for sense in ewnterm.xsenses:
+                    put("sense_offset", sense.xoffset)
+                cols["sense_offsets"].append(len(cols["sense_offset"]))
+
+            for semrel in sent.xsemrels:
+                put("semrel_id", semrel.xid)
+                put("semrel_term1", semrel.xterm1)
+                put("semrel_term2", semrel.xterm2)
+                put("semrel_reltype", semrel.xreltype)
+
+            cols["token_offsets"].append(len(cols["token_id"]))
+            cols["chunk_offsets"].append(len(cols["chunk_id"]))
+            cols["umlsterm_offsets"].append(len(cols["umlsterm_id"]))
+            cols["ewnterm_offsets"].append(len(cols["ewnterm_id"]))
+            cols["semrel_offsets"].append(len(cols["semrel_id"]))
+
+        return CompactDocument(
+            xid=doc.xid,
+            xtype=doc.xtype,
+            xlang=doc.xlang,
+            xcorresp=doc.xcorresp,
+            columns=cols,
+            tables=tables,
+        )
+
+
+class _CorpusColumns(Mapping):
+    """Columns of document ii sliced out of corpus wide (memory mapped) arrays"""
+
+    __slots__ = ("_data", "_offsets", "_ii")
+
+    def __init__(self, data, offsets, ii):
+        self._data = data
+        self._offsets = offsets
+        self._ii = ii
+
+    def __getitem__(self, column):
+        offsets = self._offsets[column]
+        return self._data[column][offsets[self._ii]: offsets[self._ii + 1]]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+
+def write_corpus(cdocs: List[CompactDocument], vocabs: Vocabs, out_dir: str):
+    """Save CompactDocuments built with one CompactBuilder (and its vocabs)."""
+    os.makedirs(out_dir, exist_ok=True)
+    for column in COLUMNS:
+        lengths = [len(cdoc.columns[column]) for cdoc in cdocs]
+        offsets = np.zeros(len(cdocs) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        data = np.empty(offsets[-1], dtype=np.int32)
+        for ii, cdoc in enumerate(cdocs):
+            data[offsets[ii]: offsets[ii + 1]] = cdoc.columns[column]
+        np.save(os.path.join(out_dir, f"{column}.npy"), data)
+        np.save(os.path.join(out_dir, f"{column}.offsets.npy"), offsets)
+
+    meta = [[cdoc.xid, cdoc.xtype, cdoc.xlang, cdoc.xcorresp] for cdoc in cdocs]
+    with open(os.path.join(out_dir, "documents.json"), "w", encoding="utf-8") as fp:
+        json.dump(meta, fp, ensure_ascii=False)
+    vocabs.save(os.path.join(out_dir, "vocabs.json"), fields=list(vocabs))
+
+
+def read_corpus(out_dir: str, mmap_mode: Optional[str] = "r") -> Tuple[List[CompactDocument], Vocabs]:
+    """Load what write_corpus saved. Column data is memory mapped by default."""
+    data = {}
+    offsets = {}
+    for column in COLUMNS:
+        data[column] = np.load(os.path.join(out_dir, f"{column}.npy"), mmap_mode=mmap_mode)
+        offsets[column] = np.load(os.path.join(out_dir, f"{column}.offsets.npy"))
+    with open(os.path.join(out_dir, "documents.json"), encoding="utf-8") as fp:
+        meta = json.load(fp)
+    vocabs = Vocabs.load(os.path.join(out_dir, "vocabs.json"))
+
+    tables = {field: vocabs[FIELD_VOCABS.get(field, field)] for field in FIELDS}
+    cdocs = [
+        CompactDocument(
+            xid=xid,
+            xtype=xtype,
+            xlang=xlang,
+            xcorresp=xcorresp,
+            columns=_CorpusColumns(data, offsets, ii),
+            tables=tables,
+        )
+        for ii, (xid, xtype, xlang, xcorresp) in enumerate(meta)
+    ]
+    return cdocs, vocabs
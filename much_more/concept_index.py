@@ -0,0 +1,208 @@
+"""
+Inverted index from UMLS concepts to where they are mentioned
+
+Keys are (field, value) pairs with field one of "cui", "tui" or "msh".
+Each posting is (doc, sentence, start, end) where doc is a row of the
+index's document table, sentence is the position of the sentence in the
+document and [start, end) are token positions within the sentence.
+
+Postings of a key are sorted by doc and stored as LEB128 varints with
+the doc column delta encoded. Everything is saved as .npy / json files
+and the postings are memory mapped on load, so a query only touches the
+bytes of the keys it asks for.
+
+    build_index(iter_docs(), "concept_index")
+    index = ConceptIndex("concept_index")
+    index.docs("cui", "C0022742")
+    index.query_and([("cui", "C0022742"), ("tui", "T047")])
+    index.count("msh", "C05.550")
+
+"""
+
+from collections import defaultdict
+import json
+import os
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from parse import Document, iter_docs
+
+
+FIELDS = ("cui", "tui", "msh")
+
+POSTING_DTYPE = np.dtype([
+    ("doc", np.int64),
+    ("sentence", np.int64),
+    ("start", np.int64),
+    ("end", np.int64),
+])
+
+
+def encode_varints(values: Iterable[int]) -> bytearray:
+    """LEB128 encode non negative ints"""
+    out = bytearray()
+    for value in values:
+        while value >= 0x80:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+    return out
+
+
+def decode_varints(buf: np.ndarray) -> np.ndarray:
+    """Vectorized LEB128 decode of a uint8 array into int64"""
+    buf = np.asarray(buf, dtype=np.uint8)
+    if len(buf) == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(buf < 0x80)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    group = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shift = 7 * (np.arange(len(buf)) - starts[group])
+    payload = (buf & 0x7F).astype(np.int64) << shift
+    return np.bincount(group, weights=payload, minlength=len(ends)).astype(np.int64)
+
+
+def _term_postings(doc: Document, doc_row: int) -> Iterable[Tuple[str, str, Tuple[int, int, int, int]]]:
+    for ss, sent in enumerate(doc.xsentences):
+        token_index = sent.token_index
+        for umlsterm in sent.xumlsterms:
+            start = token_index.get(umlsterm.xfrom, -1)
+            end = token_index.get(umlsterm.xto, -2) + 1
+            if start < 0 or end < 1:
+                continue
+            posting = (doc_row, ss, start, end)
+            seen = set()
+            for concept in umlsterm.xconcepts:
+                keys = [("cui", concept.xcui), ("tui", concept.xtui)]
+                keys.extend(("msh", msh.xcode) for msh in concept.xmshs)
+                for key in keys:
+                    # one posting per key and term even if several
+                    # concepts of the term share e.g. a tui
+                    if key[1] is not None and key not in seen:
+                        seen.add(key)
+                        yield key[0], key[1], posting
+
+
+def build_index(docs: Iterable[Document], out_dir: str) -> Dict[str, int]:
+    """Build and save the index in one pass over docs. Returns key counts per field."""
+    sample_ids = []
+    postings = defaultdict(list)
+    for doc_row, doc in enumerate(docs):
+        sample_ids.append(doc.xid)
+        for field, value, posting in _term_postings(doc, doc_row):
+            postings[(field, value)].append(posting)
+
+    keys = sorted(postings)
+    terms = {field: {} for field in FIELDS}
+    offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    counts = np.zeros((len(keys), 2), dtype=np.int64)
+    blob = bytearray()
+    for ii, key in enumerate(keys):
+        field, value = key
+        terms[field][value] = ii
+        rows = postings[key]
+        flat = []
+        last_doc = 0
+        for doc_row, ss, start, end in rows:
+            flat.extend((doc_row - last_doc, ss, start, end))
+            last_doc = doc_row
+        blob.extend(encode_varints(flat))
+        offsets[ii + 1] = len(blob)
+        counts[ii] = (len(rows), len({row[0] for row in rows}))
+
+    os.makedirs(out_dir, exist_ok=True)
+    np.save(os.path.join(out_dir, "postings.npy"), np.frombuffer(bytes(blob), dtype=np.uint8))
+    np.save(os.path.join(out_dir, "offsets.npy"), offsets)
+    np.save(os.path.join(out_dir, "counts.npy"), counts)
+    with open(os.path.join(out_dir, "terms.json"), "w", encoding="utf-8") as fp:
+        json.dump(terms, fp, ensure_ascii=False)
+    with open(os.path.join(out_dir, "documents.json"), "w", encoding="utf-8") as fp:
+        json.dump(sample_ids, fp)
+
+    return {field: len(values) for field, values in terms.items()}
+
+
+class ConceptIndex:
+    """Read side of a saved index (see module docstring)"""
+
+    def __init__(self, index_dir: str):
+        self.postings_blob = np.load(os.path.join(index_dir, "postings.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(index_dir, "offsets.npy"), mmap_mode="r")
+        self.counts = np.load(os.path.join(index_dir, "counts.npy"), mmap_mode="r")
+        with open(os.path.join(index_dir, "terms.json"), encoding="utf-8") as fp:
+            self.terms: Dict[str, Dict[str, int]] = json.load(fp)
+        with open(os.path.join(index_dir, "documents.json"), encoding="utf-8") as fp:
+            self.sample_ids: List[str] = json.load(fp)
+
+    def _term(self, field: str, value: str):
+        return self.terms[field].get(value)
+
+    def postings(self, field: str, value: str) -> np.ndarray:
+        """Structured array of (doc, sentence, start, end), sorted by doc"""
+        ii = self._term(field, value)
+        if ii is None:
+            return np.zeros(0, dtype=POSTING_DTYPE)
+        flat = decode_varints(self.postings_blob[self.offsets[ii]: self.offsets[ii + 1]])
+        rows = flat.reshape(-1, 4)
+        out = np.empty(len(rows), dtype=POSTING_DTYPE)
+        out["doc"] = np.cumsum(rows[:, 0])
+        out["sentence"] = rows[:, 1]
+        out["start"] = rows[:, 2]
+        out["end"] = rows[:, 3]
+        return out
+
+    def docs(self, field: str, value: str) -> np.ndarray:
+        """Sorted unique doc rows that mention the key"""
+        return np.unique(self.postings(field, value)["doc"])
+
+    def query_and(self, keys: Iterable[Tuple[str, str]]) -> np.ndarray:
+        """Docs that mention every key. Rarest keys are intersected first."""
+        keys = sorted(keys, key=lambda key: self.count(*key)[1])
+        result = None
+        for field, value in keys:
+            docs = self.docs(field, value)
+            result = docs if result is None else np.intersect1d(result, docs, assume_unique=True)
+            if len(result) == 0:
+                break
+        return np.zeros(0, dtype=np.int64) if result is None else result
+
+    def query_or(self, keys: Iterable[Tuple[str, str]]) -> np.ndarray:
+        """Docs that mention any of the keys"""
+        docs = [self.docs(field, value) for field, value in keys]
+        if not docs:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(docs))
+
+    def count(self, field: str, value: str) -> Tuple[int, int]:
+        """(number of mentions, number of docs) without decoding any postings"""
+        ii = self._term(field, value)
+        if ii is None:
+            return 0, 0
+        n_postings, n_docs = self.counts[ii]
+        return int(n_postings), int(n_docs)
+
+    def most_common(self, field: str, n: int = 10) -> List[Tuple[str, int, int]]:
+        """(value, mentions, docs) for the n most mentioned values of a field"""
+        values = list(self.terms[field])
+        rows = np.array([self.terms[field][value] for value in values], dtype=np.int64)
+        if len(rows) == 0:
+            return []
+        order = np.argsort(-self.counts[rows, 0], kind="stable")[:n]
+        return [
+            (values[jj], int(self.counts[rows[jj], 0]), int(self.counts[rows[jj], 1]))
+            for jj in order
+        ]
+
+
+if __name__ == "__main__":
+
+    import sys
+
+    out_dir = sys.argv[1] if len(sys.argv) > 1 else "much_more_concept_index"
+    print(build_index(iter_docs(), out_dir))
+    index = ConceptIndex(out_dir)
+    for field in FIELDS:
+        print(field, index.most_common(field, 5))
@@ -0,0 +1,339 @@
+"""
+Download the MuchMore archives
+
+Fetches every archive named in `_URLs` of the muchmore.py dataset script
+(read from the script, so there is one list of urls) into
+BASE_DATA_PATH/much_more, concurrently, one thread per archive,
+
+    python fetch.py
+    python fetch.py --manifest checksums.json --check-remote
+
+* downloads go to .<name>.part and are resumed with a Range request
+  (guarded by If-Range so a changed file starts over)
+* sizes are checked against Content-Length / Content-Range and, if a
+  manifest of {name: {"size": ..., "sha256": ...}} is given, against it
+* complete files are moved into place with os.replace and recorded in
+  fetch_state.json (size, mtime, sha256, etag)
+
+Files whose size and mtime match fetch_state.json are not downloaded or
+hashed again, so a re-run on a complete machine only stats the files
+(plus one HEAD request per file with check_remote).
+
+fetch() takes any {key: url} mapping and destination, e.g. a local
+http.server stand-in in tests.
+
+"""
+
+import ast
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import http.client
+import json
+import os
+import re
+import threading
+import time
+from typing import Dict, Optional, Tuple
+import urllib.error
+import urllib.request
+
+
+# same as parse.py, which is not imported so that fetching needs nothing
+# but the standard library
+BASE_DATA_PATH = os.path.join(
+    os.environ.get("HOME"),
+    "data",
+    "big_science_biomedical",
+)
+
+DATASET = "much_more"
+
+DEST_DIR = os.path.join(BASE_DATA_PATH, DATASET)
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "muchmore.py")
+
+STATE_FILENAME = "fetch_state.json"
+
+CHUNK_SIZE = 1 << 20
+
+MAX_RETRIES = 3
+
+TIMEOUT = 60
+
+# bytes <first>-<last>/<total or *>, or bytes */<total>
+_CONTENT_RANGE_RE = re.compile(r"bytes\s+(?:(\d+)-\d+|\*)/(\d+|\*)")
+
+_STATE_LOCK = threading.Lock()
+
+
+class FetchError(Exception):
+    pass
+
+
+def read_urls(script_path: str = SCRIPT_PATH) -> Dict[str, str]:
+    """The _URLs dict of the dataset script, read without importing it"""
+    with open(script_path, encoding="utf-8") as fp:
+        tree = ast.parse(fp.read(), script_path)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(
+            isinstance(target, ast.Name) and target.id == "_URLs" for target in node.targets
+        ):
+            return ast.literal_eval(node.value)
+    raise FetchError(f"no _URLs in {script_path}")
+
+
+def archive_urls(urls: Dict[str, str]) -> Dict[str, str]:
+    """{file name: url} with each url once (several configs share an archive)"""
+    return {os.path.basename(url): url for url in urls.values()}
+
+
+# State
+#=========================================
+
+def read_state(dest_dir: str) -> Dict[str, Dict]:
+    path = os.path.join(dest_dir, STATE_FILENAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as fp:
+        return json.load(fp)
+
+
+def _write_json(path: str, data):
+    tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, "w", encoding="utf-8") as fp:
+        json.dump(data, fp, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _record(dest_dir: str, name: str, entry: Dict):
+    with _STATE_LOCK:
+        state = read_state(dest_dir)
+        state[name] = entry
+        _write_json(os.path.join(dest_dir, STATE_FILENAME), state)
+
+
+def _record_file(dest_dir: str, name: str, url: str, sha256: str, validator: Optional[str]):
+    stat = os.stat(os.path.join(dest_dir, name))
+    _record(dest_dir, name, {
+        "url": url,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": sha256,
+        "validator": validator,
+    })
+
+
+def _is_current(path: str, entry: Optional[Dict], expected: Optional[Dict]) -> bool:
+    """Metadata only check of a finished file against its state entry"""
+    if entry is None or not os.path.exists(path):
+        return False
+    stat = os.stat(path)
+    if (stat.st_size, stat.st_mtime_ns) != (entry["size"], entry["mtime_ns"]):
+        return False
+    if expected is not None:
+        if expected.get("size") is not None and expected["size"] != entry["size"]:
+            return False
+        if expected.get("sha256") is not None and expected["sha256"] != entry["sha256"]:
+            return False
+    return True
+
+
+# Downloads
+#=========================================
+
+def _request(url: str, method: str = "GET", headers: Optional[Dict[str, str]] = None):
+    req = urllib.request.Request(url, method=method, headers=headers or {})
+    return urllib.request.urlopen(req, timeout=TIMEOUT)
+
+
+def remote_info(url: str) -> Tuple[Optional[int], Optional[str]]:
+    """(size, etag or last-modified) from a HEAD request"""
+    with _request(url, "HEAD") as resp:
+        size = resp.headers.get("Content-Length")
+        validator = resp.headers.get("ETag") or resp.headers.get("Last-Modified")
+    return (None if size is None else int(size)), validator
+
+
+def content_range(value: Optional[str]) -> Tuple[Optional[int], Optional[int]]:
+    """(first byte, total size) of a Content-Range header, None where it is not given"""
+    match = _CONTENT_RANGE_RE.fullmatch((value or "").strip())
+    if match is None:
+        raise FetchError(f"bad Content-Range {value!r}")
+    first, total = match.groups()
+    return (None if first is None else int(first)), (None if total == "*" else int(total))
+
+
+def _hash_file(path: str):
+    sha = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(CHUNK_SIZE), b""):
+            sha.update(block)
+    return sha
+
+
+def _download(url: str, part_path: str) -> Tuple[int, str, Optional[str]]:
+    """Download url into part_path, resuming what is there. Returns (size, sha256, validator)."""
+    meta_path = part_path + ".json"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    validator = None
+    if offset and os.path.exists(meta_path):
+        with open(meta_path, encoding="utf-8") as fp:
+            validator = json.load(fp).get("validator")
+    if offset and validator is None:
+        # nothing to tell whether the remote file is still the same
+        offset = 0
+
+    headers = {}
+    if offset:
+        headers = {"Range": f"bytes={offset}-", "If-Range": validator}
+    try:
+        resp = _request(url, headers=headers)
+    except urllib.error.HTTPError as err:
+        if err.code == 416 and offset:
+            # the part file already holds the whole file
+            return offset, _hash_file(part_path).hexdigest(), validator
+        raise
+
+    with resp:
+        validator = resp.headers.get("ETag") or resp.headers.get("Last-Modified")
+        if resp.status == 206:
+            first, total = content_range(resp.headers.get("Content-Range"))
+            if first != offset:
+                # not the part we asked for, start over on the retry
+                os.remove(part_path)
+                raise FetchError(f"{url}: asked for bytes from {offset}, got {resp.headers.get('Content-Range')}")
+            sha = _hash_file(part_path)
+            mode = "ab"
+        else:
+            length = resp.headers.get("Content-Length")
+            total = None if length is None else int(length)
+            sha = hashlib.sha256()
+            offset = 0
+            mode = "wb"
+
+        _write_json(meta_path, {"url": url, "validator": validator})
+        with open(part_path, mode) as fp:
+            for block in iter(lambda: resp.read(CHUNK_SIZE), b""):
+                fp.write(block)
+                sha.update(block)
+                offset += len(block)
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    if total is not None and offset != total:
+        raise FetchError(f"{url}: got {offset} of {total} bytes")
+    return offset, sha.hexdigest(), validator
+
+
+def fetch_file(
+    name: str,
+    url: str,
+    dest_dir: str,
+    expected: Optional[Dict] = None,
+    check_remote: bool = False,
+    max_retries: int = MAX_RETRIES,
+) -> str:
+    """Make sure dest_dir/name is a complete copy of url. Returns what was done."""
+    path = os.path.join(dest_dir, name)
+    part_path = os.path.join(dest_dir, f".{name}.part")
+    entry = read_state(dest_dir).get(name)
+
+    if _is_current(path, entry, expected):
+        if not check_remote:
+            return "current"
+        size, validator = remote_info(url)
+        if (size is None or size == entry["size"]) and (validator is None or validator == entry.get("validator")):
+            return "current"
+
+    if entry is None and os.path.exists(path):
+        # e.g. fetched by the old fetch_data.sh, keep it if the size matches
+        size, validator = remote_info(url)
+        if size == os.path.getsize(path):
+            sha256 = _hash_file(path).hexdigest()
+            if expected is None or expected.get("sha256") in (None, sha256):
+                _record_file(dest_dir, name, url, sha256, validator)
+                return "adopted"
+
+    for attempt in range(max_retries + 1):
+        try:
+            size, sha256, validator = _download(url, part_path)
+            break
+        except (OSError, ValueError, http.client.HTTPException, FetchError):
+            # urllib errors are OSErrors, ValueError is a malformed header,
+            # the part file is kept for the retry
+            if attempt == max_retries:
+                raise
+            time.sleep(2 ** attempt)
+
+    if expected is not None:
+        problems = [
+            f"{key} {expected[key]} != {value}"
+            for key, value in (("size", size), ("sha256", sha256))
+            if expected.get(key) is not None and expected[key] != value
+        ]
+        if problems:
+            os.remove(part_path)
+            raise FetchError(f"{name}: " + ", ".join(problems))
+
+    os.replace(part_path, path)
+    if os.path.exists(part_path + ".json"):
+        os.remove(part_path + ".json")
+    _record_file(dest_dir, name, url, sha256, validator)
+    return "downloaded"
+
+
+def fetch(
+    urls: Optional[Dict[str, str]] = None,
+    dest_dir: str = DEST_DIR,
+    manifest: Optional[Dict[str, Dict]] = None,
+    check_remote: bool = False,
+    max_workers: int = 4,
+) -> Dict[str, str]:
+    """Fetch every archive of urls (default: _URLs of muchmore.py) concurrently.
+
+    Returns {file name: "current", "adopted" or "downloaded"}, raises the first error
+    after all downloads are finished.
+    """
+    if urls is None:
+        urls = read_urls()
+    os.makedirs(dest_dir, exist_ok=True)
+    manifest = manifest or {}
+    files = archive_urls(urls)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            name: pool.submit(fetch_file, name, url, dest_dir, manifest.get(name), check_remote)
+            for name, url in files.items()
+        }
+    errors = [name for name, future in futures.items() if future.exception() is not None]
+    if errors:
+        raise FetchError(f"failed: {errors}") from futures[errors[0]].exception()
+    return {name: future.result() for name, future in futures.items()}
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="download the MuchMore archives")
+    parser.add_argument("--dest-dir", default=DEST_DIR)
+    parser.add_argument("--manifest", help="json file of {name: {size, sha256}}")
+    parser.add_argument("--check-remote", action="store_true")
+    parser.add_argument("--max-workers", type=int, default=4)
+    args = parser.parse_args()
+
+    manifest = None
+    if args.manifest is not None:
+        with open(args.manifest, encoding="utf-8") as fp:
+            manifest = json.load(fp)
+
+    t0 = time.time()
+    status = fetch(
+        dest_dir=args.dest_dir,
+        manifest=manifest,
+        check_remote=args.check_remote,
+        max_workers=args.max_workers,
+    )
+    for name, what in status.items():
+        print(f"{name}: {what}")
+    print(f"done in {time.time() - t0:.1f}s")
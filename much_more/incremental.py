@@ -0,0 +1,250 @@
+"""
+Incremental rebuilds of the parsed corpus
+
+Next to the parsed output (a compact corpus for the annotated archives,
+an arrow table for the plain text ones) a manifest.json records every
+archive member that went into it: name, size, sha256 of its bytes and
+the row it became. On a rebuild each archive is compared to the manifest,
+
+* archives whose size and mtime are unchanged are not even opened
+* otherwise members are hashed and only added or changed members are
+  parsed, rows of unchanged members are copied from the existing output
+  and members that are gone are dropped
+
+and the merged output replaces the old one. A full build is just a
+rebuild without a manifest.
+
+    python incremental.py docs <out_dir>
+    python incremental.py plain <out_dir>
+
+Vocab codes of a rebuilt corpus stay the same as before, new strings are
+appended to the vocabs.
+
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from archive import imap_ordered, iter_members
+from compact import CompactBuilder, read_corpus, write_corpus
+from parse import ANNO_PATHS, PLAIN_COLUMNS, PLAIN_PATHS, doc_from_item, plain_row
+from vocab import Vocabs
+
+
+MANIFEST_FILENAME = "manifest.json"
+
+# bump when the layout of the manifest or outputs changes
+MANIFEST_VERSION = 1
+
+PLAIN_FILENAME = "plain.arrow"
+
+
+# Manifests
+#=========================================
+
+def read_manifest(out_dir: str) -> Optional[Dict]:
+    """The manifest saved in out_dir, None if there is none (or an old version)."""
+    path = os.path.join(out_dir, MANIFEST_FILENAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as fp:
+        manifest = json.load(fp)
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def _scan_archive(language: str, path: str, old: Optional[Dict]) -> Tuple[Dict, List, Dict]:
+    """Compare one archive to its manifest entry.
+
+    Returns the new manifest entry (members without rows yet), the
+    (language, name, bytes) items that need parsing and status counts.
+    Unchanged members keep their old row under "old_row".
+    """
+    stat = os.stat(path)
+    entry = {"path": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    old_members = {} if old is None else {member["name"]: member for member in old["members"]}
+    counts = {"unchanged": 0, "added": 0, "changed": 0, "removed": 0}
+
+    if old is not None and (old["size"], old["mtime_ns"]) == (entry["size"], entry["mtime_ns"]):
+        entry["members"] = [
+            {**member, "old_row": member["row"]} for member in old["members"]
+        ]
+        counts["unchanged"] = len(entry["members"])
+        return entry, [], counts
+
+    members = []
+    items = []
+    for name, content_bytes in iter_members(path):
+        member = {
+            "name": name,
+            "size": len(content_bytes),
+            "sha256": hashlib.sha256(content_bytes).hexdigest(),
+        }
+        previous = old_members.pop(name, None)
+        if previous is not None and (previous["size"], previous["sha256"]) == (member["size"], member["sha256"]):
+            member["old_row"] = previous["row"]
+            counts["unchanged"] += 1
+        else:
+            items.append((language, name, content_bytes))
+            counts["changed" if previous is not None else "added"] += 1
+        members.append(member)
+    counts["removed"] = len(old_members)
+    entry["members"] = members
+    return entry, items, counts
+
+
+def _rebuild(
+    paths: Dict[str, str],
+    out_dir: str,
+    parse_items: Callable[[List], Dict[str, object]],
+    load_rows: Callable[[str], List],
+    write_rows: Callable[[List, str], None],
+) -> Dict[str, Dict[str, int]]:
+    """Shared driver for rebuild_docs / rebuild_plain.
+
+    parse_items maps the items to re-parse to {member name: row or None},
+    load_rows loads the rows of the existing output and write_rows saves
+    a new list of rows into a directory.
+    """
+    manifest = read_manifest(out_dir)
+    old_archives = {} if manifest is None else manifest["archives"]
+
+    archives = {}
+    items = []
+    stats = {}
+    for language, path in paths.items():
+        entry, archive_items, counts = _scan_archive(language, path, old_archives.get(language))
+        archives[language] = entry
+        items.extend(archive_items)
+        stats[language] = counts
+    # archives that are no longer in paths
+    for language in old_archives.keys() - paths.keys():
+        stats[language] = {"removed": len(old_archives[language]["members"])}
+
+    if manifest is not None and not any(
+        counts.get(key) for counts in stats.values() for key in ("added", "changed", "removed")
+    ):
+        # the output is already up to date, at most the archive stats in the
+        # manifest are refreshed (e.g. an archive that was touched or re-fetched)
+        for entry in archives.values():
+            for member in entry["members"]:
+                member["row"] = member.pop("old_row")
+        if archives != old_archives:
+            manifest_path = os.path.join(out_dir, MANIFEST_FILENAME)
+            with open(f"{manifest_path}.tmp.{os.getpid()}", "w", encoding="utf-8") as fp:
+                json.dump({"version": MANIFEST_VERSION, "archives": archives}, fp)
+            os.replace(f"{manifest_path}.tmp.{os.getpid()}", manifest_path)
+        return stats
+
+    unchanged = sum(counts.get("unchanged", 0) for counts in stats.values())
+    old_rows = load_rows(out_dir) if unchanged else []
+    parsed = parse_items(items)
+
+    rows = []
+    for entry in archives.values():
+        for member in entry["members"]:
+            if "old_row" in member:
+                old_row = member.pop("old_row")
+                row = None if old_row is None else old_rows[old_row]
+            else:
+                row = parsed[member["name"]]
+            member["row"] = None if row is None else len(rows)
+            if row is not None:
+                rows.append(row)
+
+    # write next to out_dir, then swap. the old output may still be memory
+    # mapped by the rows we are copying, so it is only removed at the end
+    tmp_dir = f"{out_dir.rstrip(os.sep)}.tmp.{os.getpid()}"
+    old_dir = f"{out_dir.rstrip(os.sep)}.old.{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    write_rows(rows, tmp_dir)
+    with open(os.path.join(tmp_dir, MANIFEST_FILENAME), "w", encoding="utf-8") as fp:
+        json.dump({"version": MANIFEST_VERSION, "archives": archives}, fp)
+    if os.path.exists(out_dir):
+        os.replace(out_dir, old_dir)
+    os.replace(tmp_dir, out_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+    return stats
+
+
+# Annotated documents (compact corpus)
+#=========================================
+
+def rebuild_docs(out_dir: str, num_proc: int = 1, paths: Dict[str, str] = ANNO_PATHS) -> Dict:
+    """Bring the compact corpus in out_dir up to date with the annotated archives.
+
+    Returns per archive counts of unchanged / added / changed / removed members.
+    """
+    state = {}
+
+    def load_rows(out_dir):
+        cdocs, vocabs = read_corpus(out_dir)
+        state["vocabs"] = vocabs
+        return cdocs
+
+    def parse_items(items):
+        # rows of unchanged documents are coded with the old vocabs, so new
+        # documents have to extend them rather than start new ones
+        if "vocabs" not in state and os.path.exists(os.path.join(out_dir, "vocabs.json")):
+            state["vocabs"] = Vocabs.load(os.path.join(out_dir, "vocabs.json"))
+        builder = CompactBuilder(state.get("vocabs"))
+        state["vocabs"] = builder.vocabs
+        return {
+            name: None if doc is None else builder.add(doc)
+            for name, doc in imap_ordered(doc_from_item, items, num_proc=num_proc)
+        }
+
+    def write_rows(cdocs, out_dir):
+        write_corpus(cdocs, state["vocabs"], out_dir)
+
+    return _rebuild(paths, out_dir, parse_items, load_rows, write_rows)
+
+
+# Plain text
+#=========================================
+
+def rebuild_plain(out_dir: str, num_proc: int = 1, paths: Dict[str, str] = PLAIN_PATHS) -> Dict:
+    """Bring the read_plain table in out_dir (PLAIN_FILENAME) up to date with the plain archives."""
+
+    def load_rows(out_dir):
+        with pa.memory_map(os.path.join(out_dir, PLAIN_FILENAME)) as source:
+            table = pa.ipc.open_file(source).read_all()
+        return list(zip(*(table.column(name).to_pylist() for name in PLAIN_COLUMNS)))
+
+    def parse_items(items):
+        return {row[1]: row for row in imap_ordered(plain_row, items, num_proc=num_proc)}
+
+    def write_rows(rows, out_dir):
+        df_plain = pd.DataFrame(rows, columns=PLAIN_COLUMNS)
+        feather.write_feather(
+            df_plain, os.path.join(out_dir, PLAIN_FILENAME), compression="uncompressed"
+        )
+
+    return _rebuild(paths, out_dir, parse_items, load_rows, write_rows)
+
+
+def load_plain(out_dir: str) -> pd.DataFrame:
+    return feather.read_feather(os.path.join(out_dir, PLAIN_FILENAME))
+
+
+if __name__ == "__main__":
+
+    import sys
+
+    kind, out_dir = sys.argv[1], sys.argv[2]
+    rebuild = {"docs": rebuild_docs, "plain": rebuild_plain}[kind]
+    t0 = time.time()
+    stats = rebuild(out_dir)
+    print(json.dumps(stats, indent=2))
+    print(f"rebuilt {out_dir} in {time.time() - t0:.1f}s")
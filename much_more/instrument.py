@@ -0,0 +1,330 @@
+"""
+Instrumentation for the MuchMore loaders
+
+The loaders (parse.py, lazy.py and the muchmore.py dataset script) report
+to the module level INSTRUMENT,
+
+* stages, wall and cpu time per named step (decompress, decode, xml_parse,
+  build_records, write, ...)
+* counters, bytes and elements seen (members, bytes, sentences, tokens, ...)
+* the slowest N archive members
+
+It is off by default and then every hook returns at once (stage returns a
+shared no-op context manager), so the hooks can stay in the loaders.
+Switch it on for a run and get a json summary at the end,
+
+    INSTRUMENT.enable("summary.json", profile="sample")
+    df_anno = read_anno()
+    INSTRUMENT.finish()
+
+or from the environment, which writes the summary at exit,
+
+    MUCHMORE_INSTRUMENT=summary.json MUCHMORE_PROFILE=cprofile python parse.py
+
+or for any script,
+
+    python instrument.py summary.json [--profile cprofile|sample] parse.py
+
+profile="cprofile" dumps pstats to <summary>.prof, profile="sample" runs a
+stack sampler thread and dumps collapsed stacks (flamegraph.pl/speedscope
+input) to <summary>.stacks.txt.
+
+Only this process is measured. With num_proc > 1 the stages that run in
+worker processes are not seen, the time the reader waits on them is.
+Worker processes (forked or spawned) never write the summary, only the
+process that enabled the run does.
+
+Shared by parse.py and the muchmore.py dataset script so this module
+should only depend on the standard library and must not import any of
+its siblings.
+
+"""
+
+import atexit
+import cProfile
+from collections import Counter
+from contextlib import nullcontext
+import heapq
+import json
+import os
+import sys
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, TypeVar
+
+
+T = TypeVar("T")
+
+DEFAULT_TOP_N = 20
+
+PROFILE_KINDS = ("cprofile", "sample")
+
+# shared by every disabled hook, so they allocate nothing
+_NULL = nullcontext()
+
+
+class _Stage:
+    """Adds the wall and cpu time of a with block to a [calls, wall, cpu] list"""
+
+    __slots__ = ("stats", "wall0", "cpu0")
+
+    def __init__(self, stats: List):
+        self.stats = stats
+
+    def __enter__(self):
+        self.wall0 = time.perf_counter()
+        self.cpu0 = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        stats = self.stats
+        stats[0] += 1
+        stats[1] += time.perf_counter() - self.wall0
+        stats[2] += time.process_time() - self.cpu0
+
+
+class _Member:
+    """Offers the wall time of a with block to the slowest members"""
+
+    __slots__ = ("instrument", "name", "wall0")
+
+    def __init__(self, instrument: "Instrument", name: str):
+        self.instrument = instrument
+        self.name = name
+
+    def __enter__(self):
+        self.wall0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.instrument.add_member(self.name, time.perf_counter() - self.wall0)
+
+
+class _StackSampler(threading.Thread):
+    """Samples the stack of one thread every interval seconds"""
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name="muchmore-stack-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def dump(self, path: str):
+        with open(path, "w", encoding="utf-8") as fp:
+            for stack, count in self.stacks.most_common():
+                fp.write(f"{stack} {count}\n")
+
+
+class Instrument:
+    """Stage timers, counters and slowest members of one run (see module docstring)"""
+
+    def __init__(self):
+        self.enabled = False
+        self.summary_path: Optional[str] = None
+        self.profile: Optional[str] = None
+        self._profiler = None
+        self._pid: Optional[int] = None
+        self.reset()
+
+    def reset(self, top_n: int = DEFAULT_TOP_N):
+        self.top_n = top_n
+        self.stages: Dict[str, List] = {}
+        self.counters: Counter = Counter()
+        self._slowest: List = []
+        self._wall0 = time.perf_counter()
+        self._cpu0 = time.process_time()
+
+    # hooks
+    #=========================================
+
+    def stage(self, name: str):
+        """Context manager that adds its wall and cpu time to stage name"""
+        if not self.enabled:
+            return _NULL
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = [0, 0.0, 0.0]
+        return _Stage(stats)
+
+    def timed(self, name: str, iterable: Iterable[T]) -> Iterator[T]:
+        """Iterate iterable adding the time spent in each next() to stage name"""
+        if not self.enabled:
+            return iter(iterable)
+        return self._timed(name, iterable)
+
+    def _timed(self, name, iterable):
+        items = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name: str, n: int = 1):
+        if self.enabled:
+            self.counters[name] += n
+
+    def member(self, name: str):
+        """Context manager that offers its wall time to the slowest members"""
+        if not self.enabled:
+            return _NULL
+        return _Member(self, name)
+
+    def add_member(self, name: str, seconds: float):
+        if len(self._slowest) < self.top_n:
+            heapq.heappush(self._slowest, (seconds, name))
+        else:
+            heapq.heappushpop(self._slowest, (seconds, name))
+
+    # runs
+    #=========================================
+
+    def enable(
+        self,
+        summary_path: Optional[str] = None,
+        profile: Optional[str] = None,
+        top_n: int = DEFAULT_TOP_N,
+        sample_interval: float = 0.005,
+    ) -> "Instrument":
+        """Start a run, profile is None, "cprofile" or "sample".
+
+        finish() ends it and writes the summary (and profile) if summary_path is given.
+        """
+        if profile is not None and profile not in PROFILE_KINDS:
+            raise ValueError(f"unknown profile {profile!r}, expected one of {PROFILE_KINDS}")
+        if self.enabled:
+            self.finish()
+        self.reset(top_n)
+        self.summary_path = summary_path
+        self.profile = profile
+        self._pid = os.getpid()
+        if profile == "cprofile":
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        elif profile == "sample":
+            self._profiler = _StackSampler(threading.get_ident(), sample_interval)
+            self._profiler.start()
+        self.enabled = True
+        return self
+
+    def profile_path(self) -> Optional[str]:
+        if self.profile is None or self.summary_path is None:
+            return None
+        suffix = ".prof" if self.profile == "cprofile" else ".stacks.txt"
+        return os.path.splitext(self.summary_path)[0] + suffix
+
+    def summary(self) -> Dict:
+        """Machine readable summary of the run so far"""
+        stages = {
+            name: {"calls": calls, "wall_s": round(wall, 6), "cpu_s": round(cpu, 6)}
+            for name, (calls, wall, cpu) in sorted(self.stages.items(), key=lambda kv: -kv[1][1])
+        }
+        return {
+            "pid": os.getpid(),
+            "wall_s": round(time.perf_counter() - self._wall0, 6),
+            "cpu_s": round(time.process_time() - self._cpu0, 6),
+            "stages": stages,
+            "counters": dict(self.counters),
+            "slowest_members": [
+                {"name": name, "wall_s": round(seconds, 6)}
+                for seconds, name in sorted(self._slowest, reverse=True)
+            ],
+            "profile": self.profile_path(),
+        }
+
+    def finish(self) -> Optional[Dict]:
+        """End the run, write the summary and profile and return the summary."""
+        if not self.enabled:
+            return None
+        self.enabled = False
+        if os.getpid() != self._pid:
+            # a forked worker that inherited the run, the parent reports it
+            self._profiler = None
+            return None
+        profiler, self._profiler = self._profiler, None
+        if profiler is not None:
+            if self.profile == "cprofile":
+                profiler.disable()
+            else:
+                profiler.stop()
+
+        summary = self.summary()
+        if self.summary_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.summary_path)), exist_ok=True)
+            if profiler is not None:
+                if self.profile == "cprofile":
+                    profiler.dump_stats(self.profile_path())
+                else:
+                    profiler.dump(self.profile_path())
+            with open(self.summary_path, "w", encoding="utf-8") as fp:
+                json.dump(summary, fp, indent=2)
+        return summary
+
+
+INSTRUMENT = Instrument()
+
+
+def enable_from_env(environ=os.environ) -> bool:
+    """Enable INSTRUMENT if MUCHMORE_INSTRUMENT names a summary path.
+
+    MUCHMORE_PROFILE picks the profiler, the summary is written at exit.
+    The pid of the enabling process is put in MUCHMORE_INSTRUMENT_PID, so
+    spawned workers, which import this module again, stay disabled.
+    """
+    summary_path = environ.get("MUCHMORE_INSTRUMENT")
+    if not summary_path:
+        return False
+    owner = environ.get("MUCHMORE_INSTRUMENT_PID")
+    if owner is not None and owner != str(os.getpid()):
+        return False
+    environ["MUCHMORE_INSTRUMENT_PID"] = str(os.getpid())
+    INSTRUMENT.enable(summary_path, profile=environ.get("MUCHMORE_PROFILE") or None)
+    atexit.register(INSTRUMENT.finish)
+    return True
+
+
+enable_from_env()
+
+
+if __name__ == "__main__":
+
+    import argparse
+    import runpy
+
+    # the loaders import this module as "instrument", make that this module
+    # instead of a second copy with its own INSTRUMENT
+    sys.modules.setdefault("instrument", sys.modules[__name__])
+
+    parser = argparse.ArgumentParser(description="run a script with the loaders instrumented")
+    parser.add_argument("summary_path")
+    parser.add_argument("--profile", choices=PROFILE_KINDS, default=None)
+    parser.add_argument("--top-n", type=int, default=DEFAULT_TOP_N)
+    parser.add_argument("script")
+    parser.add_argument("args", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    sys.argv = [args.script] + args.args
+    INSTRUMENT.enable(args.summary_path, profile=args.profile, top_n=args.top_n)
+    try:
+        runpy.run_path(args.script, run_name="__main__")
+    finally:
+        summary = INSTRUMENT.finish()
+        print(json.dumps({key: summary[key] for key in ("wall_s", "cpu_s", "stages")}, indent=2))
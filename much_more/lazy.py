@@ -0,0 +1,230 @@
+"""
+Lazy MuchMore documents
+
+A LazyDocument keeps the raw bytes of its annotated tar member and only
+parses an annotation layer the first time it is used. For each parse the
+subtrees of all other layers are cut out of a memoryview of the bytes
+with one regex pass (anno.strip_layers) before the xml parser runs, and
+the result is kept, so a token only pipeline never builds a single
+umlsterm, chunk or semrel element.
+
+    for doc in iter_lazy_docs(layers=["tokens"]):
+        for sent in doc.xsentences:
+            words = [token.xtext for token in sent.xtext]
+
+`layers` is the group of layers parsed together on the first access of
+any of them. Other layers still work, each costs one more pass. Without
+layers, each layer is parsed on its own when it is first used.
+
+An empty member (e.g. Arthroskopie.00130237.eng) gives a document with
+no sentences, is_empty set and None for the root attributes.
+
+"""
+
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from anno import LAYERS, parse_document, read_xsent
+from parse import (
+    ANNO_PATHS,
+    NATIVE_ENCODING,
+    XSENT_BUILDERS,
+    Document,
+    Sentence,
+    iter_member_items,
+)
+
+
+# layer name -> Sentence attribute
+LAYER_ATTRS = {
+    "umlsterms": "xumlsterms",
+    "ewnterms": "xewnterms",
+    "semrels": "xsemrels",
+    "chunks": "xchunks",
+    "tokens": "xtext",
+}
+
+
+class LazySentence:
+    """Sentence view whose layers are read from the parent LazyDocument"""
+
+    __slots__ = ("_doc", "_ii", "_token_index")
+
+    def __init__(self, doc: "LazyDocument", ii: int):
+        self._doc = doc
+        self._ii = ii
+        self._token_index = None
+
+    @property
+    def xid(self) -> str:
+        return self._doc._sentence_attrs()[self._ii][0]
+
+    @property
+    def xcorresp(self) -> str:
+        return self._doc._sentence_attrs()[self._ii][1]
+
+    @property
+    def xumlsterms(self) -> Tuple:
+        return self._doc.layer("umlsterms")[self._ii]
+
+    @property
+    def xewnterms(self) -> Tuple:
+        return self._doc.layer("ewnterms")[self._ii]
+
+    @property
+    def xsemrels(self) -> Tuple:
+        return self._doc.layer("semrels")[self._ii]
+
+    @property
+    def xchunks(self) -> Tuple:
+        return self._doc.layer("chunks")[self._ii]
+
+    @property
+    def xtext(self) -> Tuple:
+        return self._doc.layer("tokens")[self._ii]
+
+    @property
+    def token_index(self) -> Dict[str, int]:
+        if self._token_index is None:
+            self._token_index = {token.xid: ii for ii, token in enumerate(self.xtext)}
+        return self._token_index
+
+    def to_record(self) -> Sentence:
+        return Sentence(
+            xid=self.xid,
+            xcorresp=self.xcorresp,
+            xumlsterms=self.xumlsterms,
+            xewnterms=self.xewnterms,
+            xsemrels=self.xsemrels,
+            xchunks=self.xchunks,
+            xtext=self.xtext,
+        )
+
+
+class LazyDocument:
+    """Document that parses each annotation layer on first access (see module docstring)"""
+
+    def __init__(self, raw, layers: Optional[Iterable[str]] = None):
+        self.raw = memoryview(raw)
+        self.preload = () if layers is None else tuple(layers)
+        self._root_attrs: Optional[Dict[str, str]] = None
+        self._sentences: Optional[List[Tuple[str, str]]] = None
+        self._layers: Dict[str, Tuple[Tuple, ...]] = {}
+        self._xsentences: Optional[Tuple[LazySentence, ...]] = None
+
+    def _parse(self, layers: Tuple[str, ...]):
+        """One pass over the raw bytes building only the given layers"""
+
+        def convert(xsent):
+            return xsent.get("id"), xsent.get("corresp"), read_xsent(xsent, XSENT_BUILDERS, layers)
+
+        parsed = parse_document(self.raw, convert, NATIVE_ENCODING, layers=layers)
+        # an empty member parses to None, it has no sentences
+        xroot, sentences = (None, []) if parsed is None else parsed
+        if self._root_attrs is None:
+            self._root_attrs = {} if xroot is None else dict(xroot.attrib)
+            self._sentences = [(xid, xcorresp) for xid, xcorresp, _ in sentences]
+        for layer in layers:
+            self._layers[layer] = tuple(tuple(records[layer]) for _, _, records in sentences)
+
+    def load(self, *layers: str):
+        """Parse (in one pass) whichever of the given layers are not parsed yet"""
+        missing = tuple(layer for layer in layers if layer not in self._layers)
+        if missing or self._root_attrs is None:
+            self._parse(missing)
+
+    def layer(self, name: str) -> Tuple[Tuple, ...]:
+        """Records of one layer for every sentence"""
+        if name not in self._layers:
+            if name in self.preload:
+                self.load(*self.preload)
+            else:
+                self.load(name)
+        return self._layers[name]
+
+    @property
+    def is_empty(self) -> bool:
+        return len(self.raw) == 0
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._layers
+
+    def _sentence_attrs(self) -> List[Tuple[str, str]]:
+        if self._sentences is None:
+            self.load(*self.preload)
+        return self._sentences
+
+    def _attr(self, name: str) -> str:
+        if self._root_attrs is None:
+            self.load(*self.preload)
+        return self._root_attrs.get(name)
+
+    @property
+    def xid(self) -> str:
+        return self._attr("id")
+
+    @property
+    def xtype(self) -> str:
+        return self._attr("type")
+
+    @property
+    def xlang(self) -> str:
+        return self._attr("lang")
+
+    @property
+    def xcorresp(self) -> str:
+        return self._attr("corresp")
+
+    @property
+    def xsentences(self) -> Tuple[LazySentence, ...]:
+        if self._xsentences is None:
+            self._xsentences = tuple(
+                LazySentence(self, ii) for ii in range(len(self._sentence_attrs()))
+            )
+        return self._xsentences
+
+    def to_document(self) -> Optional[Document]:
+        """Fully parsed Document (parses every layer that is still missing), None if empty"""
+        if self.is_empty:
+            return None
+        self.load(*LAYERS)
+        return Document(
+            xid=self.xid,
+            xtype=self.xtype,
+            xlang=self.xlang,
+            xcorresp=self.xcorresp,
+            xsentences=[sent.to_record() for sent in self.xsentences],
+        )
+
+
+def iter_lazy_docs(languages=None, layers: Optional[Iterable[str]] = None) -> Iterator[LazyDocument]:
+    """LazyDocuments straight from the annotated archives, nothing is parsed up front.
+
+    Empty members are skipped. layers is passed on to every LazyDocument.
+    """
+    layers = None if layers is None else tuple(layers)
+    for _, name, content_bytes in iter_member_items(ANNO_PATHS, languages):
+        if len(content_bytes) == 0:
+            print(name)
+            print("skipping")
+            print()
+            continue
+        yield LazyDocument(content_bytes, layers)
+
+
+if __name__ == "__main__":
+
+    import time
+
+    from parse import iter_docs
+
+    t0 = time.time()
+    num_tokens = sum(len(sent.xtext) for doc in iter_docs() for sent in doc.xsentences)
+    print(f"iter_docs: {num_tokens} tokens in {time.time() - t0:.1f}s")
+
+    t0 = time.time()
+    num_tokens = sum(len(sent.xtext) for doc in iter_docs(layers=["tokens"]) for sent in doc.xsentences)
+    print(f"iter_docs(layers=['tokens']): {num_tokens} tokens in {time.time() - t0:.1f}s")
+
+    t0 = time.time()
+    num_tokens = sum(len(sent.xtext) for doc in iter_lazy_docs(layers=["tokens"]) for sent in doc.xsentences)
+    print(f"iter_lazy_docs(layers=['tokens']): {num_tokens} tokens in {time.time() - t0:.1f}s")
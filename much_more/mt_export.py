@@ -0,0 +1,263 @@
+"""
+Sentence aligned en-de export of MuchMore for MT training
+
+The en and de annotated archives are streamed side by side and joined on
+prefix (bilingual.join_on_prefix) while still raw member bytes. Matched
+pairs go to num_proc worker processes that parse the tokens layer, align
+sentences with their corresp attributes (bilingual.align_sentences) and
+format each side as one of the STREAMS,
+
+* text: token texts
+* lemma: token lemmas
+* lemma_pos: lemma|pos per token
+
+Rows (prefix, en_ids, de_ids, en, de) are cut into shards of at most
+max_shard_bytes of utf-8 text and written by a pool of threads as
+parquet or tsv files, next to a manifest.json with the row count of
+every shard,
+
+    python mt_export.py <out_dir> --stream lemma_pos --format tsv --num-proc 8
+
+Members that wait for their partner longer than max_waiting others are
+given up and counted as evicted, so the raw bytes held by the join stay
+bounded whatever the order of the archives.
+
+Shards are numbered in archive order and their contents do not depend on
+num_proc. The export is written to a temporary directory that replaces
+out_dir when it is complete.
+
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import json
+import os
+import shutil
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from archive import imap_ordered
+from bilingual import align_sentences, join_on_prefix
+from parse import ANNO_PATHS, Sentence, doc_from_item, iter_member_items, sample_prefix
+from spans import TOKEN_SEPARATOR
+
+
+MANIFEST_FILENAME = "manifest.json"
+
+MANIFEST_VERSION = 1
+
+STREAMS = ("text", "lemma", "lemma_pos")
+
+FORMATS = ("parquet", "tsv")
+
+ROW_COLUMNS = ("prefix", "en_ids", "de_ids", "en", "de")
+
+SCHEMA = pa.schema([(name, pa.string()) for name in ROW_COLUMNS])
+
+MAX_SHARD_BYTES = 64 * 1024 * 1024
+
+# unmatched members each side may hold while waiting for their partner
+MAX_WAITING = 64
+
+# separates lemma and pos in the lemma_pos stream
+TAG_SEPARATOR = "|"
+
+
+# Rows
+#=========================================
+
+def _token_string(token, stream: str) -> str:
+    if stream == "text":
+        return token.xtext or ""
+    lemma = token.xlemma or token.xtext or ""
+    if stream == "lemma":
+        return lemma
+    return f"{lemma}{TAG_SEPARATOR}{token.xpos or ''}"
+
+
+def format_sentences(sents: Tuple[Sentence, ...], stream: str) -> str:
+    """One side of an aligned group as a single line of tokens"""
+    return TOKEN_SEPARATOR.join(
+        _token_string(token, stream) for sent in sents for token in sent.xtext
+    )
+
+
+def _pair_rows(pair, stream: str) -> Optional[List[Tuple[str, ...]]]:
+    """Worker side: ((en name, en bytes), (de name, de bytes)) -> aligned rows,
+    None if either annotation is empty"""
+    (en_name, en_bytes), (de_name, de_bytes) = pair
+    _, doc_en = doc_from_item(("en", en_name, en_bytes), layers=("tokens",))
+    _, doc_de = doc_from_item(("de", de_name, de_bytes), layers=("tokens",))
+    if doc_en is None or doc_de is None:
+        return None
+    prefix = sample_prefix(en_name)
+    rows = []
+    for en_group, de_group in align_sentences(doc_en, doc_de):
+        rows.append((
+            prefix,
+            " ".join(sent.xid for sent in en_group),
+            " ".join(sent.xid for sent in de_group),
+            format_sentences(en_group, stream),
+            format_sentences(de_group, stream),
+        ))
+    return rows
+
+
+def iter_member_pairs(
+    counts: Optional[Dict[str, int]] = None,
+    max_waiting: Optional[int] = MAX_WAITING,
+) -> Iterator[Tuple[Tuple[str, bytes], Tuple[str, bytes]]]:
+    """Matched ((en name, en bytes), (de name, de bytes)) members, nothing parsed.
+
+    Unmatched members are counted in counts (keys "en" and "de"), members
+    given up after waiting for max_waiting others under "evicted".
+    """
+    en = ((sample_prefix(name), (name, data)) for _, name, data in iter_member_items(ANNO_PATHS, ["en"]))
+    de = ((sample_prefix(name), (name, data)) for _, name, data in iter_member_items(ANNO_PATHS, ["de"]))
+    evicted = set()
+    for prefix, en_item, de_item in join_on_prefix(en, de, max_waiting, evicted):
+        if en_item is None or de_item is None:
+            if counts is not None:
+                key = "evicted" if prefix in evicted else "de" if en_item is None else "en"
+                counts[key] += 1
+            continue
+        yield en_item, de_item
+
+
+# Shards
+#=========================================
+
+def _clean(value: str) -> str:
+    return value.replace("\t", " ").replace("\n", " ").replace("\r", " ")
+
+
+def write_shard(rows: List[Tuple[str, ...]], path: str, fmt: str) -> int:
+    """Write rows as a parquet or tsv (with header, no quoting) file, returns its size in bytes."""
+    if fmt == "parquet":
+        columns = list(zip(*rows)) if rows else [()] * len(ROW_COLUMNS)
+        table = pa.Table.from_arrays([pa.array(col, pa.string()) for col in columns], schema=SCHEMA)
+        pq.write_table(table, path)
+    else:
+        with open(path, "w", encoding="utf-8", newline="") as fp:
+            fp.write("\t".join(ROW_COLUMNS) + "\n")
+            for row in rows:
+                fp.write("\t".join(_clean(value) for value in row) + "\n")
+    return os.path.getsize(path)
+
+
+def _row_bytes(row: Tuple[str, ...]) -> int:
+    return sum(len(value.encode("utf-8")) for value in row)
+
+
+def export(
+    out_dir: str,
+    stream: str = "text",
+    fmt: str = "parquet",
+    num_proc: int = 1,
+    max_shard_bytes: int = MAX_SHARD_BYTES,
+    write_threads: int = 4,
+    max_waiting: Optional[int] = MAX_WAITING,
+) -> Dict:
+    """Export aligned sentence pairs to shards in out_dir, returns the manifest."""
+    if stream not in STREAMS:
+        raise ValueError(f"unknown stream {stream!r}, expected one of {STREAMS}")
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown format {fmt!r}, expected one of {FORMATS}")
+
+    tmp_dir = f"{out_dir.rstrip(os.sep)}.tmp.{os.getpid()}"
+    old_dir = f"{out_dir.rstrip(os.sep)}.old.{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    # members that give no rows: no partner, given up waiting, an empty
+    # annotation on either side or no linked sentences
+    unmatched = {"en": 0, "de": 0, "evicted": 0, "empty": 0, "unaligned": 0}
+    shards = []
+    pending = deque()
+
+    def submit(rows):
+        name = f"part-{len(shards):05d}.{fmt}"
+        shards.append({"path": name, "rows": len(rows)})
+        pending.append((shards[-1], pool.submit(write_shard, rows, os.path.join(tmp_dir, name), fmt)))
+        # bound the rows held by shards that are still being written
+        while len(pending) > 2 * write_threads:
+            shard, future = pending.popleft()
+            shard["bytes"] = future.result()
+
+    num_pairs = 0
+    with ThreadPoolExecutor(max_workers=write_threads) as pool:
+        rows, size = [], 0
+        pairs = iter_member_pairs(unmatched, max_waiting)
+        for pair_rows in imap_ordered(partial(_pair_rows, stream=stream), pairs, num_proc=num_proc):
+            if pair_rows is None:
+                unmatched["empty"] += 1
+                continue
+            if not pair_rows:
+                unmatched["unaligned"] += 1
+                continue
+            num_pairs += 1
+            for row in pair_rows:
+                row_bytes = _row_bytes(row)
+                if rows and size + row_bytes > max_shard_bytes:
+                    submit(rows)
+                    rows, size = [], 0
+                rows.append(row)
+                size += row_bytes
+        if rows:
+            submit(rows)
+        for shard, future in pending:
+            shard["bytes"] = future.result()
+
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "stream": stream,
+        "format": fmt,
+        "columns": list(ROW_COLUMNS),
+        "num_pairs": num_pairs,
+        "unmatched": unmatched,
+        "num_rows": sum(shard["rows"] for shard in shards),
+        "shards": shards,
+    }
+    with open(os.path.join(tmp_dir, MANIFEST_FILENAME), "w", encoding="utf-8") as fp:
+        json.dump(manifest, fp, indent=2)
+
+    if os.path.exists(out_dir):
+        os.replace(out_dir, old_dir)
+    os.replace(tmp_dir, out_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return manifest
+
+
+def read_manifest(out_dir: str) -> Dict:
+    with open(os.path.join(out_dir, MANIFEST_FILENAME), encoding="utf-8") as fp:
+        return json.load(fp)
+
+
+if __name__ == "__main__":
+
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="export aligned en-de sentence pairs")
+    parser.add_argument("out_dir")
+    parser.add_argument("--stream", choices=STREAMS, default="text")
+    parser.add_argument("--format", choices=FORMATS, default="parquet")
+    parser.add_argument("--num-proc", type=int, default=os.cpu_count())
+    parser.add_argument("--max-shard-mb", type=float, default=MAX_SHARD_BYTES / 2**20)
+    parser.add_argument("--max-waiting", type=int, default=MAX_WAITING)
+    args = parser.parse_args()
+
+    t0 = time.time()
+    manifest = export(
+        args.out_dir,
+        stream=args.stream,
+        fmt=args.format,
+        num_proc=args.num_proc,
+        max_shard_bytes=int(args.max_shard_mb * 2**20),
+        max_waiting=args.max_waiting,
+    )
+    print(f"pairs: {manifest['num_pairs']}, unmatched: {manifest['unmatched']}")
+    print(f"{manifest['num_rows']} rows in {len(manifest['shards'])} shards in {time.time() - t0:.1f}s")
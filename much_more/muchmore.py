@@ -58,11 +58,13 @@ Some notes
 """
 
 from dataclasses import dataclass
+import functools
 import gzip
+import io
 import os
 import re
 import tarfile
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 import xml.etree.ElementTree as ET
 from xml.etree.ElementTree import Element
 
@@ -70,6 +72,11 @@ import chardet
 import datasets
 import pandas as pd
 
+from .anno import DICT_BUILDERS, iterparse_document, read_xsent, strip_layers
+from .archive import PREFIX_RE, imap_ordered
+from .instrument import INSTRUMENT
+from .vocab import Vocabs
+
 
 """
 Step 2: Create keyword descriptors for your dataset
@@ -107,9 +114,8 @@ _HOMEPAGE = "https://muchmore.dfki.de/resources1.htm"
 # TODO: website says public domain, but didn't see a specific license 
 _LICENSE = ""
 
-# TODO: there are 4 files in this corpus. played around with different configs
-# but for now the default is to download the english annotated tar file.
-# should we make different configs for lots of use cases?  
+# there are 4 files in this corpus. the default "muchmore" config is the
+# english annotated tar file, the other configs are listed in _CONFIGS
 _URLs = {
     "en_plain": "https://muchmore.dfki.de/pubs/springer_english_train_plain.tar.gz",
     "de_plain": "https://muchmore.dfki.de/pubs/springer_german_train_plain.tar.gz",
@@ -125,27 +131,105 @@ _VERSION = "4.2.0"
 
 NATIVE_ENCODING = "ISO-8859-1"
 
+# config name -> (description, keys into _URLs, kind, language)
+_CONFIGS = {
+    _DATASETNAME: ("English annotated abstracts (same as en_anno)", ("muchmore",), "anno", "en"),
+    "en_plain": ("English plain text abstracts", ("en_plain",), "plain", "en"),
+    "de_plain": ("German plain text abstracts", ("de_plain",), "plain", "de"),
+    "en_anno": ("English annotated abstracts", ("en_anno",), "anno", "en"),
+    "de_anno": ("German annotated abstracts", ("de_anno",), "anno", "de"),
+    "bilingual": (
+        "Plain text abstracts that exist in both languages, paired on their prefix",
+        ("en_plain", "de_plain"),
+        "bilingual",
+        None,
+    ),
+}
+
+@dataclass
+class MuchMoreConfig(datasets.BuilderConfig):
+    """BuilderConfig for MuchMore
+
+    streaming_parse: feed each tar member straight into an incremental
+        xml parser and release every sentence as soon as it is converted
+        instead of decoding the whole member and building the full tree.
+        Produces the same examples either way.
+    parse_num_proc: number of worker processes that decode and convert
+        tar members. The archive is still read by a single reader and
+        examples keep archive order. 1 parses in the current process.
+    vocab_path: json file of corpus wide vocabularies (see vocab.py).
+        When set, pos, lemma, chunk type, cui, tui, preferred, MeSH code
+        and reltype also get an integer <name>_idx feature. An existing
+        file is extended so previously assigned codes are kept and the
+        updated vocabularies are written back after generation.
+    layers: annotation layers to parse, some of "umlsterms", "ewnterms",
+        "semrels", "chunks" and "tokens". Other layers come out as empty
+        lists and their xml subtrees are skipped (with streaming_parse they
+        are never even built). None parses every layer.
+    num_shards: number of contiguous groups of members generation is split
+        into, so load_dataset(..., num_proc=N) can work on N shards at
+        once. Examples and ids are the same for any number of shards.
+        A tar.gz can only be read from the start, so every shard
+        decompresses the archive up to its last member and splitting
+        needs one extra pass to list the members. Only worth it with
+        num_proc > 1, and then about num_proc shards.
+    """
+    streaming_parse: bool = False
+    parse_num_proc: int = 1
+    vocab_path: Optional[str] = None
+    layers: Optional[Tuple[str, ...]] = None
+    num_shards: int = 1
+
+
 class MuchMoreDataset(datasets.GeneratorBasedBuilder):
     """MuchMore Springer Bilingual Corpus"""
 
     VERSION = datasets.Version(_VERSION)
 
+    BUILDER_CONFIG_CLASS = MuchMoreConfig
+
     BUILDER_CONFIGS = [
-        datasets.BuilderConfig(
-            name=_DATASETNAME,
-            version=VERSION,
-            description=_DESCRIPTION,
-        ),
+        MuchMoreConfig(
+            name=name,
+            version=datasets.Version(_VERSION),
+            description=description,
+        )
+        for name, (description, _, _, _) in _CONFIGS.items()
     ]
 
     DEFAULT_CONFIG_NAME = _DATASETNAME
 
+    def _vocab_features(self, *names) -> Dict:
+        """<name>_idx integer code features, only when vocab_path is set"""
+        if self.config.vocab_path is None:
+            return {}
+        return {f"{name}_idx": datasets.Value("int32") for name in names}
+
     # heavily nested. this represents the structure in the raw xml
     # we can definitely do more to organize this, but what shape 
     # should that take? 
     def _info(self):
 
-        if self.config.name == _DATASETNAME:
+        kind = _CONFIGS[self.config.name][2]
+
+        if kind == "plain":
+            features = datasets.Features({
+                "sample_id": datasets.Value("string"),
+                "prefix": datasets.Value("string"),
+                "language": datasets.Value("string"),
+                "text": datasets.Value("string"),
+            })
+
+        elif kind == "bilingual":
+            features = datasets.Features({
+                "prefix": datasets.Value("string"),
+                "en_sample_id": datasets.Value("string"),
+                "de_sample_id": datasets.Value("string"),
+                "en_text": datasets.Value("string"),
+                "de_text": datasets.Value("string"),
+            })
+
+        elif kind == "anno":
             features = datasets.Features({
                 "sample_id": datasets.Value("string"),
                 "corresp": datasets.Value("string"),
@@ -162,8 +246,10 @@ class MuchMoreDataset(datasets.GeneratorBasedBuilder):
                             "cui": datasets.Value("string"),
                             "preferred": datasets.Value("string"),
                             "tui": datasets.Value("string"),
+                            **self._vocab_features("cui", "preferred", "tui"),
                             "mshs": datasets.Sequence({
                                 "code": datasets.Value("string"),
+                                **self._vocab_features("code"),
                             }),
                         }),
                     }),
@@ -180,18 +266,21 @@ class MuchMoreDataset(datasets.GeneratorBasedBuilder):
                         "term1": datasets.Value("string"),
                         "term2": datasets.Value("string"),
                         "reltype": datasets.Value("string"),
+                        **self._vocab_features("reltype"),
                     }),
                     "chunks": datasets.Sequence({
                         "id": datasets.Value("string"),
                         "to": datasets.Value("string"),
                         "from": datasets.Value("string"),
                         "type": datasets.Value("string"),
+                        **self._vocab_features("type"),
                     }),
                     "tokens": datasets.Sequence({
                         "id": datasets.Value("string"),
                         "pos": datasets.Value("string"),
                         "lemma": datasets.Value("string"),
                         "text": datasets.Value("string"),
+                        **self._vocab_features("pos", "lemma"),
                     }),
                 })
             })
@@ -215,23 +304,15 @@ class MuchMoreDataset(datasets.GeneratorBasedBuilder):
 
     def _split_generators(self, dl_manager):
         """Returns SplitGenerators."""
-        # TODO: This method is tasked with downloading/extracting the data and defining the splits depending on the configuration
-        # If several configurations are possible (listed in BUILDER_CONFIGS), the configuration selected by the user is in self.config.name
-
-        # dl_manager is a datasets.download.DownloadManager that can be used to download and extract URLs
-        # It can accept any type or nested list/dict and will give back the same structure with the url replaced with path to local files.
-        # By default the archives will be extracted and a path to a cached folder where they are extracted is returned instead of the archive
-        my_urls = _URLs[self.config.name]
-        data_dir = dl_manager.download(my_urls)
+        _, url_keys, _, _ = _CONFIGS[self.config.name]
+        data_dirs = dl_manager.download([_URLs[key] for key in url_keys])
         return [
             datasets.SplitGenerator(
                 name=datasets.Split.TRAIN,
-                # These kwargs will be passed to _generate_examples
-                # `iter_archive` will yield (file_path, file_pointer)
-                # tuples for each abstract / member of the tar.gz
-                # file when iterated over. 
+                # a list, so datasets can hand groups of shards to
+                # different processes when num_proc > 1
                 gen_kwargs={
-                    "file_paths": dl_manager.iter_archive(data_dir),
+                    "shards": self._get_shards(dl_manager, data_dirs),
                     "split": "train",
                 },
             ),
@@ -239,125 +320,292 @@ class MuchMoreDataset(datasets.GeneratorBasedBuilder):
 
 
     @staticmethod
-    def _get_umlsterms_from_xsent(xsent: Element) -> List:
-        xumlsterms = xsent.find("./umlsterms")
-
-        umlsterms = []
-        for xumlsterm in xumlsterms.findall("./umlsterm"):
-
-            concepts = []
-            for xconcept in xumlsterm.findall("./concept"):
-
-                mshs = [{
-                    "code": xmsh.get("code")
-                } for xmsh in xconcept.findall("./msh")]
-
-                concept = {
-                    "id": xconcept.get("id"),
-                    "cui": xconcept.get("cui"),
-                    "preferred": xconcept.get("preferred"),
-                    "tui": xconcept.get("tui"),
-                    "mshs": mshs,
-                }
-                concepts.append(concept)
-
-            umlsterm = {
-                "id": xumlsterm.get("id"),
-                "from": xumlsterm.get("from"),
-                "to": xumlsterm.get("to"),
-                "concepts": concepts,
+    def _list_members(archive) -> List[str]:
+        """Names of the non empty members of an iter_archive iterable, in archive order."""
+        names = []
+        for file_path, f in archive:
+            if f.read(1) == b"":
+                print(file_path)
+                print("skipping")
+                print()
+                continue
+            names.append(file_path)
+        return names
+
+
+    def _get_shards(self, dl_manager, data_dirs) -> List[Dict]:
+        """Split the members of the archive(s) into config.num_shards contiguous shards.
+
+        Each shard gets the iter_archive iterable(s) to read from, the
+        members it generates (tuples of en and de member names for the
+        bilingual config, None for every member) and the id of its first
+        example. Ids count the non empty members (or pairs) in archive
+        order, which is exactly what a single serial pass produces.
+        """
+        kind = _CONFIGS[self.config.name][2]
+        archives = [dl_manager.iter_archive(data_dir) for data_dir in data_dirs]
+
+        if kind != "bilingual" and self.config.num_shards == 1:
+            # one pass over the whole archive, nothing to list up front
+            return [{"archives": archives, "members": None, "first_id": 0, "num_shards": 1}]
+
+        if kind == "bilingual":
+            en_names, de_names = (self._list_members(archive) for archive in archives)
+            de_by_prefix = {PREFIX_RE.sub("", name): name for name in de_names}
+            members = [
+                (name, de_by_prefix[PREFIX_RE.sub("", name)])
+                for name in en_names
+                if PREFIX_RE.sub("", name) in de_by_prefix
+            ]
+        else:
+            members = [(name,) for name in self._list_members(archives[0])]
+
+        num_shards = max(1, min(self.config.num_shards, len(members)))
+        bounds = [len(members) * ii // num_shards for ii in range(num_shards + 1)]
+        return [
+            {
+                "archives": archives,
+                "members": members[start:stop],
+                "first_id": start,
+                "num_shards": num_shards,
             }
-            umlsterms.append(umlsterm)
-
-        return umlsterms
+            for start, stop in zip(bounds[:-1], bounds[1:])
+        ]
 
 
     @staticmethod
-    def _get_ewnterms_from_xsent(xsent: Element) -> List:
-        xewnterms = xsent.find("./ewnterms")
+    def _iter_shard_members(archive, names):
+        """(file_path, f) for the members of archive in names, stops after the last one.
+
+        names None is every member.
+        """
+        if names is None:
+            yield from INSTRUMENT.timed("decompress", archive)
+            return
+        wanted = set(names)
+        for file_path, f in INSTRUMENT.timed("decompress", archive):
+            if not wanted:
+                break
+            if file_path in wanted:
+                wanted.discard(file_path)
+                yield file_path, f
 
-        ewnterms = []
-        for xewnterm in xewnterms.findall("./ewnterm"):
 
-            senses = [{
-                "offset": xsense.get("offset")
-            } for xsense in xewnterm.findall("./sense")]
+    @staticmethod
+    def _get_sentence_from_xsent(xsent: Element, layers=None) -> Dict:
+        records = read_xsent(xsent, DICT_BUILDERS, layers)
+        return {
+            "id": xsent.get("id"),
+            "corresp": xsent.get("corresp"),
+            "umlsterms": records.get("umlsterms", []),
+            "ewnterms": records.get("ewnterms", []),
+            "semrels": records.get("semrels", []),
+            "chunks": records.get("chunks", []),
+            "tokens": records.get("tokens", []),
+        }
+
+
+    @classmethod
+    def _get_example(cls, f, streaming_parse: bool, layers=None) -> Optional[Dict]:
+        """Returns the example for one tar member or None if it is empty."""
+        if streaming_parse:
+            # reading, parsing and record building are interleaved
+            with INSTRUMENT.stage("iterparse"):
+                parsed = iterparse_document(
+                    f,
+                    functools.partial(cls._get_sentence_from_xsent, layers=layers),
+                    encoding=NATIVE_ENCODING,
+                    layers=layers,
+                )
+            if parsed is None:
+                return None
+            xroot, sentences = parsed
+
+        else:
+            with INSTRUMENT.stage("read"):
+                content_bytes = f.read()
+            if layers is not None:
+                with INSTRUMENT.stage("strip_layers"):
+                    content_bytes = strip_layers(content_bytes, layers)
+            with INSTRUMENT.stage("decode"):
+                content_str = content_bytes.decode(NATIVE_ENCODING)
+            if content_str == "":
+                return None
 
-            ewnterm = {
-                "id": xewnterm.get("id"),
-                "from": xewnterm.get("from"),
-                "to": xewnterm.get("to"),
-                "senses": senses,
-            }
-            ewnterms.append(ewnterm)
+            with INSTRUMENT.stage("xml_parse"):
+                xroot = ET.fromstring(content_str)
+            with INSTRUMENT.stage("build_records"):
+                sentences = [
+                    cls._get_sentence_from_xsent(xsent, layers)
+                    for xsent in xroot.findall("./")
+                ]
 
-        return ewnterms
+        return {
+            "sample_id": xroot.get("id"),
+            "corresp": xroot.get("corresp"),
+            "language": xroot.get("lang"),
+            "sentences": sentences,
+        }
 
 
     @staticmethod
-    def _get_semrels_from_xsent(xsent: Element) -> List[Dict[str,str]]:
-        xsemrels = xsent.find("./semrels")
-        return [{
-            "id": xsemrel.get("id"),
-            "term1": xsemrel.get("term1"),
-            "term2": xsemrel.get("term2"),
-            "reltype": xsemrel.get("reltype"),
-        } for xsemrel in xsemrels.findall("./semrel")]
+    def _read_member(f) -> bytes:
+        with INSTRUMENT.stage("read"):
+            content_bytes = f.read()
+        INSTRUMENT.count("bytes", len(content_bytes))
+        return content_bytes
 
 
-    @staticmethod
-    def _get_chunks_from_xsent(xsent: Element) -> List[Dict[str,str]]:
-        xchunks = xsent.find("./chunks")
-        return [{
-            "id": xchunk.get("id"),
-            "to": xchunk.get("to"),
-            "from": xchunk.get("from"),
-            "type": xchunk.get("type"),
-        } for xchunk in xchunks.findall("./chunk")]
+    @classmethod
+    def _get_member_example(cls, file_path, f, streaming_parse: bool, layers=None) -> Optional[Dict]:
+        """_get_example timed as one member."""
+        with INSTRUMENT.member(file_path):
+            return cls._get_example(f, streaming_parse, layers)
 
 
-    @staticmethod
-    def _get_tokens_from_xsent(xsent: Element) -> List[Dict[str,str]]:
-        xtext = xsent.find("./text")
-        return [{
-            "id": xtoken.get("id"),
-            "pos": xtoken.get("pos"),
-            "lemma": xtoken.get("lemma"),
-            "text": xtoken.text,
-        } for xtoken in xtext.findall("./token")]
+    @classmethod
+    def _get_example_from_bytes(cls, item, streaming_parse: bool, layers=None):
+        """Worker side of parse_num_proc > 1: (file_path, bytes) -> (file_path, example)."""
+        file_path, content_bytes = item
+        return file_path, cls._get_member_example(file_path, io.BytesIO(content_bytes), streaming_parse, layers)
 
 
-    def _generate_examples(self, file_paths, split):
-        _id = 0
-        for file_path, f in file_paths:
+    @staticmethod
+    def _add_vocab_codes(example: Dict, vocabs: Vocabs) -> Dict:
+        """Add <name>_idx codes next to the repeated string values (in place)."""
+        pos, lemma = vocabs["pos"], vocabs["lemma"]
+        chunk_type, reltype = vocabs["chunk_type"], vocabs["reltype"]
+        cui, tui, preferred, msh = vocabs["cui"], vocabs["tui"], vocabs["preferred"], vocabs["msh"]
+
+        for sentence in example["sentences"]:
+            for token in sentence["tokens"]:
+                token["pos_idx"] = pos.code(token["pos"])
+                token["lemma_idx"] = lemma.code(token["lemma"])
+            for chunk in sentence["chunks"]:
+                chunk["type_idx"] = chunk_type.code(chunk["type"])
+            for umlsterm in sentence["umlsterms"]:
+                for concept in umlsterm["concepts"]:
+                    concept["cui_idx"] = cui.code(concept["cui"])
+                    concept["tui_idx"] = tui.code(concept["tui"])
+                    concept["preferred_idx"] = preferred.code(concept["preferred"])
+                    for xmsh in concept["mshs"]:
+                        xmsh["code_idx"] = msh.code(xmsh["code"])
+            for semrel in sentence["semrels"]:
+                semrel["reltype_idx"] = reltype.code(semrel["reltype"])
+        return example
+
+
+    def _generate_plain_examples(self, shard):
+        language = _CONFIGS[self.config.name][3]
+        names = None if shard["members"] is None else [name for name, in shard["members"]]
+        members = self._iter_shard_members(shard["archives"][0], names)
+        _id = shard["first_id"]
+        for file_path, f in members:
+            with INSTRUMENT.stage("read"):
+                content_bytes = f.read()
+            if content_bytes == b"":
+                print(file_path)
+                print("skipping")
+                print()
+                continue
+            INSTRUMENT.count("bytes", len(content_bytes))
+            with INSTRUMENT.stage("decode"):
+                text = content_bytes.decode(NATIVE_ENCODING)
+            example = {
+                "sample_id": file_path,
+                "prefix": PREFIX_RE.sub("", file_path),
+                "language": language,
+                "text": text,
+            }
+            # time spent by the consumer (features encoding and arrow writing)
+            with INSTRUMENT.stage("write"):
+                yield _id, example
+            _id += 1
 
-            content_bytes = f.read()
-            content_str = content_bytes.decode(NATIVE_ENCODING)
-            if content_str == "":
-                print(content_str)
+
+    def _generate_bilingual_examples(self, shard):
+        if not shard["members"]:
+            return
+        texts = []
+        for archive, names in zip(shard["archives"], zip(*shard["members"])):
+            with INSTRUMENT.stage("read"):
+                texts.append({
+                    file_path: f.read().decode(NATIVE_ENCODING)
+                    for file_path, f in self._iter_shard_members(archive, names)
+                })
+        en_texts, de_texts = texts
+        for _id, (en_name, de_name) in enumerate(shard["members"], shard["first_id"]):
+            example = {
+                "prefix": PREFIX_RE.sub("", en_name),
+                "en_sample_id": en_name,
+                "de_sample_id": de_name,
+                "en_text": en_texts[en_name],
+                "de_text": de_texts[de_name],
+            }
+            with INSTRUMENT.stage("write"):
+                yield _id, example
+
+
+    def _generate_anno_examples(self, shard, vocabs):
+        streaming_parse = self.config.streaming_parse
+        layers = self.config.layers
+        names = None if shard["members"] is None else [name for name, in shard["members"]]
+        file_paths = self._iter_shard_members(shard["archives"][0], names)
+
+        if self.config.parse_num_proc > 1:
+            # the archive is still read here, in order, one member at a time.
+            # only the decoding and xml -> example conversion is farmed out.
+            members = ((file_path, self._read_member(f)) for file_path, f in file_paths)
+            get_example = functools.partial(
+                self._get_example_from_bytes, streaming_parse=streaming_parse, layers=layers
+            )
+            examples = imap_ordered(
+                get_example, members, num_proc=self.config.parse_num_proc
+            )
+        else:
+            examples = (
+                (file_path, self._get_member_example(file_path, f, streaming_parse, layers))
+                for file_path, f in file_paths
+            )
+
+        _id = shard["first_id"]
+        for file_path, example in examples:
+
+            if example is None:
+                print(file_path)
                 print("skipping")
                 print()
                 continue
 
-            xroot = ET.fromstring(content_str)
-
-            sentences = []
-            for xsent in xroot.findall("./"):
-                sentence = {
-                    "id": xsent.get("id"),
-                    "corresp": xsent.get("corresp"),
-                    "umlsterms": self._get_umlsterms_from_xsent(xsent),
-                    "ewnterms": self._get_ewnterms_from_xsent(xsent),
-                    "semrels": self._get_semrels_from_xsent(xsent),
-                    "chunks": self._get_chunks_from_xsent(xsent),
-                    "tokens": self._get_tokens_from_xsent(xsent),
-                }
-                sentences.append(sentence)
-
-            yield _id, {
-                "sample_id": xroot.get("id"),
-                "corresp": xroot.get("corresp"),
-                "language": xroot.get("lang"),
-                "sentences": sentences,
-            },
+            if vocabs is not None:
+                with INSTRUMENT.stage("vocab_codes"):
+                    self._add_vocab_codes(example, vocabs)
+
+            INSTRUMENT.count("examples")
+            # time spent by the consumer (features encoding and arrow writing)
+            with INSTRUMENT.stage("write"):
+                yield _id, example
             _id += 1
+
+
+    def _generate_examples(self, shards, split):
+        kind = _CONFIGS[self.config.name][2]
+
+        vocabs = None
+        if self.config.vocab_path is not None and kind == "anno":
+            # codes are handed out in first seen order, so every shard has
+            # to go through one Vocabs object in order
+            if len(shards) != shards[0]["num_shards"]:
+                raise ValueError("vocab_path needs every shard in one process (num_proc=1)")
+            vocabs = Vocabs.load_or_new(self.config.vocab_path)
+
+        for shard in shards:
+            if kind == "plain":
+                yield from self._generate_plain_examples(shard)
+            elif kind == "bilingual":
+                yield from self._generate_bilingual_examples(shard)
+            else:
+                yield from self._generate_anno_examples(shard, vocabs)
+
+        if vocabs is not None:
+            vocabs.save(self.config.vocab_path)
@@ -0,0 +1,220 @@
+"""
+Character offsets of annotated tokens in the plain text abstracts
+
+The <token> elements of the V4.2 archives carry no offsets into the
+abstracts of the plain text archives. align_tokens walks an abstract and
+the token sequence of its document once, keeping a cursor into the text,
+so the whole alignment is linear in the length of the text. Whitespace is
+ignored on both sides and both are NFKC normalized (plus a few quote and
+dash foldings), a token that is not at the cursor is searched for in a
+small window ahead of it and a token that is not found there gets -1 and
+leaves the cursor where it was.
+
+Chunks, umlsterms and ewnterms get offsets through their first and last
+token (spans.document_spans), -1 if either is not aligned.
+
+    text_offsets = document_offsets(doc, text)
+    starts, ends = text_offsets["tokens"]["start"], text_offsets["tokens"]["end"]
+    text[starts[0]: ends[0]]
+
+The offsets of the whole corpus can be built in one pass over both kinds
+of archive and cached as .npy files, which are memory mapped on load,
+
+    build_offsets("text_offsets")
+    offsets = TextOffsets("text_offsets")
+    offsets.document("Arthroskopie.00130003.eng.abstr")
+
+"""
+
+from array import array
+import json
+import os
+import unicodedata
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+
+from parse import ANNO_PATHS, Document
+from plain_anno import iter_plain_anno
+from spans import SPAN_LAYERS, document_spans
+
+
+# how far past the cursor (in normalized characters) a token is looked for
+WINDOW = 64
+
+# single character foldings applied after NFKC
+_FOLD = str.maketrans({
+    "‘": "'", "’": "'", "‚": "'", "‛": "'",
+    "“": '"', "”": '"', "„": '"', "‟": '"',
+    "«": '"', "»": '"',
+    "‐": "-", "‑": "-", "‒": "-", "–": "-", "—": "-", "−": "-",
+})
+
+OFFSET_LAYERS = ("tokens",) + tuple(SPAN_LAYERS)
+
+# code points for which str.isspace() is true
+_WHITESPACE = np.array([ord(ch) for ch in map(chr, range(0x3001)) if ch.isspace()], dtype=np.uint32)
+
+
+# Alignment
+#=========================================
+
+def _normalize_char(ch: str) -> str:
+    return unicodedata.normalize("NFKC", ch).translate(_FOLD)
+
+
+def normalize_text(text: str) -> Tuple[str, np.ndarray]:
+    """text without whitespace and normalized, and for each of its characters
+    the offset in text it came from"""
+    if unicodedata.is_normalized("NFKC", text) and text.translate(_FOLD) == text:
+        # nothing changes but whitespace, so stay vectorized
+        codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+        keep = np.flatnonzero(~np.isin(codes, _WHITESPACE))
+        return "".join(text.split()), keep
+
+    chars = []
+    source = array("q")
+    for ii, ch in enumerate(text):
+        if ch.isspace():
+            continue
+        for norm_ch in _normalize_char(ch) if not ch.isascii() else ch:
+            if not norm_ch.isspace():
+                chars.append(norm_ch)
+                source.append(ii)
+    return "".join(chars), np.frombuffer(source, dtype=np.int64)
+
+
+def normalize_token(token: str) -> str:
+    return "".join(unicodedata.normalize("NFKC", token).translate(_FOLD).split())
+
+
+def align_tokens(text: str, tokens: Sequence[str], window: int = WINDOW) -> Tuple[np.ndarray, np.ndarray]:
+    """Half open character offsets of every token in text, -1 where a token is not found"""
+    norm_text, source = normalize_text(text)
+    starts = np.full(len(tokens), -1, dtype=np.int64)
+    ends = np.full(len(tokens), -1, dtype=np.int64)
+    cursor = 0
+    for ii, token in enumerate(tokens):
+        norm_token = normalize_token(token or "")
+        if not norm_token:
+            continue
+        if norm_text.startswith(norm_token, cursor):
+            found = cursor
+        else:
+            found = norm_text.find(norm_token, cursor, cursor + window + len(norm_token))
+            if found < 0:
+                continue
+        cursor = found + len(norm_token)
+        starts[ii] = source[found]
+        ends[ii] = source[cursor - 1] + 1
+    return starts, ends
+
+
+def document_offsets(doc: Document, text: str, window: int = WINDOW) -> Dict[str, Dict[str, np.ndarray]]:
+    """start / end character offsets into text for the tokens (in document
+    order) and the chunks, umlsterms and ewnterms of doc"""
+    tokens = [token.xtext for sent in doc.xsentences for token in sent.xtext]
+    token_start, token_end = align_tokens(text, tokens, window)
+    offsets = {"tokens": {"start": token_start, "end": token_end}}
+
+    for layer, spans in document_spans(doc, SPAN_LAYERS).items():
+        doc_start, doc_end = spans["doc_start"], spans["doc_end"]
+        start = np.full(len(doc_start), -1, dtype=np.int64)
+        end = np.full(len(doc_start), -1, dtype=np.int64)
+        valid = np.flatnonzero(doc_start >= 0)
+        first = token_start[doc_start[valid]]
+        last = token_end[doc_end[valid] - 1]
+        both = (first >= 0) & (last >= 0)
+        start[valid[both]] = first[both]
+        end[valid[both]] = last[both]
+        offsets[layer] = {"start": start, "end": end}
+    return offsets
+
+
+# Corpus cache
+#=========================================
+
+def build_offsets(out_dir: str, languages: Iterable[str] = tuple(ANNO_PATHS), num_proc: int = 1) -> Dict[str, int]:
+    """Align every document of the corpus to its plain text and save the offsets.
+
+    Each language is one lockstep pass over its plain and annotated archive
+    (plain_anno.iter_plain_anno). Returns counts of aligned and unaligned items.
+    """
+    documents: List[Dict] = []
+    columns = {layer: {"start": [], "end": []} for layer in OFFSET_LAYERS}
+    counts = {"documents": 0, "unmatched": 0}
+
+    for language in languages:
+        for pair in iter_plain_anno(language, num_proc=num_proc, layers=OFFSET_LAYERS):
+            if pair.problem is not None:
+                counts["unmatched"] += 1
+                continue
+            offsets = document_offsets(pair.doc, pair.text)
+            documents.append({
+                "sample_id": pair.doc.xid,
+                "plain_name": pair.plain_name,
+                "language": language,
+                "text_length": len(pair.text),
+            })
+            for layer, cols in offsets.items():
+                columns[layer]["start"].append(cols["start"].astype(np.int32))
+                columns[layer]["end"].append(cols["end"].astype(np.int32))
+                counts[f"{layer}_unaligned"] = counts.get(f"{layer}_unaligned", 0) + int((cols["start"] < 0).sum())
+                counts[layer] = counts.get(layer, 0) + len(cols["start"])
+    counts["documents"] = len(documents)
+
+    os.makedirs(out_dir, exist_ok=True)
+    for layer, cols in columns.items():
+        lengths = np.array([len(values) for values in cols["start"]], dtype=np.int64)
+        layer_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=layer_offsets[1:])
+        np.save(os.path.join(out_dir, f"{layer}_offsets.npy"), layer_offsets)
+        for name in ("start", "end"):
+            values = np.concatenate(cols[name]) if cols[name] else np.zeros(0, dtype=np.int32)
+            np.save(os.path.join(out_dir, f"{layer}_{name}.npy"), values)
+    with open(os.path.join(out_dir, "documents.json"), "w", encoding="utf-8") as fp:
+        json.dump(documents, fp)
+    return counts
+
+
+class TextOffsets:
+    """Cached offsets written by build_offsets, arrays are memory mapped"""
+
+    def __init__(self, out_dir: str):
+        with open(os.path.join(out_dir, "documents.json"), encoding="utf-8") as fp:
+            self.documents: List[Dict] = json.load(fp)
+        self.doc_rows = {document["sample_id"]: ii for ii, document in enumerate(self.documents)}
+        self.arrays = {
+            layer: {
+                name: np.load(os.path.join(out_dir, f"{layer}_{name}.npy"), mmap_mode="r")
+                for name in ("offsets", "start", "end")
+            }
+            for layer in OFFSET_LAYERS
+        }
+
+    def __len__(self):
+        return len(self.documents)
+
+    def document(self, sample_id: str) -> Dict[str, Dict[str, np.ndarray]]:
+        """Same layout as document_offsets, as views into the cached arrays.
+
+        sample_id is the document id (doc.xid), e.g. Arthroskopie.00130003.eng.abstr
+        """
+        ii = self.doc_rows[sample_id]
+        out = {}
+        for layer, arrays in self.arrays.items():
+            lo, hi = arrays["offsets"][ii], arrays["offsets"][ii + 1]
+            out[layer] = {"start": arrays["start"][lo:hi], "end": arrays["end"][lo:hi]}
+        return out
+
+
+if __name__ == "__main__":
+
+    import sys
+    import time
+
+    out_dir = sys.argv[1] if len(sys.argv) > 1 else "text_offsets"
+    t0 = time.time()
+    counts = build_offsets(out_dir)
+    print(json.dumps(counts, indent=2))
+    print(f"built {out_dir} in {time.time() - t0:.1f}s")
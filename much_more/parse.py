@@ -13,17 +13,23 @@ description of annotation format
 
 """
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from functools import partial
 import gzip
+from itertools import islice
 import os
-import re
-import tarfile
-from typing import Iterable, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 import xml.etree.ElementTree as ET
 from xml.etree.ElementTree import Element
 
 import chardet
 import pandas as pd
+import pyarrow as pa
+
+from anno import XsentBuilders, parse_document, read_xsent
+from archive import PREFIX_RE, imap_ordered, iter_members
+from instrument import INSTRUMENT
+from vocab import Vocabs
 
 
 NATIVE_ENCODING = "ISO-8859-1"
@@ -48,24 +54,134 @@ ANNO_PATHS = {
 }
 
 
-def read_plain():
+PLAIN_COLUMNS = ["prefix", "sample_id", "abstract", "language"]
+ANNO_COLUMNS = ["prefix", "sample_id", "anno_xml", "language"]
+
+# members per record batch / DataFrame in the chunked readers
+CHUNK_SIZE = 1000
+
+
+def sample_prefix(sample_id: str) -> str:
+    """Prefix shared by the en and de versions of a sample id or member name."""
+    return PREFIX_RE.sub("", sample_id)
+
+
+def iter_member_items(paths, languages=None):
+    """Yield (language, member name, member bytes) for each archive in paths."""
+    if languages is None:
+        languages = list(paths)
+    for key in languages:
+        for name, content_bytes in INSTRUMENT.timed("decompress", iter_members(paths[key])):
+            INSTRUMENT.count("members")
+            INSTRUMENT.count("bytes", len(content_bytes))
+            yield key, name, content_bytes
+
 
-    rows = []
-    for key, path in PLAIN_PATHS.items():
-        with tarfile.open(name=path, mode="r:gz") as tf:
-            for member in tf.getmembers():
-                prefix = re.sub(".(eng|ger).abstr", "", member.name)
-                language = key
-                with tf.extractfile(member) as fp:
-                    content_bytes = fp.read()
-                    content_str = content_bytes.decode(NATIVE_ENCODING)
+def plain_row(item):
+    """(language, member name, member bytes) -> (prefix, sample_id, abstract, language) row"""
+    language, name, content_bytes = item
+    prefix = PREFIX_RE.sub("", name)
+    with INSTRUMENT.stage("decode"):
+        content_str = content_bytes.decode(NATIVE_ENCODING)
+    return (prefix, name, content_str, language)
 
-                row = (prefix, member.name, content_str, language)
-                rows.append(row)
 
-    columns = ["prefix", "sample_id", "abstract", "language"]
-    df_plain = pd.DataFrame(rows, columns=columns)
-    return df_plain
+def iter_plain(num_proc=1, languages=None) -> Iterator[Tuple[str, str, str, str]]:
+    """Stream (prefix, sample_id, abstract, language) rows from the plain text archives.
+
+    With num_proc > 1 a single reader streams member bytes to a pool
+    of worker processes that do the decoding. Row order is unchanged.
+    languages limits which of the PLAIN_PATHS archives are read.
+    """
+    items = iter_member_items(PLAIN_PATHS, languages)
+    return imap_ordered(plain_row, items, num_proc=num_proc)
+
+
+def iter_plain_batches(
+    chunk_size=CHUNK_SIZE, columns=None, num_proc=1, languages=None
+) -> Iterator[pa.RecordBatch]:
+    """Stream the plain text archives as arrow record batches of chunk_size members.
+
+    columns picks a subset of PLAIN_COLUMNS, without "abstract" members are
+    not decoded at all. language is dictionary encoded. num_proc and
+    languages work as in iter_plain.
+    """
+    return _iter_record_batches(
+        PLAIN_PATHS, PLAIN_COLUMNS, plain_row, chunk_size, columns, num_proc, languages
+    )
+
+
+def iter_plain_frames(chunk_size=CHUNK_SIZE, columns=None, num_proc=1, languages=None) -> Iterator[pd.DataFrame]:
+    """iter_plain_batches as DataFrames (language is categorical)."""
+    for batch in iter_plain_batches(chunk_size, columns, num_proc, languages):
+        yield batch.to_pandas()
+
+
+def read_plain(num_proc=1, columns=None):
+    """Read the plain text archives into a DataFrame (see iter_plain_batches)."""
+    batches = iter_plain_batches(CHUNK_SIZE, columns, num_proc)
+    return _batches_to_frame(batches, _batch_schema(PLAIN_COLUMNS, columns))
+
+
+def _batch_schema(all_columns, columns=None) -> pa.Schema:
+    columns = all_columns if columns is None else columns
+    unknown = [name for name in columns if name not in all_columns]
+    if unknown:
+        raise ValueError(f"unknown columns {unknown}, expected some of {all_columns}")
+    return pa.schema([
+        (name, pa.dictionary(pa.int8(), pa.string()) if name == "language" else pa.string())
+        for name in columns
+    ])
+
+
+def _iter_record_batches(paths, all_columns, row_func, chunk_size, columns, num_proc, languages):
+    """Shared body of iter_plain_batches / iter_anno_batches.
+
+    Only chunk_size rows of python strings are alive at a time, each chunk
+    is copied into arrow buffers before the next one is read.
+    """
+    if languages is None:
+        languages = list(paths)
+    schema = _batch_schema(all_columns, columns)
+    positions = [all_columns.index(name) for name in schema.names]
+    text_column = all_columns[2]
+
+    items = iter_member_items(paths, languages)
+    if text_column in schema.names:
+        rows = imap_ordered(row_func, items, num_proc=num_proc)
+    else:
+        # nothing to decode
+        rows = ((PREFIX_RE.sub("", name), name, None, language) for language, name, _ in items)
+
+    # the same dictionary in every batch so frames concatenate as categoricals
+    dictionary = pa.array(languages, pa.string())
+    language_codes = {language: ii for ii, language in enumerate(languages)}
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        with INSTRUMENT.stage("record_batch"):
+            arrays = []
+            for name, pos in zip(schema.names, positions):
+                if name == "language":
+                    codes = pa.array([language_codes[row[pos]] for row in chunk], pa.int8())
+                    arrays.append(pa.DictionaryArray.from_arrays(codes, dictionary))
+                else:
+                    arrays.append(pa.array([row[pos] for row in chunk], pa.string()))
+            batch = pa.RecordBatch.from_arrays(arrays, schema=schema)
+        del chunk
+        yield batch
+
+
+def _batches_to_frame(batches, schema) -> pd.DataFrame:
+    """Collect record batches into one DataFrame without holding two copies.
+
+    The strings only ever exist as arrow buffers (not as one python object
+    per value) and self_destruct frees each column once it is converted.
+    """
+    table = pa.Table.from_batches(list(batches), schema=schema)
+    with INSTRUMENT.stage("dataframe"):
+        return table.to_pandas(split_blocks=True, self_destruct=True)
 
 
 def report_plain(df_plain):
@@ -82,24 +198,47 @@ def report_plain(df_plain):
     print()
 
 
-def read_anno():
+def anno_row(item):
+    """(language, member name, member bytes) -> (prefix, sample_id, anno_xml, language) row"""
+    language, name, content_bytes = item
+    prefix = PREFIX_RE.sub("", name)
+    with INSTRUMENT.stage("decode"):
+        content_str = content_bytes.decode(NATIVE_ENCODING)
+    return (prefix, name, content_str, language)
+
+
+def iter_anno(num_proc=1, languages=None) -> Iterator[Tuple[str, str, str, str]]:
+    """Stream (prefix, sample_id, anno_xml, language) rows (raw xml, not parsed).
+
+    num_proc and languages work as in iter_plain.
+    """
+    items = iter_member_items(ANNO_PATHS, languages)
+    return imap_ordered(anno_row, items, num_proc=num_proc)
+
+
+def iter_anno_batches(
+    chunk_size=CHUNK_SIZE, columns=None, num_proc=1, languages=None
+) -> Iterator[pa.RecordBatch]:
+    """Stream the annotated archives as arrow record batches of chunk_size members.
 
-    rows = []
-    for key, path in ANNO_PATHS.items():
-        with tarfile.open(name=path, mode="r:gz") as tf:
-            for member in tf.getmembers():
-                prefix = re.sub(".(eng|ger).abstr.chunkmorph.annotated.xml", "", member.name)
-                language = key
-                with tf.extractfile(member) as fp:
-                    content_bytes = fp.read()
-                    content_str = content_bytes.decode(NATIVE_ENCODING)
+    Works as iter_plain_batches, e.g. columns=["prefix", "sample_id", "language"]
+    lists the members without decoding any xml.
+    """
+    return _iter_record_batches(
+        ANNO_PATHS, ANNO_COLUMNS, anno_row, chunk_size, columns, num_proc, languages
+    )
+
+
+def iter_anno_frames(chunk_size=CHUNK_SIZE, columns=None, num_proc=1, languages=None) -> Iterator[pd.DataFrame]:
+    """iter_anno_batches as DataFrames (language is categorical)."""
+    for batch in iter_anno_batches(chunk_size, columns, num_proc, languages):
+        yield batch.to_pandas()
 
-                row = (prefix, member.name, content_str, language)
-                rows.append(row)
 
-    columns = ["prefix", "sample_id", "anno_xml", "language"]
-    df_anno = pd.DataFrame(rows, columns=columns)
-    return df_anno
+def read_anno(num_proc=1, columns=None):
+    """Read the annotated archives into a DataFrame (see iter_anno_batches)."""
+    batches = iter_anno_batches(CHUNK_SIZE, columns, num_proc)
+    return _batches_to_frame(batches, _batch_schema(ANNO_COLUMNS, columns))
 
 
 def report_anno(df_anno):
@@ -117,16 +256,6 @@ def report_anno(df_anno):
 
 
 
-# Read raw data from tar files
-#=========================================
-df_plain = read_plain()
-report_plain(df_plain)
-df_anno = read_anno()
-report_anno(df_anno)
-
-sys.exit(1)
-
-
 # UmlsTerms
 #=========================================
 
@@ -207,6 +336,12 @@ class Sentence:
     xsemrels: Tuple[SemRel,...]
     xchunks: Tuple[Chunk,...]
     xtext: Tuple[Token,...]
+    # token id -> position in xtext, used to resolve from/to spans
+    token_index: Optional[Dict[str, int]] = field(default=None, compare=False, repr=False)
+
+    def __post_init__(self):
+        if self.token_index is None:
+            self.token_index = {token.xid: ii for ii, token in enumerate(self.xtext)}
 
 # Documents
 #=========================================
@@ -220,151 +355,210 @@ class Document:
     xsentences: Tuple[Sentence,...]
 
 
-def get_umlsterms_from_xsent(xsent: Element) -> Tuple[UmlsTerm,...]:
-    xumlsterms = xsent.find("./umlsterms")
-
-    umlsterms = []
-    for xumlsterm in xumlsterms.findall("./umlsterm"):
-
-        concepts = []
-        for xconcept in xumlsterm.findall("./concept"):
-
-            mshs = []
-            for xmsh in xconcept.findall("./msh"):
-                msh = Msh(xcode=xmsh.get("code"))
-                mshs.append(msh)
-
-            concept = Concept(
-                xid=xconcept.get("id"),
-                xcui=xconcept.get("cui"),
-                xpreferred=xconcept.get("preferred"),
-                xtui=xconcept.get("tui"),
-                xmshs=tuple(mshs),
-            )
-            concepts.append(concept)
-
-        umlsterm = UmlsTerm(
-            xid=xumlsterm.get("id"),
-            xfrom=xumlsterm.get("from"),
-            xto=xumlsterm.get("to"),
-            xconcepts=tuple(concepts),
-        )
-        umlsterms.append(umlsterm)
-
-    return tuple(umlsterms)
-
-
-def get_xrceterms_from_xsent(xsent: Element) -> Tuple:
-    xrceterms = xsent.find("./xrceterms")
-    assert(len(xrceterms.findall("./"))==0)
-
-
-def get_ewnterms_from_xsent(xsent: Element) -> Tuple[EwnTerm,...]:
-    xewnterms = xsent.find("./ewnterms")
+# Single pass over each sentence
+#=========================================
 
-    ewnterms = []
-    for xewnterm in xewnterms.findall("./ewnterm"):
+XSENT_BUILDERS = XsentBuilders(
+    msh=lambda xmsh: Msh(xcode=xmsh.get("code")),
+    concept=lambda xconcept, mshs: Concept(
+        xid=xconcept.get("id"),
+        xcui=xconcept.get("cui"),
+        xpreferred=xconcept.get("preferred"),
+        xtui=xconcept.get("tui"),
+        xmshs=tuple(mshs),
+    ),
+    umlsterm=lambda xumlsterm, concepts: UmlsTerm(
+        xid=xumlsterm.get("id"),
+        xfrom=xumlsterm.get("from"),
+        xto=xumlsterm.get("to"),
+        xconcepts=tuple(concepts),
+    ),
+    sense=lambda xsense: Sense(xoffset=xsense.get("offset")),
+    ewnterm=lambda xewnterm, senses: EwnTerm(
+        xid=xewnterm.get("id"),
+        xfrom=xewnterm.get("from"),
+        xto=xewnterm.get("to"),
+        xsenses=tuple(senses),
+    ),
+    semrel=lambda xsemrel: SemRel(
+        xid=xsemrel.get("id"),
+        xterm1=xsemrel.get("term1"),
+        xterm2=xsemrel.get("term2"),
+        xreltype=xsemrel.get("reltype"),
+    ),
+    chunk=lambda xchunk: Chunk(
+        xid=xchunk.get("id"),
+        xfrom=xchunk.get("from"),
+        xto=xchunk.get("to"),
+        xtype=xchunk.get("type"),
+    ),
+    token=lambda xtoken: Token(
+        xid=xtoken.get("id"),
+        xpos=xtoken.get("pos"),
+        xlemma=xtoken.get("lemma"),
+        xtext=xtoken.text,
+    ),
+)
 
-        senses = []
-        for xsense in xewnterm.findall("./sense"):
 
-            sense = Sense(
-                xoffset=xsense.get("offset"),
-            )
-            senses.append(sense)
+def get_sentence_from_xsent(xsent: Element, layers: Optional[Iterable[str]] = None) -> Sentence:
+    """Sentence with the given layers (all when None), the others are left empty"""
+    records = read_xsent(xsent, XSENT_BUILDERS, layers)
+    return Sentence(
+        xid=xsent.get("id"),
+        xcorresp=xsent.get("corresp"),
+        xumlsterms=tuple(records.get("umlsterms", ())),
+        xewnterms=tuple(records.get("ewnterms", ())),
+        xsemrels=tuple(records.get("semrels", ())),
+        xchunks=tuple(records.get("chunks", ())),
+        xtext=tuple(records.get("tokens", ())),
+    )
 
-        ewnterm = EwnTerm(
-            xid=xewnterm.get("id"),
-            xfrom=xewnterm.get("from"),
-            xto=xewnterm.get("to"),
-            xsenses=tuple(senses),
-        )
-        ewnterms.append(ewnterm)
-
-    return tuple(ewnterms)
-
-
-def get_semrels_from_xsent(xsent: Element) -> Tuple[SemRel,...]:
-    xsemrels = xsent.find("./semrels")
-    semrels = [
-        SemRel(
-            xid=xsemrel.get("id"),
-            xterm1=xsemrel.get("term1"),
-            xterm2=xsemrel.get("term2"),
-            xreltype=xsemrel.get("reltype"),
-        ) for xsemrel in xsemrels.findall("./semrel")
-    ]
-    return tuple(semrels)
-
-
-def get_chunks_from_xsent(xsent: Element) -> Tuple[Chunk,...]:
-    xchunks = xsent.find("./chunks")
-    chunks = [
-        Chunk(
-            xid=xchunk.get("id"),
-            xfrom=xchunk.get("from"),
-            xto=xchunk.get("to"),
-            xtype=xchunk.get("type"),
-        ) for xchunk in xchunks.findall("./chunk")
-    ]
-    return tuple(chunks)
-
-
-def get_text_from_xsent(xsent: Element) -> Tuple[Token,...]:
-    xtext = xsent.find("./text")
-    tokens = [
-        Token(
-            xid=xtoken.get("id"),
-            xpos=xtoken.get("pos"),
-            xlemma=xtoken.get("lemma"),
-            xtext=xtoken.text,
-        ) for xtoken in xtext.findall("./token")
-    ]
-    return tuple(tokens)
-
-
-#sample_id = "Arthroskopie.00130003.eng.abstr.chunkmorph.annotated.xml"
-#xml_str = df_anno[df_anno['sample_id']==sample_id].iloc[0]['anno_xml']
-#xroot = ET.fromstring(xml_str)
-
-docs = []
-#for indx, row in df_anno.head(1).iterrows():
-for indx, row in df_anno.iterrows():
-
-    if row["anno_xml"] == "":
-        print(row)
-        print("skipping")
-        print()
-        continue
-
-    xroot = ET.fromstring(row["anno_xml"])
-
-    sents = []
-    for xsent in xroot.findall("./"):
-
-        umlsterms = get_umlsterms_from_xsent(xsent)
-        get_xrceterms_from_xsent(xsent)
-        ewnterms = get_ewnterms_from_xsent(xsent)
-        semrels = get_semrels_from_xsent(xsent)
-        chunks = get_chunks_from_xsent(xsent)
-        text = get_text_from_xsent(xsent)
-
-        sent = Sentence(
-            xid=xsent.get("id"),
-            xcorresp=xsent.get("corresp"),
-            xumlsterms=umlsterms,
-            xewnterms=ewnterms,
-            xsemrels=semrels,
-            xchunks=chunks,
-            xtext=text,
-        )
-        sents.append(sent)
 
-    doc = Document(
+def get_document_from_xroot(xroot: Element, layers: Optional[Iterable[str]] = None) -> Document:
+    sents = [get_sentence_from_xsent(xsent, layers) for xsent in xroot.findall("./")]
+    return Document(
         xid=xroot.get("id"),
         xtype=xroot.get("type"),
         xlang=xroot.get("lang"),
         xcorresp=xroot.get("corresp"),
         xsentences=sents,
     )
-    docs.append(doc)
+
+
+def read_docs(df_anno) -> List[Document]:
+    docs = []
+    for indx, row in df_anno.iterrows():
+
+        if row["anno_xml"] == "":
+            print(row)
+            print("skipping")
+            print()
+            continue
+
+        with INSTRUMENT.member(row["sample_id"]):
+            with INSTRUMENT.stage("xml_parse"):
+                xroot = ET.fromstring(row["anno_xml"])
+            with INSTRUMENT.stage("build_records"):
+                docs.append(get_document_from_xroot(xroot))
+
+    return docs
+
+
+def intern_document(doc: Document, vocabs: Vocabs) -> Document:
+    """Swap repeated annotation values in doc for the canonical strings in vocabs.
+
+    Every distinct pos, lemma, chunk type, cui, tui, preferred name, MeSH
+    code and relation type is then held once in memory and gets a stable
+    code, e.g. vocabs["pos"].code(token.xpos). Modifies doc in place.
+    """
+    pos, lemma = vocabs["pos"], vocabs["lemma"]
+    chunk_type, reltype = vocabs["chunk_type"], vocabs["reltype"]
+    cui, tui, preferred, msh = vocabs["cui"], vocabs["tui"], vocabs["preferred"], vocabs["msh"]
+
+    for sent in doc.xsentences:
+        for token in sent.xtext:
+            token.xpos = pos.intern(token.xpos)
+            token.xlemma = lemma.intern(token.xlemma)
+        for chunk in sent.xchunks:
+            chunk.xtype = chunk_type.intern(chunk.xtype)
+        for umlsterm in sent.xumlsterms:
+            for concept in umlsterm.xconcepts:
+                concept.xcui = cui.intern(concept.xcui)
+                concept.xtui = tui.intern(concept.xtui)
+                concept.xpreferred = preferred.intern(concept.xpreferred)
+                for xmsh in concept.xmshs:
+                    xmsh.xcode = msh.intern(xmsh.xcode)
+        for semrel in sent.xsemrels:
+            semrel.xreltype = reltype.intern(semrel.xreltype)
+    return doc
+
+
+def doc_from_item(item, layers=None) -> Tuple[str, Optional[Document]]:
+    """(language, member name, member bytes) -> (member name, Document or None if empty)
+
+    Runs in the worker processes of iter_docs. layers works as in iter_docs.
+    """
+    language, name, content_bytes = item
+    with INSTRUMENT.member(name):
+        return name, _parse_doc(content_bytes, layers)
+
+
+def _parse_doc(content_bytes, layers) -> Optional[Document]:
+    if layers is not None:
+        # only build the elements of the wanted layers. strip, parse and
+        # record building are interleaved here so it is one stage
+        with INSTRUMENT.stage("parse_document"):
+            parsed = parse_document(
+                content_bytes,
+                lambda xsent: get_sentence_from_xsent(xsent, layers),
+                NATIVE_ENCODING,
+                layers=layers,
+            )
+        if parsed is None:
+            return None
+        xroot, sents = parsed
+        return Document(
+            xid=xroot.get("id"),
+            xtype=xroot.get("type"),
+            xlang=xroot.get("lang"),
+            xcorresp=xroot.get("corresp"),
+            xsentences=sents,
+        )
+
+    with INSTRUMENT.stage("decode"):
+        content_str = content_bytes.decode(NATIVE_ENCODING)
+    if content_str == "":
+        return None
+    with INSTRUMENT.stage("xml_parse"):
+        xroot = ET.fromstring(content_str)
+    with INSTRUMENT.stage("build_records"):
+        return get_document_from_xroot(xroot)
+
+
+def iter_docs(num_proc=1, max_pending=None, vocabs=None, languages=None, layers=None) -> Iterator[Document]:
+    """Parse Documents straight from the annotated archives.
+
+    A single reader streams raw member bytes out of the tar.gz files and
+    num_proc worker processes decode and convert them. Documents come out
+    in archive order and at most max_pending batches of members are in flight.
+    If vocabs is given each document is passed through intern_document
+    (in this process, so codes follow archive order).
+    languages limits which of the ANNO_PATHS archives are read.
+    layers (e.g. ["tokens"]) limits which annotation layers are parsed,
+    the xml of the others is skipped and they are left empty.
+    """
+    items = iter_member_items(ANNO_PATHS, languages)
+    convert = doc_from_item if layers is None else partial(doc_from_item, layers=tuple(layers))
+    for name, doc in imap_ordered(
+        convert, items, num_proc=num_proc, max_pending=max_pending
+    ):
+        if doc is None:
+            print(name)
+            print("skipping")
+            print()
+            continue
+        if vocabs is not None:
+            with INSTRUMENT.stage("intern"):
+                intern_document(doc, vocabs)
+        if INSTRUMENT.enabled:
+            INSTRUMENT.count("documents")
+            INSTRUMENT.count("sentences", len(doc.xsentences))
+            INSTRUMENT.count("tokens", sum(len(sent.xtext) for sent in doc.xsentences))
+        yield doc
+
+
+if __name__ == "__main__":
+
+    # Read raw data from tar files
+    #=========================================
+    df_plain = read_plain()
+    report_plain(df_plain)
+    df_anno = read_anno()
+    report_anno(df_anno)
+
+    #sample_id = "Arthroskopie.00130003.eng.abstr.chunkmorph.annotated.xml"
+    #xml_str = df_anno[df_anno['sample_id']==sample_id].iloc[0]['anno_xml']
+    #xroot = ET.fromstring(xml_str)
+
+    docs = read_docs(df_anno)
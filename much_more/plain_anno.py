@@ -0,0 +1,106 @@
+"""
+Plain text / annotation pairing for one language of MuchMore
+
+Every abstract in a plain text archive has its annotated version in the
+V4.2 archive of the same language. Instead of reading both archives into
+DataFrames and merging them, the two tar.gz files are streamed side by
+side and members are matched on prefix (bilingual.join_on_prefix) with a
+small reorder buffer, so memory stays constant however large the corpus,
+
+    for pair in iter_plain_anno("en", layers=["tokens"]):
+        if pair.problem is not None:
+            continue  # e.g. the empty Arthroskopie.00130237.eng annotation
+        text, doc = pair.text, pair.doc
+
+Unmatched items are not dropped, they come out with a problem set
+("no annotation", "no plain text" or "empty annotation"). Items given up
+after waiting for max_waiting others have "evicted" instead, as does
+their partner if it turns up later.
+
+"""
+
+from functools import partial
+from typing import Iterable, Iterator, NamedTuple, Optional
+
+from archive import imap_ordered
+from bilingual import join_on_prefix
+from parse import ANNO_PATHS, Document, doc_from_item, iter_member_items, iter_plain, sample_prefix
+
+
+# unmatched items each side may hold while waiting for their partner
+MAX_WAITING = 64
+
+
+class PlainAnnoPair(NamedTuple):
+    prefix: str
+    plain_name: Optional[str]
+    text: Optional[str]
+    anno_name: Optional[str]
+    doc: Optional[Document]
+    evicted: bool = False
+
+    @property
+    def problem(self) -> Optional[str]:
+        """None for a good pair, otherwise why it is incomplete"""
+        if self.evicted:
+            return "evicted"
+        if self.plain_name is None:
+            return "no plain text"
+        if self.anno_name is None:
+            return "no annotation"
+        if self.doc is None:
+            return "empty annotation"
+        return None
+
+
+def iter_plain_anno(
+    language: str,
+    num_proc: int = 1,
+    layers: Optional[Iterable[str]] = None,
+    max_waiting: int = MAX_WAITING,
+) -> Iterator[PlainAnnoPair]:
+    """Stream (plain text, parsed annotation) pairs of one language.
+
+    Both archives are read in lockstep. num_proc worker processes parse
+    the annotations and layers limits which layers are parsed (as in
+    iter_docs). An item that waits for its partner longer than max_waiting
+    other items is given up and reported as evicted (see join_on_prefix).
+    """
+    plain = (
+        (prefix, (name, text)) for prefix, name, text, _ in iter_plain(languages=[language])
+    )
+    convert = doc_from_item if layers is None else partial(doc_from_item, layers=tuple(layers))
+    items = iter_member_items(ANNO_PATHS, [language])
+    anno = (
+        (sample_prefix(name), (name, doc))
+        for name, doc in imap_ordered(convert, items, num_proc=num_proc)
+    )
+    evicted = set()
+    for prefix, plain_item, anno_item in join_on_prefix(plain, anno, max_waiting, evicted):
+        plain_name, text = (None, None) if plain_item is None else plain_item
+        anno_name, doc = (None, None) if anno_item is None else anno_item
+        unmatched = plain_item is None or anno_item is None
+        yield PlainAnnoPair(prefix, plain_name, text, anno_name, doc, unmatched and prefix in evicted)
+
+
+def report_plain_anno(pairs: Iterable[PlainAnnoPair]):
+    matched = 0
+    unmatched = []
+    for pair in pairs:
+        if pair.problem is None:
+            matched += 1
+        else:
+            unmatched.append(pair)
+
+    print('total matched plain/anno pairs: ', matched)
+    print('unmatched: ', len(unmatched))
+    for pair in unmatched:
+        print(f'  {pair.prefix}: {pair.problem} ({pair.plain_name or pair.anno_name})')
+    print()
+
+
+if __name__ == "__main__":
+
+    for language in ANNO_PATHS:
+        print(language)
+        report_plain_anno(iter_plain_anno(language, layers=["tokens"]))
@@ -0,0 +1,242 @@
+"""
+Corpus wide graph of semantic relations between UMLS concepts
+
+Each <semrel> links two umlsterms of a sentence (term1, term2 are
+sentence local umlsterm ids). Here the term ids are resolved to the CUIs
+of their concepts and every semrel becomes one directed edge
+cui(term1) -> cui(term2) per pair of concepts of the two terms.
+
+Edges are stored in compressed sparse row (CSR) form sorted by source
+node. Alongside the target of each edge there is its integer relation
+type and provenance (document row, sentence position and position of the
+semrel in the sentence). A second permutation of the edges sorted by
+target gives incoming edges. Nodes and relation types are coded with the
+"cui" and "reltype" vocabs (vocab.py).
+
+    build_graph(iter_docs(), "semgraph")
+    graph = SemanticGraph("semgraph")
+    graph.neighbors("C0022742")
+    graph.degree("C0022742", direction="in")
+    graph.k_hop("C0022742", 2)
+
+"""
+
+from array import array
+import json
+import os
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from parse import Document, iter_docs
+from vocab import Vocabs
+
+
+GRAPH_FIELDS = ("cui", "reltype")
+
+EDGE_COLUMNS = ("src", "dst", "reltype", "doc", "sentence", "semrel")
+
+DIRECTIONS = ("out", "in", "both")
+
+
+def build_graph(docs: Iterable[Document], out_dir: str, vocabs: Optional[Vocabs] = None) -> Dict[str, int]:
+    """Build and save the graph in one pass over docs. Returns node, edge and skip counts."""
+    if vocabs is None:
+        vocabs = Vocabs.new(GRAPH_FIELDS)
+    cui_vocab = vocabs["cui"]
+    reltype_vocab = vocabs["reltype"]
+    edges = {name: array("i") for name in EDGE_COLUMNS}
+    sample_ids = []
+    skipped = 0
+
+    for doc_row, doc in enumerate(docs):
+        sample_ids.append(doc.xid)
+        for ss, sent in enumerate(doc.xsentences):
+            if not sent.xsemrels:
+                continue
+            # concepts without a cui code to -1, they are no node
+            term_cuis = {
+                umlsterm.xid: [
+                    code for code in (cui_vocab.code(concept.xcui) for concept in umlsterm.xconcepts)
+                    if code >= 0
+                ]
+                for umlsterm in sent.xumlsterms
+            }
+            for rr, semrel in enumerate(sent.xsemrels):
+                srcs = term_cuis.get(semrel.xterm1)
+                dsts = term_cuis.get(semrel.xterm2)
+                if not srcs or not dsts:
+                    skipped += 1
+                    continue
+                reltype = reltype_vocab.code(semrel.xreltype)
+                for src in srcs:
+                    for dst in dsts:
+                        edges["src"].append(src)
+                        edges["dst"].append(dst)
+                        edges["reltype"].append(reltype)
+                        edges["doc"].append(doc_row)
+                        edges["sentence"].append(ss)
+                        edges["semrel"].append(rr)
+
+    num_nodes = len(cui_vocab)
+    columns = {name: np.frombuffer(values, dtype=np.int32) for name, values in edges.items()}
+    order = np.argsort(columns["src"], kind="stable")
+    columns = {name: values[order] for name, values in columns.items()}
+
+    os.makedirs(out_dir, exist_ok=True)
+    for name, values in columns.items():
+        np.save(os.path.join(out_dir, f"{name}.npy"), values)
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(columns["src"], minlength=num_nodes), out=indptr[1:])
+    np.save(os.path.join(out_dir, "indptr.npy"), indptr)
+    in_edges = np.argsort(columns["dst"], kind="stable").astype(np.int64)
+    in_indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(columns["dst"], minlength=num_nodes), out=in_indptr[1:])
+    np.save(os.path.join(out_dir, "in_edges.npy"), in_edges)
+    np.save(os.path.join(out_dir, "in_indptr.npy"), in_indptr)
+
+    vocabs.save(out_dir, fields=GRAPH_FIELDS)
+    with open(os.path.join(out_dir, "documents.json"), "w", encoding="utf-8") as fp:
+        json.dump(sample_ids, fp)
+
+    return {"nodes": num_nodes, "edges": len(order), "skipped_semrels": skipped}
+
+
+class SemanticGraph:
+    """Read side of a saved graph (see module docstring). Arrays are memory mapped."""
+
+    def __init__(self, graph_dir: str, mmap_mode: Optional[str] = "r"):
+        def load(name):
+            return np.load(os.path.join(graph_dir, f"{name}.npy"), mmap_mode=mmap_mode)
+
+        self.edges = {name: load(name) for name in EDGE_COLUMNS}
+        self.indptr = load("indptr")
+        self.in_indptr = load("in_indptr")
+        self.in_edges = load("in_edges")
+        self.vocabs = Vocabs.load(graph_dir)
+        with open(os.path.join(graph_dir, "documents.json"), encoding="utf-8") as fp:
+            self.sample_ids: List[str] = json.load(fp)
+
+    @property
+    def num_nodes(self) -> int:
+        return len(self.indptr) - 1
+
+    @property
+    def num_edges(self) -> int:
+        return len(self.edges["src"])
+
+    def node(self, cui: str) -> int:
+        """Node code of a cui, KeyError if the cui is not in the vocab.
+
+        With a shared corpus vocabs a cui can have a node but no edges (degree 0).
+        """
+        return self.vocabs["cui"].codes[cui]
+
+    def cuis(self, nodes: Iterable[int]) -> List[str]:
+        strings = self.vocabs["cui"].strings
+        return [strings[node] for node in nodes]
+
+    def edge_ids(self, cui: str, direction: str = "out") -> np.ndarray:
+        """Ids (rows of self.edges) of the edges leaving / entering / touching cui"""
+        node = self.node(cui)
+        out_ids = np.arange(self.indptr[node], self.indptr[node + 1])
+        if direction == "out":
+            return out_ids
+        in_ids = np.asarray(self.in_edges[self.in_indptr[node]: self.in_indptr[node + 1]])
+        if direction == "in":
+            return in_ids
+        if direction == "both":
+            return np.union1d(out_ids, in_ids)
+        raise ValueError(f"direction must be one of {DIRECTIONS}, got {direction!r}")
+
+    def neighbors(self, cui: str, direction: str = "out", reltype: Optional[str] = None) -> List[str]:
+        """Distinct neighboring cuis, optionally only over edges of one relation type"""
+        ids = self.edge_ids(cui, direction)
+        if reltype is not None:
+            code = self.vocabs["reltype"].codes.get(reltype, -1)
+            ids = ids[self.edges["reltype"][ids] == code]
+        node = self.node(cui)
+        src = self.edges["src"][ids]
+        dst = self.edges["dst"][ids]
+        # the other end of each edge (self loops point back at cui)
+        other = np.where(src == node, dst, src)
+        return self.cuis(np.unique(other))
+
+    def degree(self, cui: str, direction: str = "out") -> int:
+        """Number of edges (not distinct neighbors) leaving / entering / touching cui"""
+        node = self.node(cui)
+        out_degree = int(self.indptr[node + 1] - self.indptr[node])
+        in_degree = int(self.in_indptr[node + 1] - self.in_indptr[node])
+        if direction == "out":
+            return out_degree
+        if direction == "in":
+            return in_degree
+        if direction == "both":
+            return out_degree + in_degree
+        raise ValueError(f"direction must be one of {DIRECTIONS}, got {direction!r}")
+
+    def degrees(self, direction: str = "out") -> np.ndarray:
+        """Degree of every node, indexed by node code"""
+        if direction == "out":
+            return np.diff(self.indptr)
+        if direction == "in":
+            return np.diff(self.in_indptr)
+        if direction == "both":
+            return np.diff(self.indptr) + np.diff(self.in_indptr)
+        raise ValueError(f"direction must be one of {DIRECTIONS}, got {direction!r}")
+
+    def _expand(self, frontier: np.ndarray, direction: str) -> np.ndarray:
+        parts = []
+        if direction in ("out", "both"):
+            parts.extend(
+                self.edges["dst"][self.indptr[node]: self.indptr[node + 1]] for node in frontier
+            )
+        if direction in ("in", "both"):
+            parts.extend(
+                self.edges["src"][self.in_edges[self.in_indptr[node]: self.in_indptr[node + 1]]]
+                for node in frontier
+            )
+        if not parts:
+            return np.zeros(0, dtype=np.int32)
+        return np.unique(np.concatenate(parts))
+
+    def k_hop(self, cui: str, k: int, direction: str = "out") -> List[str]:
+        """Cuis reachable from cui in 1 to k hops (cui itself excluded)"""
+        if direction not in DIRECTIONS:
+            raise ValueError(f"direction must be one of {DIRECTIONS}, got {direction!r}")
+        start = self.node(cui)
+        seen = np.zeros(self.num_nodes, dtype=bool)
+        seen[start] = True
+        frontier = np.array([start])
+        for _ in range(k):
+            reached = self._expand(frontier, direction)
+            frontier = reached[~seen[reached]]
+            if len(frontier) == 0:
+                break
+            seen[frontier] = True
+        seen[start] = False
+        return self.cuis(np.flatnonzero(seen))
+
+    def provenance(self, edge_ids: np.ndarray) -> List[Dict]:
+        """Where each edge was read from: sample id, sentence position and semrel position"""
+        return [
+            {
+                "sample_id": self.sample_ids[self.edges["doc"][ii]],
+                "sentence": int(self.edges["sentence"][ii]),
+                "semrel": int(self.edges["semrel"][ii]),
+                "reltype": self.vocabs["reltype"].string(int(self.edges["reltype"][ii])),
+            }
+            for ii in edge_ids
+        ]
+
+
+if __name__ == "__main__":
+
+    import sys
+
+    out_dir = sys.argv[1] if len(sys.argv) > 1 else "much_more_semgraph"
+    print(build_graph(iter_docs(), out_dir))
+    graph = SemanticGraph(out_dir)
+    top = np.argsort(-graph.degrees("both"), kind="stable")[:5]
+    for cui in graph.cuis(top):
+        print(cui, graph.degree(cui, "both"), graph.neighbors(cui, "both")[:10])
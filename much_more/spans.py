@@ -0,0 +1,130 @@
+"""
+Batched resolution of token id spans to positions and character offsets
+
+Chunks, umlsterms and ewnterms point at tokens by id (from="w2" to="w4",
+both inclusive). `document_spans` resolves every span layer of a
+Document in one call using the token_index each Sentence builds when it
+is parsed, and returns integer numpy arrays per layer,
+
+* sentence: position of the sentence in the document
+* start, end: half open token positions within the sentence
+* doc_start, doc_end: half open token positions within the document
+* char_start, char_end: half open character offsets into sentence_text(sent)
+
+Spans whose from/to ids are not tokens of the sentence get -1 everywhere
+except in sentence.
+
+    spans = document_spans(doc)
+    chunks = spans["chunks"]
+    for ss, start, end in zip(chunks["sentence"], chunks["start"], chunks["end"]):
+        tokens = doc.xsentences[ss].xtext[start:end]
+
+"""
+
+from array import array
+from typing import Dict, Iterable, Tuple
+
+import numpy as np
+
+from parse import Document, Sentence
+
+
+# layer name -> Sentence attribute
+SPAN_LAYERS = {
+    "chunks": "xchunks",
+    "umlsterms": "xumlsterms",
+    "ewnterms": "xewnterms",
+}
+
+SPAN_COLUMNS = ("sentence", "start", "end", "doc_start", "doc_end", "char_start", "char_end")
+
+TOKEN_SEPARATOR = " "
+
+
+def sentence_text(sent: Sentence) -> str:
+    """Sentence text rebuilt from its tokens, joined by TOKEN_SEPARATOR"""
+    return TOKEN_SEPARATOR.join(token.xtext or "" for token in sent.xtext)
+
+
+def token_char_offsets(sent: Sentence) -> Tuple[np.ndarray, np.ndarray]:
+    """Half open (start, end) character offsets of every token in sentence_text(sent)"""
+    lengths = np.fromiter(
+        (len(token.xtext or "") for token in sent.xtext), dtype=np.int64, count=len(sent.xtext)
+    )
+    ends = np.cumsum(lengths + len(TOKEN_SEPARATOR)) - len(TOKEN_SEPARATOR)
+    return ends - lengths, ends
+
+
+def document_spans(
+    doc: Document,
+    layers: Iterable[str] = tuple(SPAN_LAYERS),
+) -> Dict[str, Dict[str, np.ndarray]]:
+    """Resolve every span of the given layers of doc (see module docstring)"""
+    layers = list(layers)
+    raw = {layer: {"sentence": array("i"), "start": array("i"), "end": array("i")} for layer in layers}
+    token_base = array("q", [0])
+    char_starts, char_ends = [], []
+
+    for ss, sent in enumerate(doc.xsentences):
+        token_index = sent.token_index
+        for layer in layers:
+            cols = raw[layer]
+            for span in getattr(sent, SPAN_LAYERS[layer]):
+                start = token_index.get(span.xfrom, -1)
+                end = token_index.get(span.xto, -1)
+                if start < 0 or end < 0:
+                    start = end = -1
+                else:
+                    end += 1
+                cols["sentence"].append(ss)
+                cols["start"].append(start)
+                cols["end"].append(end)
+        token_base.append(token_base[-1] + len(sent.xtext))
+        starts, ends = token_char_offsets(sent)
+        char_starts.append(starts)
+        char_ends.append(ends)
+
+    token_base = np.frombuffer(token_base, dtype=np.int64)
+    # per token character offsets for the whole document, indexed by doc position
+    char_starts = np.concatenate(char_starts) if char_starts else np.zeros(0, dtype=np.int64)
+    char_ends = np.concatenate(char_ends) if char_ends else np.zeros(0, dtype=np.int64)
+
+    spans = {}
+    for layer in layers:
+        sentence = np.frombuffer(raw[layer]["sentence"], dtype=np.int32).astype(np.int64)
+        start = np.frombuffer(raw[layer]["start"], dtype=np.int32).astype(np.int64)
+        end = np.frombuffer(raw[layer]["end"], dtype=np.int32).astype(np.int64)
+        valid = start >= 0
+        base = token_base[sentence]
+        doc_start = np.where(valid, base + start, -1)
+        doc_end = np.where(valid, base + end, -1)
+        char_start = np.full(len(start), -1, dtype=np.int64)
+        char_end = np.full(len(start), -1, dtype=np.int64)
+        char_start[valid] = char_starts[doc_start[valid]]
+        char_end[valid] = char_ends[doc_end[valid] - 1]
+        spans[layer] = {
+            "sentence": sentence,
+            "start": start,
+            "end": end,
+            "doc_start": doc_start,
+            "doc_end": doc_end,
+            "char_start": char_start,
+            "char_end": char_end,
+        }
+    return spans
+
+
+if __name__ == "__main__":
+
+    import time
+
+    from parse import iter_docs
+
+    t0 = time.time()
+    num_docs = 0
+    num_spans = 0
+    for doc in iter_docs():
+        spans = document_spans(doc)
+        num_docs += 1
+        num_spans += sum(len(cols["start"]) for cols in spans.values())
+    print(f"{num_spans} spans in {num_docs} documents in {time.time() - t0:.1f}s")
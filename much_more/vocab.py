@@ -0,0 +1,108 @@
+"""
+Corpus wide vocabularies for repeated annotation values
+
+POS tags, lemmas, chunk types, CUIs, TUIs, preferred names, MeSH codes
+and relation types repeat enormously across the corpus. A Vocab assigns
+each distinct string a dense integer code (in first seen order) and hands
+back one canonical string object for every occurrence. Vocabs are saved
+as json and codes stay stable when a saved vocab is loaded and extended.
+
+Shared by parse.py and the muchmore.py dataset script so this module
+should only depend on the standard library and must not import any of
+its siblings.
+
+"""
+
+import json
+import os
+from typing import Dict, Iterable, List, Optional
+
+
+VOCAB_FIELDS = (
+    "pos",
+    "lemma",
+    "chunk_type",
+    "cui",
+    "tui",
+    "preferred",
+    "msh",
+    "reltype",
+)
+
+VOCAB_FILENAME = "vocabs.json"
+
+
+class Vocab:
+    """Maps strings to dense integer codes and back. None is coded as -1."""
+
+    def __init__(self, strings: Iterable[str] = ()):
+        self.strings: List[str] = []
+        self.codes: Dict[str, int] = {}
+        for string in strings:
+            self.code(string)
+
+    def code(self, string: Optional[str]) -> int:
+        """Code for string, adding it if it is new"""
+        if string is None:
+            return -1
+        code = self.codes.get(string)
+        if code is None:
+            code = len(self.strings)
+            self.codes[string] = code
+            self.strings.append(string)
+        return code
+
+    def intern(self, string: Optional[str]) -> Optional[str]:
+        """The canonical copy of string, adding it if it is new"""
+        if string is None:
+            return None
+        return self.strings[self.code(string)]
+
+    def string(self, code: int) -> Optional[str]:
+        if code == -1:
+            return None
+        return self.strings[code]
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __contains__(self, string):
+        return string in self.codes
+
+
+class Vocabs(dict):
+    """field name -> Vocab. Unknown fields get an empty Vocab on first access."""
+
+    def __missing__(self, field):
+        vocab = self[field] = Vocab()
+        return vocab
+
+    @classmethod
+    def new(cls, fields: Iterable[str] = VOCAB_FIELDS) -> "Vocabs":
+        return cls({field: Vocab() for field in fields})
+
+    def save(self, path: str, fields: Iterable[str] = VOCAB_FIELDS):
+        """Write the given fields as json. A directory path gets VOCAB_FILENAME appended."""
+        if os.path.isdir(path):
+            path = os.path.join(path, VOCAB_FILENAME)
+        data = {field: self[field].strings for field in fields}
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fp:
+            json.dump(data, fp, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "Vocabs":
+        if os.path.isdir(path):
+            path = os.path.join(path, VOCAB_FILENAME)
+        with open(path, encoding="utf-8") as fp:
+            data = json.load(fp)
+        return cls({field: Vocab(strings) for field, strings in data.items()})
+
+    @classmethod
+    def load_or_new(cls, path: str) -> "Vocabs":
+        if os.path.isdir(path):
+            path = os.path.join(path, VOCAB_FILENAME)
+        if os.path.exists(path):
+            return cls.load(path)
+        return cls.new()
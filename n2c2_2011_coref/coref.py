@@ -0,0 +1,213 @@
+"""
+Mention table and coreference clusters for n2c2 2011 coref
+
+All concepts of all documents go into one columnar mention table (numpy
+int32 columns, documents are contiguous row ranges). Every chain of a
+.chains file unions its mentions with an array based union-find, so a
+mention that appears in two chains joins them, and concepts that are in
+no chain are singleton clusters. Clusters are then relabelled 0..n-1 and
+stored in CSR form, which gives constant time lookups both ways,
+
+    index = build_coref_index(iter_samples(PATHS["task_1c"]))
+    cluster = index.cluster[row]                 # mention -> chain
+    rows = index.cluster_mentions(cluster)       # chain -> mentions
+    pos = index.positive_pairs("clinical-1")     # (n, 2) mention rows
+    neg = index.negative_pairs("clinical-1")
+
+"""
+
+from array import array
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from parse import CONCEPT_TYPES, Mismatch, PATHS, iter_samples
+
+
+MENTION_COLUMNS = ("doc", "line", "start", "end", "type")
+
+
+def _find(parent: array, ii: int) -> int:
+    while parent[ii] != ii:
+        # path halving
+        parent[ii] = parent[parent[ii]]
+        ii = parent[ii]
+    return ii
+
+
+class CorefIndex:
+    """Mentions of many documents with their coreference clusters (see module docstring)"""
+
+    def __init__(
+        self,
+        sample_ids: List[str],
+        columns: Dict[str, np.ndarray],
+        parent: array,
+        mismatches: List[Mismatch],
+    ):
+        self.sample_ids = sample_ids
+        self.doc_rows = {sample_id: ii for ii, sample_id in enumerate(sample_ids)}
+        self.columns = columns
+        self.mismatches = mismatches
+
+        roots = np.frombuffer(parent, dtype=np.int32)
+        # relabel union-find roots to dense cluster ids in mention order
+        _, first, cluster = np.unique(roots, return_index=True, return_inverse=True)
+        order = np.argsort(first, kind="stable")
+        relabel = np.empty_like(order)
+        relabel[order] = np.arange(len(order))
+        self.cluster = relabel[cluster].astype(np.int32)
+
+        self.cluster_order = np.argsort(self.cluster, kind="stable").astype(np.int32)
+        self.cluster_offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.cluster, minlength=len(order)), out=self.cluster_offsets[1:])
+
+        doc = columns["doc"]
+        self.doc_offsets = np.searchsorted(doc, np.arange(len(sample_ids) + 1)).astype(np.int64)
+        self._span_rows = None
+
+    def __len__(self):
+        return len(self.cluster)
+
+    @property
+    def num_clusters(self) -> int:
+        return len(self.cluster_offsets) - 1
+
+    def cluster_mentions(self, cluster: int) -> np.ndarray:
+        """Mention rows of a cluster, in mention order"""
+        return self.cluster_order[self.cluster_offsets[cluster]: self.cluster_offsets[cluster + 1]]
+
+    def cluster_sizes(self) -> np.ndarray:
+        return np.diff(self.cluster_offsets)
+
+    def doc_mentions(self, sample_id: str) -> np.ndarray:
+        ii = self.doc_rows[sample_id]
+        return np.arange(self.doc_offsets[ii], self.doc_offsets[ii + 1])
+
+    def mention(self, sample_id: str, line: int, start: int, end: int) -> int:
+        """Row of the mention with this span (0 based line, half open tokens), KeyError if none"""
+        if self._span_rows is None:
+            self._span_rows = {}
+            cols = self.columns
+            keys = zip(*(cols[name].tolist() for name in ("doc", "line", "start", "end")))
+            for row, key in enumerate(keys):
+                self._span_rows.setdefault(key, row)
+        return self._span_rows[(self.doc_rows[sample_id], line, start, end)]
+
+    def positive_pairs(self, sample_id: str) -> np.ndarray:
+        """(n, 2) array of mention rows (i < j) that are in the same cluster"""
+        clusters = np.unique(self.cluster[self.doc_mentions(sample_id)])
+        # only pairs within each cluster, not all pairs of the document
+        pairs = [np.zeros((0, 2), dtype=np.int64)]
+        for cluster in clusters[self.cluster_sizes()[clusters] > 1]:
+            rows = self.cluster_mentions(cluster).astype(np.int64)
+            ii, jj = np.triu_indices(len(rows), k=1)
+            pairs.append(np.stack([rows[ii], rows[jj]], axis=1))
+        pairs = np.concatenate(pairs)
+        return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+    def negative_pairs(self, sample_id: str, same_type: bool = False) -> np.ndarray:
+        """(n, 2) array of mention rows (i < j) in different clusters,
+        optionally only pairs of mentions with the same concept type"""
+        rows = self.doc_mentions(sample_id)
+        ii, jj = np.triu_indices(len(rows), k=1)
+        keep = self.cluster[rows[ii]] != self.cluster[rows[jj]]
+        if same_type:
+            types = self.columns["type"]
+            keep &= types[rows[ii]] == types[rows[jj]]
+        return np.stack([rows[ii[keep]], rows[jj[keep]]], axis=1)
+
+    def chains(self, sample_id: str) -> List[List[Tuple[int, int, int]]]:
+        """(line, start, end) spans of every cluster with more than one mention in a document"""
+        cols = self.columns
+        out = []
+        seen = set()
+        for row in self.doc_mentions(sample_id):
+            cluster = self.cluster[row]
+            if cluster in seen:
+                continue
+            seen.add(cluster)
+            rows = self.cluster_mentions(cluster)
+            if len(rows) > 1:
+                out.append([(int(cols["line"][rr]), int(cols["start"][rr]), int(cols["end"][rr])) for rr in rows])
+        return out
+
+
+def build_coref_index(samples: Iterable[Dict]) -> CorefIndex:
+    """Build the mention table and clusters from iter_samples(...) output in one pass"""
+    sample_ids = []
+    columns = {name: array("i") for name in MENTION_COLUMNS}
+    parent = array("i")
+    mismatches = []
+
+    def add_mention(doc, line, start, end, type_code):
+        row = len(parent)
+        for name, value in zip(MENTION_COLUMNS, (doc, line, start, end, type_code)):
+            columns[name].append(value)
+        parent.append(row)
+        return row
+
+    for sample in samples:
+        concepts = sample.get("concepts")
+        chains = sample.get("coref_chains")
+        if concepts is None:
+            continue
+        doc = len(sample_ids)
+        sample_ids.append(sample["sample_id"])
+
+        span_rows = {}
+        for line, start, end, type_code in zip(concepts.line, concepts.start, concepts.end, concepts.type):
+            row = add_mention(doc, line, start, end, type_code)
+            span_rows.setdefault((line, start, end), row)
+        if chains is None:
+            continue
+        mismatches.extend(chains.mismatches)
+
+        heads = {}
+        for line, start, end, chain in zip(chains.line, chains.start, chains.end, chains.chain):
+            row = span_rows.get((line, start, end))
+            if row is None:
+                # a chain mention with no concept, keep it as a mention anyway
+                mismatches.append(Mismatch(
+                    sample["sample_id"], "chains", chains.chain_line[chain], "chain_mention", "concept", f"{line + 1}:{start} {line + 1}:{end - 1}"
+                ))
+                row = add_mention(doc, line, start, end, chains.chain_type[chain])
+                span_rows[(line, start, end)] = row
+            if chain not in heads:
+                heads[chain] = row
+                continue
+            root_a = _find(parent, heads[chain])
+            root_b = _find(parent, row)
+            if root_a != root_b:
+                parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    for ii in range(len(parent)):
+        parent[ii] = _find(parent, ii)
+
+    return CorefIndex(
+        sample_ids,
+        {name: np.frombuffer(values, dtype=np.int32) for name, values in columns.items()},
+        parent,
+        mismatches,
+    )
+
+
+def report_coref(index: CorefIndex):
+
+    sizes = index.cluster_sizes()
+    print('total documents: ', len(index.sample_ids))
+    print('total mentions: ', len(index))
+    print('clusters with more than one mention: ', int((sizes > 1).sum()))
+    print('mentions in those clusters: ', int(sizes[sizes > 1].sum()))
+    print('largest cluster: ', int(sizes.max()) if len(sizes) else 0)
+    print('positive pairs: ', int((sizes * (sizes - 1) // 2).sum()))
+    types = np.bincount(index.columns["type"], minlength=len(CONCEPT_TYPES))
+    print('mention type counts: ', dict(zip(CONCEPT_TYPES, types.tolist())))
+    print('mismatches: ', len(index.mismatches))
+    print()
+
+
+if __name__ == "__main__":
+
+    index = build_coref_index(iter_samples(PATHS["task_1c"]))
+    report_coref(index)
@@ -11,13 +11,15 @@ task_1c:
 
 
 """
-from collections import defaultdict
-from dataclasses import dataclass
+from array import array
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
 import gzip
 import os
 import re
 import tarfile
-from typing import Iterable, Tuple
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 import xml.etree.ElementTree as ET
 from xml.etree.ElementTree import Element
 import zipfile
@@ -40,60 +42,378 @@ PATHS = {
 }
 
 
-path = PATHS["task_1c"]
+def read_samples(path):
 
-samples = defaultdict(dict)
-with zipfile.ZipFile(path) as zf:
-    for info in zf.infolist():
+    samples = defaultdict(dict)
+    with zipfile.ZipFile(path) as zf:
+        for info in zf.infolist():
 
-        base, filename = os.path.split(info.filename)
-        exts = tuple(filename.split('.')[1:])
-        sample_id = filename.split('.')[0]
+            base, filename = os.path.split(info.filename)
+            exts = tuple(filename.split('.')[1:])
+            sample_id = filename.split('.')[0]
 
-        if exts in [("txt",), ("txt", "con")]:
-            metapath = tuple(base.split("/"))
-            samples[sample_id]["metapath"] = metapath
-            content = zf.read(info).decode("utf-8")
+            if exts in [("txt",), ("txt", "con")]:
+                metapath = tuple(base.split("/"))
+                samples[sample_id]["sample_id"] = sample_id
+                samples[sample_id]["metapath"] = metapath
+                content = zf.read(info).decode("utf-8")
+
+                if exts == ("txt",):
+                    samples[sample_id]["txt"] = content
+
+                elif exts == ("txt", "con"):
+                    samples[sample_id]["con"] = content
+
+            elif exts == ("txt", "chains"):
+                samples[sample_id]["chains"] = zf.read(info).decode("utf-8")
+
+    return samples
+
+
+# Lazy loading
+#=========================================
+
+class SampleMembers(NamedTuple):
+    """Zip member names of one sample (None when the archive has no such file)"""
+    txt: Optional[str]
+    con: Optional[str]
+    metapath: Tuple[str, ...]
+    chains: Optional[str] = None
 
-            if exts == ("txt",):
-                samples[sample_id]["txt"] = content
 
+def index_samples(path: str) -> Dict[str, SampleMembers]:
+    """sample_id -> SampleMembers from the zip central directory (no member is read)"""
+    members = defaultdict(dict)
+    with zipfile.ZipFile(path) as zf:
+        for info in zf.infolist():
+            base, filename = os.path.split(info.filename)
+            exts = tuple(filename.split('.')[1:])
+            sample_id = filename.split('.')[0]
+            if exts == ("txt",):
+                members[sample_id]["txt"] = info.filename
             elif exts == ("txt", "con"):
-                samples[sample_id]["con"] = content
+                members[sample_id]["con"] = info.filename
+            elif exts == ("txt", "chains"):
+                members[sample_id]["chains"] = info.filename
+                continue
+            else:
+                continue
+            # same rule as read_samples, the last member seen wins
+            members[sample_id]["metapath"] = tuple(base.split("/"))
+
+    return {
+        sample_id: SampleMembers(found.get("txt"), found.get("con"), found["metapath"], found.get("chains"))
+        for sample_id, found in members.items()
+        if "metapath" in found
+    }
+
+
+def load_sample(zf: zipfile.ZipFile, sample_id: str, members: SampleMembers) -> Dict:
+    """Read the members of one sample and parse its concepts and chains.
+
+    Returns a dict with the read_samples keys plus "concepts" (None
+    without both a .txt and a .con file) and "coref_chains" (None without
+    a .chains file).
+    """
+    sample = {"sample_id": sample_id, "metapath": members.metapath}
+    if members.txt is not None:
+        sample["txt"] = zf.read(members.txt).decode("utf-8")
+    if members.con is not None:
+        sample["con"] = zf.read(members.con).decode("utf-8")
+    sample["concepts"] = None
+    if "txt" in sample and "con" in sample:
+        sample["concepts"] = parse_concepts(sample_id, sample["txt"], sample["con"])
+    sample["coref_chains"] = None
+    if members.chains is not None:
+        sample["chains"] = zf.read(members.chains).decode("utf-8")
+        sample["coref_chains"] = parse_chains(sample_id, sample["chains"])
+    return sample
+
+
+# one open ZipFile per archive in each worker process. keyed by pid too
+# so a forked worker never shares the file position of its parent
+_ZIP_FILES: Dict[Tuple[int, str], zipfile.ZipFile] = {}
 
 
+def _load_sample_worker(args):
+    path, sample_id, members = args
+    key = (os.getpid(), path)
+    if key not in _ZIP_FILES:
+        _ZIP_FILES[key] = zipfile.ZipFile(path)
+    return load_sample(_ZIP_FILES[key], sample_id, members)
+
+
+def iter_samples(path: str, num_proc: int = 1, max_pending: Optional[int] = None) -> Iterator[Dict]:
+    """Lazily yield load_sample(...) for every sample in the archive, in index order.
+
+    Members are only read when their sample is reached. With num_proc > 1
+    samples are read and parsed by a pool of worker processes with at most
+    max_pending (default 2 per worker) samples in flight.
+    """
+    index = index_samples(path)
+    if num_proc <= 1:
+        with zipfile.ZipFile(path) as zf:
+            for sample_id, members in index.items():
+                yield load_sample(zf, sample_id, members)
+        return
+
+    items = ((path, sample_id, members) for sample_id, members in index.items())
+
+    if max_pending is None:
+        max_pending = 2 * num_proc
+    executor = ProcessPoolExecutor(max_workers=num_proc)
+    try:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(_load_sample_worker, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
 
-sample_id = "clinical-522"
-text = samples[sample_id]["txt"]
-text_lines = text.splitlines()
-concepts_lines = samples[sample_id]["con"].splitlines()
 
 dq = '''"'''
 sq = """'"""
 
 
-for cl in concepts_lines:
+# Concepts
+#=========================================
+# each line of a .con file looks like,
+#   c="chest pain" 12:3 12:4||t="problem"
+# with 1 based line numbers and 0 based, inclusive token offsets into the
+# whitespace tokenized line of the .txt file
+
+CONCEPT_RE = re.compile(
+    r'^c="(?P<text>.*)" (?P<start_line>\d+):(?P<start_token>\d+) '
+    r'(?P<end_line>\d+):(?P<end_token>\d+)\|\|t="(?P<type>[^"]*)"\s*$'
+)
+
+CONCEPT_TYPES = ("person", "problem", "treatment", "test", "pronoun")
+CONCEPT_TYPE_CODES = {ctype: ii for ii, ctype in enumerate(CONCEPT_TYPES)}
+
+
+@dataclass
+class Mismatch:
+    """A line of a .con or .chains file (source) that was left out and why, line is 0 based"""
+    sample_id: str
+    source: str
+    line: int
+    kind: str
+    expected: str
+    found: str
+
+
+@dataclass
+class Concepts:
+    """Columnar concepts of one document.
+
+    line is 0 based, [start, end) are token positions in that line and
+    type holds codes into CONCEPT_TYPES. Lines of the .con file that could
+    not be parsed or do not agree with the .txt file are left out and
+    described in mismatches instead.
+    """
+    sample_id: str
+    text: List[str] = field(default_factory=list)
+    line: array = field(default_factory=lambda: array("i"))
+    start: array = field(default_factory=lambda: array("i"))
+    end: array = field(default_factory=lambda: array("i"))
+    type: array = field(default_factory=lambda: array("b"))
+    mismatches: List[Mismatch] = field(default_factory=list)
+
+    def __len__(self):
+        return len(self.line)
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame({
+            "sample_id": self.sample_id,
+            "text": self.text,
+            "line": self.line,
+            "start": self.start,
+            "end": self.end,
+            "type": pd.Categorical.from_codes(self.type, categories=CONCEPT_TYPES),
+        })
+
+
+def parse_concepts(sample_id: str, txt: str, con: str) -> Concepts:
+    """Parse a .con file and check its tokens against the .txt file"""
+    # tokenize each line of the text once for all concepts on it
+    line_tokens = [line.split() for line in txt.splitlines()]
+    concepts = Concepts(sample_id)
+    con_lines = []
+
+    def mismatch(con_line, kind, expected, found):
+        concepts.mismatches.append(Mismatch(sample_id, "con", con_line, kind, expected, found))
+
+    for con_line, cl in enumerate(con.splitlines()):
+        if not cl.strip():
+            continue
+        match = CONCEPT_RE.match(cl)
+        if match is None:
+            mismatch(con_line, "format", CONCEPT_RE.pattern, cl)
+            continue
+
+        text = match.group("text")
+        start_line = int(match.group("start_line"))
+        end_line = int(match.group("end_line"))
+        start = int(match.group("start_token"))
+        end = int(match.group("end_token")) + 1
+        type_code = CONCEPT_TYPE_CODES.get(match.group("type"), -1)
+
+        if start_line != end_line:
+            mismatch(con_line, "multiline", f"{start_line}", f"{end_line}")
+            continue
+        line = start_line - 1
+        if not 0 <= line < len(line_tokens):
+            mismatch(con_line, "line", f"< {len(line_tokens)}", f"{line}")
+            continue
+        if type_code < 0:
+            mismatch(con_line, "type", "|".join(CONCEPT_TYPES), match.group("type"))
+            continue
+
+        con_lines.append(con_line)
+        concepts.text.append(text)
+        concepts.line.append(line)
+        concepts.start.append(start)
+        concepts.end.append(end)
+        concepts.type.append(type_code)
+
+    # concept text is lower cased in the .con files
+    keep = []
+    for ii, (con_line, text, line, start, end) in enumerate(
+        zip(con_lines, concepts.text, concepts.line, concepts.start, concepts.end)
+    ):
+        found = " ".join(line_tokens[line][start: end]).lower()
+        if found == " ".join(text.replace(dq, "").split()):
+            keep.append(ii)
+        else:
+            mismatch(con_line, "tokens", text, found)
+
+    if len(keep) < len(concepts):
+        concepts.text = [concepts.text[ii] for ii in keep]
+        for name in ("line", "start", "end", "type"):
+            column = getattr(concepts, name)
+            setattr(concepts, name, array(column.typecode, (column[ii] for ii in keep)))
+
+    return concepts
+
+
+# Coreference chains
+#=========================================
+# each line of a .chains file is one chain,
+#   c="the patient" 3:0 3:1||c="he" 7:4 7:4||t="coref person"
+# with the mentions in the same format as the .con concepts
+
+MENTION_RE = re.compile(
+    r'^c="(?P<text>.*)" (?P<start_line>\d+):(?P<start_token>\d+) '
+    r'(?P<end_line>\d+):(?P<end_token>\d+)$'
+)
+
+CHAIN_TYPE_RE = re.compile(r'^t="coref (?P<type>[^"]*)"\s*$')
+
+
+@dataclass
+class Chains:
+    """Columnar mentions of the coreference chains of one document.
+
+    One row per mention (line 0 based, [start, end) token positions) with
+    chain the row of its chain in chain_type (codes into CONCEPT_TYPES) and
+    chain_line (0 based line in the .chains file). Chains that could not be parsed are left out and described in
+    mismatches.
+    """
+    sample_id: str
+    text: List[str] = field(default_factory=list)
+    line: array = field(default_factory=lambda: array("i"))
+    start: array = field(default_factory=lambda: array("i"))
+    end: array = field(default_factory=lambda: array("i"))
+    chain: array = field(default_factory=lambda: array("i"))
+    chain_type: array = field(default_factory=lambda: array("b"))
+    chain_line: array = field(default_factory=lambda: array("i"))
+    mismatches: List[Mismatch] = field(default_factory=list)
+
+    def __len__(self):
+        return len(self.line)
+
+
+def parse_chains(sample_id: str, chains: str) -> Chains:
+    """Parse a .chains file"""
+    out = Chains(sample_id)
+
+    for chains_line, cl in enumerate(chains.splitlines()):
+        if not cl.strip():
+            continue
+        *parts, tpart = cl.split("||")
+        type_match = CHAIN_TYPE_RE.match(tpart)
+        matches = [MENTION_RE.match(part) for part in parts]
+        if type_match is None or not matches or None in matches:
+            out.mismatches.append(Mismatch(sample_id, "chains", chains_line, "format", "chain", cl))
+            continue
+        type_code = CONCEPT_TYPE_CODES.get(type_match.group("type"), -1)
+        if type_code < 0:
+            out.mismatches.append(
+                Mismatch(sample_id, "chains", chains_line, "type", "|".join(CONCEPT_TYPES), type_match.group("type"))
+            )
+            continue
+        if any(match.group("start_line") != match.group("end_line") for match in matches):
+            out.mismatches.append(Mismatch(sample_id, "chains", chains_line, "multiline", "chain", cl))
+            continue
+
+        chain = len(out.chain_type)
+        out.chain_type.append(type_code)
+        out.chain_line.append(chains_line)
+        for match in matches:
+            out.text.append(match.group("text"))
+            out.line.append(int(match.group("start_line")) - 1)
+            out.start.append(int(match.group("start_token")))
+            out.end.append(int(match.group("end_token")) + 1)
+            out.chain.append(chain)
+
+    return out
+
+
+def get_concepts(sample):
+    """(tokens, line, start token, end token, type) tuples of one sample.
+
+    Kept for existing callers, raises on the first mismatch like it always
+    did. Use parse_concepts to get every mismatch instead.
+    """
+    concepts = parse_concepts(sample["sample_id"], sample["txt"], sample["con"])
+    assert not concepts.mismatches, concepts.mismatches[0]
+    return [
+        (tuple(text.replace(dq, "").split()), line, start, end, CONCEPT_TYPES[type_code])
+        for text, line, start, end, type_code in zip(
+            concepts.text, concepts.line, concepts.start, concepts.end, concepts.type
+        )
+    ]
+
+
+def parse_archive(path: str, num_proc: int = 1) -> Dict[str, Concepts]:
+    """Concepts of every sample in the archive that has both a .txt and a .con file"""
+    return {
+        sample["sample_id"]: sample["concepts"]
+        for sample in iter_samples(path, num_proc=num_proc)
+        if sample["concepts"] is not None
+    }
+
 
-    cpart, tpart = cl.split("||")
-    cpart = cpart.replace("c=", "")
-    cpart = cpart.replace(dq, '')
-    cpart_pieces = cpart.split()
-    cpart_tokens = tuple(cpart_pieces[:-2])
-    cpart_start = cpart_pieces[-2]
-    cpart_end = cpart_pieces[-1]
+def report_concepts(concepts_by_sample: Dict[str, Concepts]):
 
-    cpart_start_line, cpart_start_token = [int(el) for el in cpart_start.split(":")]
-    cpart_end_line, cpart_end_token = [int(el) for el in cpart_end.split(":")]
-    assert(cpart_start_line == cpart_end_line)
-    cpart_line = cpart_start_line - 1
-    cpart_end_token += 1
+    mismatches = [mm for concepts in concepts_by_sample.values() for mm in concepts.mismatches]
+    type_counts = Counter(
+        CONCEPT_TYPES[code] for concepts in concepts_by_sample.values() for code in concepts.type
+    )
+    print('total samples: ', len(concepts_by_sample))
+    print('total concepts: ', sum(len(concepts) for concepts in concepts_by_sample.values()))
+    print('concept type counts: ', dict(type_counts))
+    print('mismatches: ', dict(Counter(f"{mm.source} {mm.kind}" for mm in mismatches)))
+    for mm in mismatches[:10]:
+        print('  ', f"{mm.sample_id}.{mm.source}:{mm.line + 1} {mm.kind}: expected {mm.expected!r}, found {mm.found!r}")
+    print()
 
-    tpart = tpart.replace("t=", "")
-    concept_type = tpart.replace(dq, '')
 
-    tokens_from_line = tuple([
-        el.lower() for el in
-        text_lines[cpart_line].split()[cpart_start_token: cpart_end_token]
-    ])
+if __name__ == "__main__":
 
-    assert(tokens_from_line == cpart_tokens)
+    path = PATHS["task_1c"]
+    concepts_by_sample = parse_archive(path)
+    report_concepts(concepts_by_sample)
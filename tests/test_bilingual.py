@@ -0,0 +1,37 @@
+from bilingual import join_on_prefix
+
+
+def _stream(prefixes, tag):
+    return [(prefix, f"{tag}:{prefix}") for prefix in prefixes]
+
+
+def test_join_on_prefix_matches_out_of_order():
+    left = _stream(["a", "b", "c", "d"], "l")
+    right = _stream(["b", "a", "e", "c"], "r")
+    out = list(join_on_prefix(left, right))
+    assert sorted(out, key=lambda row: row[0]) == [
+        ("a", "l:a", "r:a"),
+        ("b", "l:b", "r:b"),
+        ("c", "l:c", "r:c"),
+        ("d", "l:d", None),
+        ("e", None, "r:e"),
+    ]
+
+
+def test_join_on_prefix_reports_evicted_pairs():
+    # "a" is the first item on the left but the fourth on the right
+    left = _stream(["a", "b", "c", "d"], "l")
+    right = _stream(["x", "y", "z", "a"], "r")
+    evicted = set()
+    out = list(join_on_prefix(left, right, max_waiting=2, evicted=evicted))
+
+    assert ("a", "l:a", "r:a") not in out
+    assert ("a", "l:a", None) in out
+    assert ("a", None, "r:a") in out
+    assert "a" in evicted
+    # every item comes out exactly once
+    assert sorted(item for row in out for item in row[1:] if item is not None) == sorted(
+        item for _, item in left + right
+    )
+    # without max_waiting the pair is found
+    assert ("a", "l:a", "r:a") in list(join_on_prefix(left, right))
@@ -0,0 +1,145 @@
+import hashlib
+import http.server
+import json
+import os
+import threading
+
+import pytest
+
+import fetch
+from synthetic import write_much_more
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """Serves src_dir with Range / If-Range support and injectable failures"""
+
+    src_dir = None
+    # name -> number of GETs to cut off after a third of the body
+    cut = {}
+    # name -> number of ranged GETs answered with a broken Content-Range
+    bad_range = {}
+    log = []
+
+    def log_message(self, *args):
+        pass
+
+    def _file(self):
+        name = os.path.basename(self.path)
+        with open(os.path.join(self.src_dir, name), "rb") as fp:
+            data = fp.read()
+        return name, data, '"%s"' % hashlib.md5(data).hexdigest()
+
+    def do_HEAD(self):
+        name, data, etag = self._file()
+        self.log.append(("HEAD", name, None))
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+
+    def do_GET(self):
+        name, data, etag = self._file()
+        range_header = self.headers.get("Range")
+        self.log.append(("GET", name, range_header))
+        start = 0
+        if range_header and self.headers.get("If-Range") == etag:
+            start = int(range_header.split("=")[1].rstrip("-"))
+            self.send_response(206)
+            if self.bad_range.get(name):
+                self.bad_range[name] -= 1
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+            else:
+                self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        body = data[start:]
+        if self.cut.get(name):
+            self.cut[name] -= 1
+            self.wfile.write(body[: len(body) // 3])
+            self.wfile.flush()
+            self.connection.shutdown(2)
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    src_dir = tmp_path / "src"
+    write_much_more(str(src_dir), scale=0.05)
+    handler = type("Handler", (_Handler,), {"src_dir": str(src_dir), "cut": {}, "bad_range": {}, "log": []})
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    monkeypatch.setattr(fetch.time, "sleep", lambda seconds: None)
+
+    base = f"http://127.0.0.1:{httpd.server_port}/pubs/"
+    urls = {key: base + os.path.basename(url) for key, url in fetch.read_urls().items()}
+    yield urls, str(src_dir), handler
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _same_files(src_dir, dest_dir):
+    for name in os.listdir(src_dir):
+        with open(os.path.join(src_dir, name), "rb") as src, open(os.path.join(dest_dir, name), "rb") as dest:
+            assert src.read() == dest.read(), name
+
+
+def test_fetch_resumes_and_skips_current_files(server, tmp_path):
+    urls, src_dir, handler = server
+    dest_dir = str(tmp_path / "dest")
+    handler.cut["springer_german_train_V4.2.tar.gz"] = 1
+
+    status = fetch.fetch(urls, dest_dir)
+    assert set(status.values()) == {"downloaded"}
+    assert len(status) == 4
+    _same_files(src_dir, dest_dir)
+    # the cut download was resumed from where it stopped
+    ranged = [(method, name) for method, name, range_header in handler.log if range_header]
+    assert ranged == [("GET", "springer_german_train_V4.2.tar.gz")]
+    assert not [name for name in os.listdir(dest_dir) if name.endswith(".part")]
+
+    handler.log.clear()
+    assert set(fetch.fetch(urls, dest_dir).values()) == {"current"}
+    assert handler.log == []
+    assert set(fetch.fetch(urls, dest_dir, check_remote=True).values()) == {"current"}
+    assert {method for method, _, _ in handler.log} == {"HEAD"}
+
+
+def test_fetch_restarts_on_bad_content_range(server, tmp_path):
+    urls, src_dir, handler = server
+    dest_dir = str(tmp_path / "dest")
+    name = "springer_english_train_plain.tar.gz"
+    handler.cut[name] = 1
+    handler.bad_range[name] = 1
+
+    fetch.fetch(urls, dest_dir)
+    _same_files(src_dir, dest_dir)
+    # cut, resumed with a broken Content-Range, then downloaded from the start
+    assert [range_header is None for method, got, range_header in handler.log if got == name] == [True, False, True]
+
+
+def test_fetch_checks_manifest_and_adopts_old_files(server, tmp_path):
+    urls, src_dir, handler = server
+    dest_dir = str(tmp_path / "dest")
+    fetch.fetch(urls, dest_dir)
+
+    name = "springer_english_train_plain.tar.gz"
+    os.remove(os.path.join(dest_dir, name))
+    with pytest.raises(fetch.FetchError):
+        fetch.fetch(urls, dest_dir, manifest={name: {"sha256": "0" * 64}})
+    assert not os.path.exists(os.path.join(dest_dir, name))
+
+    # a file without a state entry (e.g. from the old fetch_data.sh) is kept
+    state_path = os.path.join(dest_dir, fetch.STATE_FILENAME)
+    with open(state_path, encoding="utf-8") as fp:
+        state = json.load(fp)
+    state.pop("springer_german_train_plain.tar.gz")
+    with open(state_path, "w", encoding="utf-8") as fp:
+        json.dump(state, fp)
+    status = fetch.fetch(urls, dest_dir)
+    assert status["springer_german_train_plain.tar.gz"] == "adopted"
+    assert status[name] == "downloaded"
+    _same_files(src_dir, dest_dir)
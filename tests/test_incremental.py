@@ -0,0 +1,109 @@
+import io
+import os
+import tarfile
+
+import pytest
+
+import compact
+import incremental
+from archive import iter_members
+from parse import doc_from_item, plain_row
+from synthetic import write_much_more
+
+
+@pytest.fixture
+def archives(tmp_path):
+    write_much_more(str(tmp_path), scale=0.05, seed=1)
+    anno = {
+        "en": str(tmp_path / "springer_english_train_V4.2.tar.gz"),
+        "de": str(tmp_path / "springer_german_train_V4.2.tar.gz"),
+    }
+    plain = {
+        "en": str(tmp_path / "springer_english_train_plain.tar.gz"),
+        "de": str(tmp_path / "springer_german_train_plain.tar.gz"),
+    }
+    return anno, plain
+
+
+def _fresh_docs(paths):
+    items = [(language, name, data) for language, path in paths.items() for name, data in iter_members(path)]
+    return [doc for _, doc in map(doc_from_item, items) if doc is not None]
+
+
+def _fresh_plain(paths):
+    return [plain_row((language, name, data)) for language, path in paths.items() for name, data in iter_members(path)]
+
+
+def _rebuilt_docs(out_dir):
+    cdocs, _ = compact.read_corpus(out_dir)
+    return [cdoc.to_document() for cdoc in cdocs]
+
+
+def _rebuilt_plain(out_dir):
+    return [tuple(row) for row in incremental.load_plain(out_dir).itertuples(index=False)]
+
+
+def _edit_archive(path):
+    """change member 3, remove member 5 and add a new member"""
+    members = list(iter_members(path))
+    changed = members[3][1]
+    changed = changed.replace(b'lemma="', b'lemma="x', 1) if b'lemma="' in changed else changed + b"more text\n"
+    out = [(name, changed if ii == 3 else data) for ii, (name, data) in enumerate(members) if ii != 5]
+    name, data = members[10]
+    out.insert(20, (name.replace(".0013", ".9913"), data.replace(b'id="', b'id="new', 1)))
+    with tarfile.open(path, "w:gz") as tf:
+        for name, data in out:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+
+
+def test_rebuild_docs_matches_fresh_parse(archives, tmp_path):
+    anno, _ = archives
+    out_dir = str(tmp_path / "docs")
+    incremental.rebuild_docs(out_dir, paths=anno)
+    assert _rebuilt_docs(out_dir) == _fresh_docs(anno)
+
+    _edit_archive(anno["de"])
+    stats = incremental.rebuild_docs(out_dir, paths=anno)
+    assert stats["de"]["changed"] == 1
+    assert stats["de"]["removed"] == 1
+    assert stats["de"]["added"] == 1
+    assert stats["en"] == {"unchanged": stats["en"]["unchanged"], "added": 0, "changed": 0, "removed": 0}
+    assert _rebuilt_docs(out_dir) == _fresh_docs(anno)
+
+
+def test_rebuild_plain_matches_fresh_parse(archives, tmp_path):
+    _, plain = archives
+    out_dir = str(tmp_path / "plain")
+    incremental.rebuild_plain(out_dir, paths=plain)
+    assert _rebuilt_plain(out_dir) == _fresh_plain(plain)
+
+    _edit_archive(plain["en"])
+    stats = incremental.rebuild_plain(out_dir, paths=plain)
+    assert (stats["en"]["changed"], stats["en"]["removed"], stats["en"]["added"]) == (1, 1, 1)
+    assert _rebuilt_plain(out_dir) == _fresh_plain(plain)
+
+
+def test_rebuild_without_changes_keeps_output(archives, tmp_path):
+    anno, _ = archives
+    out_dir = str(tmp_path / "docs")
+    incremental.rebuild_docs(out_dir, paths=anno)
+    corpus_mtime = os.stat(os.path.join(out_dir, "vocabs.json")).st_mtime_ns
+
+    # touched but identical archives are hashed, nothing is re-parsed or rewritten
+    os.utime(anno["en"])
+    stats = incremental.rebuild_docs(out_dir, paths=anno)
+    assert all(counts["added"] == counts["changed"] == counts["removed"] == 0 for counts in stats.values())
+    assert os.stat(os.path.join(out_dir, "vocabs.json")).st_mtime_ns == corpus_mtime
+    manifest = incremental.read_manifest(out_dir)
+    assert manifest["archives"]["en"]["mtime_ns"] == os.stat(anno["en"]).st_mtime_ns
+    assert _rebuilt_docs(out_dir) == _fresh_docs(anno)
+
+
+def test_rebuild_drops_removed_archive(archives, tmp_path):
+    anno, _ = archives
+    out_dir = str(tmp_path / "docs")
+    incremental.rebuild_docs(out_dir, paths=anno)
+    incremental.rebuild_docs(out_dir, paths={"en": anno["en"]})
+    assert _rebuilt_docs(out_dir) == _fresh_docs({"en": anno["en"]})